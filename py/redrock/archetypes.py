@@ -3,15 +3,19 @@ Classes and functions for archetypes.
 """
 
 import os
+import sys
+import hashlib
 from glob import glob
 from astropy.io import fits
 import numpy as np
 from scipy.interpolate import interp1d
 import scipy.special
 
-from .zscan import calc_zchi2_one
+from .zscan import calc_zchi2_one, _zchi2_batch
 
-from .rebin import trapz_rebin
+from .targets import NormalSpectrum
+
+from .rebin import trapz_rebin_batch, centers2edges
 
 from .utils import transmission_Lyman
 
@@ -48,15 +52,71 @@ class Archetype():
         self._archetype['INTERP'] = np.array([None]*self._narch)
         for i in range(self._narch):
             self._archetype['INTERP'][i] = interp1d(self.wave,self.flux[i,:],fill_value='extrapolate',kind='linear')
+        # Optional pre-selection of the candidate archetypes
+        self.index = None
+        self.ncandidates = self._narch
+        self._check_every = 0
 
         h.close()
 
         return
+    def set_index(self, index, ncandidates, check_fraction=0.1):
+        """Only fit the best candidates of an index of the archetypes.
+
+        Args:
+            index (ArchetypeIndex): the index of these archetypes.
+            ncandidates (int): the number of candidates to fit.
+            check_fraction (float): the fraction of the searches which are
+                also done with all archetypes (see get_best_archetype).
+
+        """
+        self.index = index
+        self.ncandidates = ncandidates
+        self._check_every = 0
+        if check_fraction > 0:
+            self._check_every = max(1, int(round(1.0 / check_fraction)))
+        return
+
+    def rebin_archetypes(self, z, dwave, rows=None):
+        """Linearly interpolate the archetypes at a redshift.
+
+        The archetypes are extrapolated outside of their wavelength range,
+        as by rebin_template(trapz=False).
+
+        Args:
+            z (float): the redshift.
+            dwave (dict): the wavelength grids for each wavehash.
+            rows (array): (optional) the indices of the archetypes to
+                interpolate.  Default is all of them.
+
+        Returns:
+            dict: the (len(rows), nwave) archetypes for each wavehash.
+
+        """
+        flux = self.flux
+        if rows is not None:
+            flux = flux[rows]
+        binned = dict()
+        for hs, wave in dwave.items():
+            x = wave / (1. + z)
+            i = np.clip(np.searchsorted(self.wave, x), 1, self._nwave - 1)
+            t = (x - self.wave[i-1]) / (self.wave[i] - self.wave[i-1])
+            binned[hs] = flux[:,i-1] * (1. - t) + flux[:,i] * t
+        return binned
+
+    def _check(self, z):
+        """Whether the search at redshift z is checked with all archetypes.
+        """
+        if self._check_every == 0:
+            return False
+        h = hashlib.sha1(np.float64(z).tobytes()).hexdigest()
+        return int(h[:8], 16) % self._check_every == 0
+
     def rebin_template(self,index,z,dwave,trapz=True):
         """
         """
         if trapz:
-            return {hs:trapz_rebin((1.+z)*self.wave, self.flux[index], wave) for hs, wave in dwave.items()}
+            return {hs:trapz_rebin_batch(self.wave, self.flux[index:index+1], centers2edges(wave), [z])[0,:,0] for hs, wave in dwave.items()}
         else:
             return {hs:self._archetype['INTERP'][index](wave/(1.+z)) for hs, wave in dwave.items()}
 
@@ -72,15 +132,22 @@ class Archetype():
         wave_min = w.min()
         wave_max = w.max()
         legendre = np.array([scipy.special.legendre(i)( (wave-wave_min)/(wave_max-wave_min)*2.-1. ) for i in range(deg_legendre)])
-        binned = trapz_rebin((1+z)*self.wave, self.flux[index], wave)*transmission_Lyman(z,wave)
+        binned = trapz_rebin_batch(self.wave, self.flux[index:index+1], centers2edges(wave), [z])[0,:,0]*transmission_Lyman(z,wave)
         flux = np.append(binned[None,:],legendre, axis=0)
         flux = flux.T.dot(coeff).T / (1+z)
 
         return flux
 
-    def get_best_archetype(self,spectra,weights,flux,wflux,dwave,z,legendre):
+    def get_best_archetype(self,spectra,weights,flux,wflux,dwave,z,legendre,stats=None):
         """Get the best archetype for the given redshift and spectype.
 
+        With an index (see set_index), only the best candidates of the index
+        are fit.  If stats is given, a fraction of the redshifts (chosen
+        from a hash of z, so that the choice does not depend on how the work
+        is distributed) are also searched with all archetypes, to count how
+        often the candidates miss the best archetype.  This check does not
+        change the result, which is always that of the candidates.
+
         Args:
             spectra (list): list of Spectrum objects.
             weights (array): concatenated spectral weights (ivar).
@@ -89,6 +156,9 @@ class Archetype():
             dwave (dic): dictionary of wavelength grids
             z (float): best redshift
             legendre (dic): legendre polynomial
+            stats (array): (optional) the numbers of (searches using the
+                index, searches checked with all archetypes, checks which
+                found a different archetype), which are incremented.
 
         Returns:
             chi2 (float): chi2 of best archetype
@@ -97,18 +167,31 @@ class Archetype():
 
         """
 
-        nleg = legendre[list(legendre.keys())[0]].shape[0]
-        zzchi2 = np.zeros(self._narch, dtype=np.float64)
-        zzcoeff = np.zeros((self._narch, nleg+1), dtype=np.float64)
         trans = { hs:transmission_Lyman(z,w) for hs, w in dwave.items() }
 
-        for i in range(self._narch):
-            binned = self.rebin_template(i, z, dwave,trapz=False)
-            binned = { hs:trans[hs]*binned[hs] for hs, w in dwave.items() }
-            tdata = { hs:np.append(binned[hs][:,None],legendre[hs].transpose(), axis=1 ) for hs, wave in dwave.items() }
-            zzchi2[i], zzcoeff[i] = calc_zchi2_one(spectra, weights, flux, wflux, tdata)
-
+        # Fit all archetypes (or candidates) together, and refit the best
+        # one with the trapezoidal rebinning.
+        rows = None
+        if self.index is not None:
+            rows = self.index.candidates(spectra, weights, flux, wflux,
+                dwave, z, legendre, trans, self.ncandidates)
+        binned = self.rebin_archetypes(z, dwave, rows=rows)
+        binned = { hs:trans[hs]*binned[hs] for hs, w in dwave.items() }
+        zzchi2, zzcoeff = calc_zchi2_archetypes(spectra, weights, flux,
+            wflux, binned, legendre)
         iBest = np.argmin(zzchi2)
+        if rows is not None:
+            iBest = rows[iBest]
+            if stats is not None:
+                stats[0] += 1
+                if self._check(z):
+                    full = self.rebin_archetypes(z, dwave)
+                    full = { hs:trans[hs]*full[hs] for hs, w in dwave.items() }
+                    fchi2, fcoeff = calc_zchi2_archetypes(spectra, weights,
+                        flux, wflux, full, legendre)
+                    stats[1] += 1
+                    stats[2] += int(np.argmin(fchi2) != iBest)
+
         binned = self.rebin_template(iBest, z, dwave,trapz=True)
         binned = { hs:trans[hs]*binned[hs] for hs, w in dwave.items() }
         tdata = { hs:np.append(binned[hs][:,None],legendre[hs].transpose(), axis=1 ) for hs, wave in dwave.items() }
@@ -123,9 +206,16 @@ class All_archetypes():
     Args:
         lstfilename (lst str): List of file to get the templates from
         archetypes_dir (str): Directory to the archetypes
+        ncandidates (int): if > 0, only fit the best ncandidates archetypes
+            of an ArchetypeIndex of each spectype.  The index is cached next
+            to the archetype file.
+        check_fraction (float): with ncandidates, the fraction of the
+            searches which are also done with all archetypes to count how
+            often the candidates miss the best one.
 
     """
-    def __init__(self, lstfilename=None, archetypes_dir=None):
+    def __init__(self, lstfilename=None, archetypes_dir=None, ncandidates=0,
+        check_fraction=0.1):
 
         # Get list of path to archetype
         if lstfilename is None:
@@ -136,10 +226,253 @@ class All_archetypes():
         for f in lstfilename:
             archetype = Archetype(f)
             print('DEBUG: Found {} archetypes for SPECTYPE {} in file {}'.format(archetype._narch, archetype._rrtype, f) )
+            if (ncandidates > 0) and (ncandidates < archetype._narch):
+                index = ArchetypeIndex(archetype,
+                    cache_file=archetype_index_file(f))
+                archetype.set_index(index, ncandidates,
+                    check_fraction=check_fraction)
             self.archetypes[archetype._rrtype] = archetype
 
         return
 
+def _archetype_products(spectra, weights, flux, wflux, binned, legendre,
+    full=False):
+    """Weighted products of the resolution convolved archetypes and Legendre
+    polynomials with each other and with the data.
+
+    Returns:
+        tuple: (gaa, gal, gll, ya, yl, fwf), the archetype-archetype products
+            (only the diagonal unless full is True), the archetype-Legendre
+            and Legendre-Legendre products, the products with the weighted
+            flux and the weighted sum of the squared flux.
+
+    """
+    narch = binned[spectra[0].wavehash].shape[0]
+    nleg = legendre[spectra[0].wavehash].shape[0]
+
+    if full:
+        gaa = np.zeros((narch, narch))
+    else:
+        gaa = np.zeros(narch)
+    gal = np.zeros((narch, nleg))
+    gll = np.zeros((nleg, nleg))
+    ya = np.zeros(narch)
+    yl = np.zeros(nleg)
+    fwf = 0.0
+
+    first = 0
+    for s in spectra:
+        B = binned[s.wavehash].T
+        L = legendre[s.wavehash].T
+        if isinstance(s, NormalSpectrum):
+            AB = s.A.dot(B)
+            if full:
+                gaa += B.T.dot(AB)
+            else:
+                gaa += np.sum(B * AB, axis=0)
+            gal += AB.T.dot(L)
+            gll += L.T.dot(s.A.dot(L))
+            ya += B.T.dot(s.Rtwf)
+            yl += L.T.dot(s.Rtwf)
+            fwf += s.fwf
+        else:
+            last = first + s.Rcompact.shape[0]
+            w = weights[first:last]
+            wf = wflux[first:last]
+            RB = s.Rcompact.dot(B)
+            RL = s.Rcompact.dot(L)
+            wRL = w[:,None] * RL
+            if full:
+                gaa += RB.T.dot(w[:,None] * RB)
+            else:
+                gaa += np.dot(w, RB**2)
+            gal += RB.T.dot(wRL)
+            gll += RL.T.dot(wRL)
+            ya += RB.T.dot(wf)
+            yl += RL.T.dot(wf)
+            fwf += np.dot(flux[first:last], wf)
+            first = last
+
+    return gaa, gal, gll, ya, yl, fwf
+
+
+def _solve_archetypes(gaa, gal, gll, ya, yl, fwf):
+    """Solve the Legendre-augmented normal equations of many archetypes.
+    """
+    narch, nleg = gal.shape
+    M = np.zeros((narch, nleg+1, nleg+1))
+    M[:,0,0] = gaa
+    M[:,0,1:] = gal
+    M[:,1:,0] = gal
+    M[:,1:,1:] = gll
+    y = np.zeros((narch, nleg+1))
+    y[:,0] = ya
+    y[:,1:] = yl
+
+    zchi2 = np.zeros(narch, dtype=np.float64)
+    zcoeff = np.zeros((narch, nleg+1), dtype=np.float64)
+    _zchi2_batch(M, y, fwf, zchi2, zcoeff)
+
+    return zchi2, zcoeff
+
+
+def calc_zchi2_archetypes(spectra, weights, flux, wflux, binned, legendre):
+    """Fit all archetypes, each with Legendre polynomials, at once.
+
+    Each archetype is fit with the basis (archetype, P_0, ..., P_n-1).  The
+    resolution is applied once to the stack of all archetypes and to the
+    Legendre polynomials, and the normal equations of all archetypes are
+    assembled from the weighted products of these and solved together.
+
+    Args:
+        spectra (list): list of Spectrum objects, or the list of
+            NormalSpectrum objects of a collapsed target.
+        weights (array): concatenated spectral weights of the pixels with
+            non-zero weight (see spectral_data).
+        flux (array): concatenated flux values.
+        wflux (array): concatenated weighted flux values.
+        binned (dict): the (narch, nwave) archetypes for each wavehash.
+        legendre (dict): the (nleg, nwave) Legendre polynomials for each
+            wavehash.
+
+    Returns:
+        tuple: (zchi2, zcoeff) arrays of chi^2 and coefficients for every
+            archetype.
+
+    """
+    return _solve_archetypes(*_archetype_products(spectra, weights, flux,
+        wflux, binned, legendre))
+
+
+class ArchetypeIndex(object):
+    """Low dimensional rest-frame index of the archetypes of one spectype.
+
+    The (normalized) archetypes are decomposed on their first nbasis
+    principal components, and each archetype is represented by its
+    projection on them.  For a target and redshift, the basis is fit to the
+    data once, and the chi2 of every archetype is approximated by that of
+    its projection.  The cost per pixel is that of the nbasis vectors
+    instead of all archetypes.  Only the best candidates of this approximate
+    chi2 are then interpolated and fit with the full archetypes.
+
+    The basis and projections are cached in cache_file, if given (see
+    archetype_index_file).  If the cache cannot be written, a warning is
+    printed once per file and process.
+
+    Args:
+        archetype (Archetype): the archetypes.
+        nbasis (int): the number of principal components.
+        cache_file (str): (optional) the cache file of the index.
+
+    """
+    def __init__(self, archetype, nbasis=10, cache_file=None):
+        h = hashlib.sha1()
+        for x in [archetype.wave, archetype.flux]:
+            h.update(np.ascontiguousarray(x, dtype=np.float64).tobytes())
+        h.update(str(nbasis).encode())
+        key = h.hexdigest()
+
+        self.basis = None
+        if (cache_file is not None) and os.path.isfile(cache_file):
+            try:
+                with np.load(cache_file) as data:
+                    if str(data['key']) == key:
+                        self.basis = data['basis']
+                        self.coords = data['coords']
+            except (OSError, ValueError, KeyError):
+                pass
+
+        if self.basis is None:
+            flux = archetype.flux
+            norm = np.linalg.norm(flux, axis=1)
+            norm[norm == 0] = 1.0
+            u, w, vt = np.linalg.svd(flux / norm[:,None], full_matrices=False)
+            self.basis = vt[:nbasis]
+            self.coords = flux.dot(self.basis.T)
+            if cache_file is not None:
+                tmp = "{}.tmp{}.npz".format(cache_file, os.getpid())
+                try:
+                    np.savez(tmp, key=key, basis=self.basis,
+                        coords=self.coords)
+                    os.replace(tmp, cache_file)
+                except OSError:
+                    if cache_file not in _index_write_warned:
+                        _index_write_warned.add(cache_file)
+                        print("WARNING: cannot write archetype index {}"\
+                            .format(cache_file))
+                        sys.stdout.flush()
+
+        self._interp = interp1d(archetype.wave, self.basis, axis=1,
+            fill_value='extrapolate', kind='linear')
+        return
+
+    @property
+    def nbasis(self):
+        return len(self.basis)
+
+    def candidates(self, spectra, weights, flux, wflux, dwave, z, legendre,
+        trans, ncandidates):
+        """Return the best candidate archetypes for a target and redshift.
+
+        Args:
+            spectra (list): list of Spectrum or NormalSpectrum objects.
+            weights (array): see calc_zchi2_archetypes.
+            flux (array): see calc_zchi2_archetypes.
+            wflux (array): see calc_zchi2_archetypes.
+            dwave (dict): the wavelength grids for each wavehash.
+            z (float): the redshift.
+            legendre (dict): the Legendre polynomials for each wavehash.
+            trans (dict): the Lyman transmission for each wavehash.
+            ncandidates (int): the number of candidates.
+
+        Returns:
+            array: the indices of the candidates, best first.
+
+        """
+        basis = { hs:trans[hs]*self._interp(wave/(1.+z)) \
+            for hs, wave in dwave.items() }
+        gbb, gbl, gll, yb, yl, fwf = _archetype_products(spectra, weights,
+            flux, wflux, basis, legendre, full=True)
+        P = self.coords
+        chi2, coeff = _solve_archetypes(np.einsum('ij,jk,ik->i', P, gbb, P),
+            P.dot(gbl), gll, P.dot(yb), yl, fwf)
+        return np.argsort(chi2)[:ncandidates]
+
+
+# The index cache files which could not be written by this process.
+_index_write_warned = set()
+
+
+def archetype_index_file(filename):
+    """Return the cache file of the ArchetypeIndex of an archetype file.
+
+    This is <base>-index.npz next to the archetype file, if it exists or the
+    directory is writable.  Otherwise it is in $RR_TEMPLATE_CACHE, if set.
+
+    Args:
+        filename (str): the archetype file.
+
+    Returns:
+        str: the path of the index cache file.
+
+    """
+    filename = os.path.expandvars(filename)
+    base = os.path.splitext(os.path.basename(filename))[0] + '-index.npz'
+    archdir = os.path.dirname(os.path.abspath(filename))
+    local = os.path.join(archdir, base)
+    if os.path.isfile(local) or os.access(archdir, os.W_OK):
+        return local
+    cache_dir = os.getenv('RR_TEMPLATE_CACHE')
+    if cache_dir is not None:
+        cache_dir = os.path.expandvars(cache_dir)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            return os.path.join(cache_dir, base)
+        except OSError:
+            pass
+    return local
+
+
 def find_archetypes(archetypes_dir=None):
     """Return list of rrarchetype-\*.fits archetype files
 
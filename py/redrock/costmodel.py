@@ -0,0 +1,301 @@
+"""
+Cost model used to balance targets and files among processes.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import json
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class CostModel(object):
+    """Predict the cost of fitting targets from their size.
+
+    The cost (in core-seconds) of fitting one target is modelled as
+
+        c_target + nz * (c_pix * npix + c_hash * nhash)
+
+    where npix is the number of pixels of the spectra of the target, masked
+    or not (see grid_size), nhash the number of wavelength grids of its
+    spectra and nz the total number of redshifts of all templates.  The cost of a job (one run of rrdesi,
+    e.g. on one spectra file) is the sum of its target costs plus c_job.
+
+    The coefficients are fitted to the measured run times of previous jobs
+    (see add_sample() and fit()) and are saved between runs by save().
+
+    Args:
+        coeff (array): (optional) the coefficients (c_job, c_target, c_pix,
+            c_hash).  Defaults to rough values for DESI coadds.
+        nz (int): (optional) the total redshift grid size of the templates
+            used when the templates are not known yet.
+        samples (list): (optional) the measured jobs, each a list of the
+            four job features followed by the measured cost.
+
+    """
+    #- c_job, c_target, c_pix, c_hash in core-seconds
+    default_coeff = (960.0, 1.0, 1.8e-7, 2.0e-5)
+    default_nz = 10000
+    max_samples = 500
+
+    def __init__(self, coeff=None, nz=None, samples=None):
+        if coeff is None:
+            coeff = self.default_coeff
+        if nz is None:
+            nz = self.default_nz
+        self.coeff = np.array(coeff, dtype=np.float64)
+        self.nz = int(nz)
+        self.samples = list()
+        if samples is not None:
+            self.samples = [ list(x) for x in samples ]
+
+    def features(self, npix, nhash, ntarget=1, njob=0, nz=None):
+        """Return the cost model features of targets.
+
+        Args:
+            npix (int): the total number of pixels.
+            nhash (int): the total number of wavehashes of the targets.
+            ntarget (int): the number of targets.
+            njob (int): the number of jobs.
+            nz (int): (optional) the total redshift grid size of the
+                templates.  Defaults to the last one seen by the model.
+
+        Returns:
+            array: the features (njob, ntarget, nz*npix, nz*nhash).
+
+        """
+        if nz is None:
+            nz = self.nz
+        return np.array([njob, ntarget, nz*npix, nz*nhash], dtype=np.float64)
+
+    def target_cost(self, npix, nhash, nz=None):
+        """Return the predicted cost of one target.
+        """
+        return float(self.coeff.dot(self.features(npix, nhash, nz=nz)))
+
+    def job_cost(self, sizes, nz=None):
+        """Return the predicted cost of a job.
+
+        Args:
+            sizes (list): the (npix, nhash) of each target of the job.
+            nz (int): (optional) the total redshift grid size.
+
+        Returns:
+            float: the cost in core-seconds.
+
+        """
+        sizes = np.asarray(list(sizes), dtype=np.float64).reshape(-1, 2)
+        f = self.features(np.sum(sizes[:,0]), np.sum(sizes[:,1]),
+            ntarget=len(sizes), njob=1, nz=nz)
+        return float(self.coeff.dot(f))
+
+    def add_sample(self, features, cost):
+        """Add one measured job.
+
+        Args:
+            features (array): the job features (see features()).
+            cost (float): the measured cost in core-seconds.
+
+        """
+        self.samples.append([ float(x) for x in features ] + [ float(cost) ])
+        self.samples = self.samples[-self.max_samples:]
+        return
+
+    def fit(self):
+        """Fit the coefficients to the measured jobs.
+
+        The relative error of the predicted costs is minimized with non
+        negative coefficients.  The coefficients are left unchanged until
+        there are at least twice as many jobs as coefficients.
+
+        Returns:
+            bool: True if the coefficients were updated.
+
+        """
+        from scipy.optimize import nnls
+        nfeat = len(self.coeff)
+        if len(self.samples) < 2 * nfeat:
+            return False
+        data = np.array(self.samples, dtype=np.float64)
+        data = data[data[:,nfeat] > 0]
+        if len(data) < 2 * nfeat:
+            return False
+        A = data[:,:nfeat] / data[:,nfeat:]
+        b = np.ones(len(data))
+        # Scale the columns so that they are of order unity.
+        scale = np.max(np.abs(A), axis=0)
+        scale[scale == 0] = 1.0
+        x, rnorm = nnls(A / scale, b)
+        coeff = x / scale
+        if not np.any(coeff > 0):
+            return False
+        self.coeff = coeff
+        return True
+
+    @classmethod
+    def load(cls, path=None):
+        """Load a cost model.
+
+        Args:
+            path (str): (optional) the cost model file.  Defaults to
+                $RR_COST_MODEL.  If there is no such file, the default
+                coefficients are used.
+
+        Returns:
+            CostModel: the cost model.
+
+        """
+        if path is None:
+            path = os.getenv('RR_COST_MODEL')
+        if (path is None) or (not os.path.isfile(path)):
+            return cls()
+        with open(path, 'r') as f:
+            state = json.load(f)
+        return cls(coeff=state['coeff'], nz=state['nz'],
+            samples=state['samples'])
+
+    def save(self, path=None):
+        """Save the cost model.
+
+        The model is written to a temporary file which is then renamed, so
+        that concurrent jobs never read a partial file.  Jobs measured by
+        other runs since this model was loaded are kept.
+
+        Args:
+            path (str): (optional) the cost model file.  Defaults to
+                $RR_COST_MODEL.  If None, nothing is written.
+
+        """
+        if path is None:
+            path = os.getenv('RR_COST_MODEL')
+        if path is None:
+            return
+        if os.path.isfile(path):
+            other = CostModel.load(path)
+            new = [ x for x in self.samples if x not in other.samples ]
+            self.samples = (other.samples + new)[-self.max_samples:]
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+        state = dict(coeff=self.coeff.tolist(), nz=self.nz,
+            samples=self.samples)
+        tmp = "{}.tmp{}".format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, path)
+        return
+
+
+@contextmanager
+def _locked(path):
+    """Hold an exclusive lock on the cost model file path.
+
+    The lock is taken on path.lock, so that concurrent jobs update the file
+    one at a time.  Without fcntl (not POSIX), nothing is locked.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    dirname = os.path.dirname(os.path.abspath(path))
+    os.makedirs(dirname, exist_ok=True)
+    with open(path + ".lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def grid_size(grids, coadd=False):
+    """Return the number of pixels and wavelength grids of a target.
+
+    This is the size of a target used to fit the cost model and to predict
+    costs.  All pixels are counted, masked or not, since the masks are not
+    known before the spectra are read.
+
+    Args:
+        grids (dict): the number of spectra of the target on each
+            (nwave, first, last) wavelength grid.
+        coadd (bool): if True, count one spectrum per wavelength grid, as
+            for the coadds.
+
+    Returns:
+        tuple: (npix, nhash).
+
+    """
+    if coadd:
+        npix = sum([ k[0] for k in grids.keys() ])
+    else:
+        npix = sum([ k[0] * n for k, n in grids.items() ])
+    return (int(npix), len(grids))
+
+
+def target_size(target):
+    """Return the number of pixels and wavelength grids of a target.
+
+    Args:
+        target (Target): the target.
+
+    Returns:
+        tuple: (npix, nhash), see grid_size.
+
+    """
+    grids = dict()
+    if target.collapsed:
+        spectra = [ (ns.wave, ns.nspec) for ns in target.normal ]
+    else:
+        spectra = [ (s.wave, 1) for s in target.spectra ]
+    for wave, n in spectra:
+        k = (len(wave), float(wave[0]), float(wave[-1]))
+        grids[k] = grids.get(k, 0) + n
+    return grid_size(grids)
+
+
+def record_job(targets, templates, seconds, nworker, path=None):
+    """Add the measured cost of a job to the saved cost model.
+
+    The features of all targets are summed over the communicator and the
+    model is refitted and saved by the rank 0 process, while holding a lock
+    on the file so that concurrent jobs do not lose each other's samples.
+    This should only be called for jobs which succeeded.  If the file
+    cannot be written, a warning is printed.
+
+    Args:
+        targets (DistTargets): the targets of the job.
+        templates (list): the list of DistTemplate objects.
+        seconds (float): the elapsed time of the job.
+        nworker (int): the total number of processes or threads of the job.
+        path (str): (optional) the cost model file.  Defaults to
+            $RR_COST_MODEL.  If None, nothing is recorded.
+
+    """
+    if path is None:
+        path = os.getenv('RR_COST_MODEL')
+    if path is None:
+        return
+    comm = targets.comm
+    size = np.zeros(2, dtype=np.float64)
+    for tg in targets.local():
+        size += target_size(tg)
+    if comm is not None:
+        size = comm.reduce(size, root=0)
+    if (comm is None) or (comm.rank == 0):
+        try:
+            with _locked(path):
+                model = CostModel.load(path)
+                model.nz = sum([ len(t.template.redshifts) \
+                    for t in templates ])
+                model.add_sample(model.features(size[0], size[1],
+                    ntarget=len(targets.all_target_ids), njob=1),
+                    seconds * nworker)
+                model.fit()
+                model.save(path)
+        except OSError as err:
+            print("WARNING: cannot update the cost model {}: {}".format(
+                path, err))
+            sys.stdout.flush()
+    return
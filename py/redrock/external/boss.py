@@ -28,12 +28,18 @@ from ..utils import elapsed, get_mp, distribute_work
 
 from ..targets import Spectrum, Target, DistTargetsCopy
 
-from ..templates import load_dist_templates
+from ..costmodel import CostModel
+
+from ..templates import load_dist_templates, parse_binning
 
 from ..results import write_zscan
 
 from ..zfind import zfind
 
+from ..zscan import HierarchicalScan
+
+from ..workers import create_pool, default_backend
+
 from .._version import __version__
 
 from ..archetypes import All_archetypes
@@ -303,9 +309,8 @@ def read_spectra(spplates_name, targetids=None, use_frames=False,
                         ## Integration method.
                         w = (la_spplate_edges[:-1]>la[i,0]) & (la_spplate_edges[1:]<la[i,-1])
                         w_edges = (la_spplate_edges>la[i,0]) & (la_spplate_edges<la[i,-1])
-                        fl_new[i,w] = trapz_rebin(la[i,:], fl[i,:], edges=la_spplate_edges[w_edges])
-                        iv_new[i,w] = trapz_rebin(la[i,:], iv[i,:], edges=la_spplate_edges[w_edges])
-                        wd_new[i,w] = trapz_rebin(la[i,:], wd[i,:], edges=la_spplate_edges[w_edges])
+                        fl_new[i,w], iv_new[i,w], wd_new[i,w] = trapz_rebin(la[i,:],
+                            np.array([fl[i,:], iv[i,:], wd[i,:]]), edges=la_spplate_edges[w_edges])
 
                     elif coadd_frames_interp=='ngp':
                         ## NGP method.
@@ -504,6 +509,15 @@ def rrboss(options=None, comm=None):
     parser.add_argument("--archetypes", type=str, default=None,
         required=False, help="archetype file or directory for final redshift comparisons")
 
+    parser.add_argument("--archetype-candidates", type=int, default=0,
+        required=False, help="only fit the best N archetypes of a cached "
+        "index of each archetype file (default all)")
+
+    parser.add_argument("--archetype-check", type=float, default=0.1,
+        required=False, help="with --archetype-candidates, the fraction of "
+        "the fits also done with all archetypes to report how often the "
+        "candidates miss the best one")
+
     parser.add_argument("-o", "--output", type=str, default=None,
         required=False, help="output file")
 
@@ -535,6 +549,10 @@ def rrboss(options=None, comm=None):
         required=False, help="if not using MPI, the number of multiprocessing"
             " processes to use (defaults to half of the hardware threads)")
 
+    parser.add_argument("--threads", type=int, default=0,
+        required=False, help="the number of threads used by each process "
+            "(with or without MPI) instead of multiprocessing")
+
     parser.add_argument("--use-frames", default=False, action="store_true",
         required=False, help="use individual spcframes instead of spplate "
         "(the spCFrame files are expected to be in the same directory as "
@@ -572,6 +590,34 @@ def rrboss(options=None, comm=None):
         required=False, help="temporary option to control interpolation method "
         "when coadding frames.")
 
+    parser.add_argument("--banded-scan", default=False, action="store_true",
+        required=False, help="use the precomputed banded normal equations "
+        "(R^T W R) of each target in the redshift scan; faster with several "
+        "exposures per target, not for coadds")
+
+    parser.add_argument("--scan-binning", type=str, default=None,
+        required=False, help="bin the spectra and templates of the redshift "
+        "scan by this number of pixels, either for all template types (e.g. "
+        "4) or per type (e.g. GALAXY:4,STAR:2); the best minima are refined "
+        "at full resolution")
+
+    parser.add_argument("--brent-ztol", type=float, default=None,
+        required=False, help="refine the chi2 minima with Brent's method to "
+        "this redshift tolerance instead of a fixed grid of 15 redshifts")
+
+    parser.add_argument("--zscan-step", type=int, default=0,
+        required=False, help="if > 1, first scan every N-th redshift and then "
+        "the full redshift grid only around the best minima")
+
+    parser.add_argument("--zscan-candidates", type=int, default=5,
+        required=False, help="with --zscan-step, the number of minima of the "
+        "first scan which are scanned on the full redshift grid")
+
+    parser.add_argument("--fft-scan", default=False, action="store_true",
+        required=False, help="scan the redshifts of templates without Lyman "
+        "absorption with FFT cross-correlations of the spectra on "
+        "log-lambda grids")
+
     parser.add_argument("--random-seed", type=int, default=0,
         required=False, help="seed for choosing random exposure")
 
@@ -634,7 +680,7 @@ def rrboss(options=None, comm=None):
 
     # Multiprocessing processes to use if MPI is disabled.
     mpprocs = 0
-    if comm is None:
+    if (comm is None) and (args.threads == 0):
         mpprocs = get_mp(args.mp)
         print("Running with {} processes".format(mpprocs))
         if "OMP_NUM_THREADS" in os.environ:
@@ -652,6 +698,8 @@ def rrboss(options=None, comm=None):
         sys.stdout.flush()
     elif comm_rank == 0:
         print("Running with {} processes".format(comm_size))
+        if args.threads > 0:
+            print("Using {} threads in each process".format(args.threads))
         #print("pre flush")
         sys.stdout.flush()
         #print("flushed")
@@ -694,7 +742,15 @@ def rrboss(options=None, comm=None):
 
         start = elapsed(None, "", comm=comm)
 
-        dtargets = DistTargetsCopy(targets, comm=comm, root=0)
+        # All processes must balance the targets with the same cost model.
+        cost_model = None
+        if comm_rank == 0:
+            cost_model = CostModel.load()
+        if comm is not None:
+            cost_model = comm.bcast(cost_model, root=0)
+
+        dtargets = DistTargetsCopy(targets, comm=comm, root=0,
+            cost_model=cost_model)
 
         # Get the dictionary of wavelength grids
         dwave = dtargets.wavegrids()
@@ -710,7 +766,8 @@ def rrboss(options=None, comm=None):
         #print('checkpoint: start load_dist_templates')
         #sys.stdout.flush()
         dtemplates = load_dist_templates(dwave, templates=args.templates,
-            comm=comm, mp_procs=mpprocs)
+            comm=comm, mp_procs=mpprocs, nthreads=(args.threads or None),
+            binning=parse_binning(args.scan_binning))
         #print('checkpoint: enc load_dist_templates')
         #sys.stdout.flush()
 
@@ -719,9 +776,27 @@ def rrboss(options=None, comm=None):
 
         start = elapsed(None, "", comm=comm)
 
-        scandata, zfit = zfind(dtargets, dtemplates, mpprocs,
-            nminima=args.nminima, archetypes=args.archetypes,
-            priors=args.priors, chi2_scan=args.chi2_scan)
+        hierarchy = None
+        if args.zscan_step > 1:
+            hierarchy = HierarchicalScan(step=args.zscan_step,
+                ncandidates=max(args.zscan_candidates, args.nminima))
+
+        # Start the workers of the local targets once for both the redshift
+        # scan and the fitting of all templates.
+
+        with create_pool(default_backend(comm, mpprocs, args.threads),
+            max(mpprocs, args.threads), dtargets, dtemplates) as pool:
+            scandata, zfit = zfind(dtargets, dtemplates, mpprocs,
+                nminima=args.nminima, archetypes=args.archetypes,
+                priors=args.priors, chi2_scan=args.chi2_scan,
+                banded=args.banded_scan, pool=pool, hierarchy=hierarchy,
+                fft=args.fft_scan, ztol=args.brent_ztol,
+                archetype_candidates=args.archetype_candidates,
+                archetype_check=args.archetype_check)
+
+        # Free the node-local shared memory of the templates
+        for t in dtemplates:
+            t.close()
 
         stop = elapsed(start, "Computing redshifts took", comm=comm)
 
@@ -25,12 +25,18 @@ from ..utils import elapsed, get_mp, distribute_work
 
 from ..targets import (Spectrum, Target, DistTargets)
 
-from ..templates import load_dist_templates
+from ..costmodel import CostModel, grid_size, record_job
+
+from ..templates import load_dist_templates, parse_binning
 
 from ..results import write_zscan
 
 from ..zfind import zfind
 
+from ..zscan import HierarchicalScan
+
+from ..workers import create_pool, default_backend
+
 from .._version import __version__
 
 from ..archetypes import All_archetypes
@@ -65,6 +71,55 @@ def write_zbest(outfile, zbest, fibermap, template_version, archetype_version):
     return
 
 
+def target_grids(wave, targetids, grids=None):
+    """Count the spectra of each target on each wavelength grid of a file.
+
+    This only uses the wavelength grids and the fibermap of the file, so
+    that the sizes of the targets (see target_sizes) are known before the
+    spectra are read.
+
+    Args:
+        wave (dict): the wavelength array of each band of the file.
+        targetids (array): the TARGETID of each selected row.
+        grids (dict): (optional) the counts of other files, which are
+            updated.
+
+    Returns:
+        dict: for each target ID, a dictionary of the number of spectra on
+            each (nwave, first, last) wavelength grid.
+
+    """
+    if grids is None:
+        grids = dict()
+    keys = [ (len(w), float(w[0]), float(w[-1])) \
+        for band, w in sorted(wave.items()) ]
+    utargets, nspec = np.unique(np.asarray(targetids), return_counts=True)
+    for t, n in zip(utargets, nspec):
+        tg = grids.setdefault(t, dict())
+        for k in keys:
+            tg[k] = tg.get(k, 0) + int(n)
+    return grids
+
+
+def target_sizes(grids, coadd=True):
+    """Return the number of pixels and wavelength grids of each target.
+
+    These are the inputs of the cost model (see
+    redrock.costmodel.grid_size).  A wavelength grid which appears in
+    several files is counted once.
+
+    Args:
+        grids (dict): the output of target_grids().
+        coadd (bool): if True, count the pixels of the coadds, which have one
+            spectrum per wavelength grid.
+
+    Returns:
+        dict: the (npix, nhash) of each target ID.
+
+    """
+    return { t:grid_size(tg, coadd=coadd) for t, tg in grids.items() }
+
+
 class DistTargetsDESI(DistTargets):
     """Distributed targets for DESI.
 
@@ -91,11 +146,15 @@ class DistTargetsDESI(DistTargets):
         cache_Rcsr: pre-calculate and cache sparse CSR format of resolution
             matrix R
         cosmics_nsig (float): cosmic rejection threshold used in coaddition
+        cost_model (CostModel): (optional) the model of the cost of each
+            target used to balance the targets among processes.  Defaults
+            to the built-in coefficients.
     """
 
     ### @profile
     def __init__(self, spectrafiles, coadd=True, targetids=None,
-                 first_target=None, n_target=None, comm=None, cache_Rcsr=False, cosmics_nsig=0):
+                 first_target=None, n_target=None, comm=None, cache_Rcsr=False, cosmics_nsig=0,
+                 cost_model=None):
 
         comm_size = 1
         comm_rank = 0
@@ -130,6 +189,10 @@ class DistTargetsDESI(DistTargets):
 
         self._alltargetids = set()
 
+        # The number of good pixels and wavelength grids of each target.
+
+        self._target_grids = dict()
+
         # The fibermaps from all files
 
         self._fmaps = {}
@@ -240,24 +303,25 @@ class DistTargetsDESI(DistTargets):
                 self._bands[sfile] = comm.bcast(self._bands[sfile], root=0)
                 self._wave[sfile] = comm.bcast(self._wave[sfile], root=0)
 
+            target_grids(self._wave[sfile], self._fmaps[sfile]["TARGETID"],
+                grids=self._target_grids)
+
             if comm_rank == 0:
                 hdus.close()
 
         self._keep_targets = list(sorted(self._alltargetids))
+        self._target_sizes = target_sizes(self._target_grids, coadd=coadd)
 
         # Now we have the metadata for all targets in all files.  Distribute
-        # the targets among process weighted by the amount of work to do for
-        # each target.  This weight is either "1" if we are going to use coadds
-        # or the number of spectra if we are using all the data.
-
-        tweights = None
-        if not coadd:
-            tweights = dict()
-            for t in self._keep_targets:
-                tweights[t] = 0
-                for sfile in spectrafiles:
-                    if t in self._target_specs[sfile]:
-                        tweights[t] += len(self._target_specs[sfile][t])
+        # the targets among process weighted by the predicted cost of each
+        # target, which depends on its number of pixels and wavelength
+        # grids.
+
+        if cost_model is None:
+            cost_model = CostModel()
+        tweights = dict()
+        for t in self._keep_targets:
+            tweights[t] = cost_model.target_cost(*self._target_sizes[t])
 
         self._proc_targets = distribute_work(comm_size,
             self._keep_targets, weights=tweights)
@@ -394,7 +458,7 @@ class DistTargetsDESI(DistTargets):
                             self._my_data[toff].spectra[tspec_res[t]].R = dia
                             #- Coadds replace Rcsr so only compute if not coadding
                             if not coadd and cache_Rcsr:
-                                self._my_data[toff].spectra[tspec_res[t]].Rcsr = dia.tocsr()
+                                self._my_data[toff].spectra[tspec_res[t]]._Rcsr = dia.tocsr()
                             tspec_res[t] += 1
                     toff += 1
 
@@ -445,6 +509,15 @@ def rrdesi(options=None, comm=None):
     parser.add_argument("--archetypes", type=str, default=None,
         required=False, help="archetype file or directory for final redshift comparison")
 
+    parser.add_argument("--archetype-candidates", type=int, default=0,
+        required=False, help="only fit the best N archetypes of a cached "
+        "index of each archetype file (default all)")
+
+    parser.add_argument("--archetype-check", type=float, default=0.1,
+        required=False, help="with --archetype-candidates, the fraction of "
+        "the fits also done with all archetypes to report how often the "
+        "candidates miss the best one")
+
     parser.add_argument("-o", "--output", type=str, default=None,
         required=False, help="output file")
 
@@ -472,6 +545,11 @@ def rrdesi(options=None, comm=None):
     parser.add_argument("--allspec", default=False, action="store_true",
         required=False, help="use individual spectra instead of coadd")
 
+    parser.add_argument("--collapse-allspec", default=False,
+        action="store_true", required=False, help="with --allspec, sum the "
+        "normal equations of the individual spectra of each target; this is "
+        "exact and as fast as using the coadd")
+
     parser.add_argument("--ncpu", type=int, default=None,
         required=False, help="DEPRECATED: the number of multiprocessing"
             " processes; use --mp instead")
@@ -480,6 +558,10 @@ def rrdesi(options=None, comm=None):
         required=False, help="if not using MPI, the number of multiprocessing"
             " processes to use (defaults to half of the hardware threads)")
 
+    parser.add_argument("--threads", type=int, default=0,
+        required=False, help="the number of threads used by each process "
+            "(with or without MPI) instead of multiprocessing")
+
     parser.add_argument("--no-skymask", default=False, action="store_true",
         required=False, help="Do not do extra masking of sky lines")
 
@@ -490,9 +572,37 @@ def rrdesi(options=None, comm=None):
         required=False, help="debug with ipython (only if communicator has a "
         "single process)")
 
+    parser.add_argument("--banded-scan", default=False, action="store_true",
+        required=False, help="use the precomputed banded normal equations "
+        "(R^T W R) of each target in the redshift scan; faster with several "
+        "exposures per target, not for coadds")
+
+    parser.add_argument("--scan-binning", type=str, default=None,
+        required=False, help="bin the spectra and templates of the redshift "
+        "scan by this number of pixels, either for all template types (e.g. "
+        "4) or per type (e.g. GALAXY:4,STAR:2); the best minima are refined "
+        "at full resolution")
+
+    parser.add_argument("--brent-ztol", type=float, default=None,
+        required=False, help="refine the chi2 minima with Brent's method to "
+        "this redshift tolerance instead of a fixed grid of 15 redshifts")
+
+    parser.add_argument("--zscan-step", type=int, default=0,
+        required=False, help="if > 1, first scan every N-th redshift and then "
+        "the full redshift grid only around the best minima")
+
+    parser.add_argument("--zscan-candidates", type=int, default=5,
+        required=False, help="with --zscan-step, the number of minima of the "
+        "first scan which are scanned on the full redshift grid")
+
     parser.add_argument("--cosmics-nsig", type=float, default=0,
         required=False, help="n sigma cosmic ray threshold in coaddition")
 
+    parser.add_argument("--cost-model", type=str, default=None,
+        required=False, help="file of the model of the cost of each target, "
+        "used to balance the targets and updated with the run time of this "
+        "job (defaults to $RR_COST_MODEL)")
+
     parser.add_argument("infiles", nargs='*')
 
     args = None
@@ -539,6 +649,14 @@ def rrdesi(options=None, comm=None):
             else:
                 sys.exit(1)
 
+        if args.collapse_allspec and not args.allspec:
+            print("ERROR: --collapse-allspec requires --allspec")
+            sys.stdout.flush()
+            if comm is not None:
+                comm.Abort()
+            else:
+                sys.exit(1)
+
         if (args.targetids is not None) and ((args.mintarget is not None) \
             or (args.ntargets is not None)):
             print("ERROR: cannot select targets by both ID and range")
@@ -564,7 +682,7 @@ def rrdesi(options=None, comm=None):
 
     # Multiprocessing processes to use if MPI is disabled.
     mpprocs = 0
-    if comm is None:
+    if (comm is None) and (args.threads == 0):
         mpprocs = get_mp(args.mp)
         print("Running with {} processes".format(mpprocs))
         if "OMP_NUM_THREADS" in os.environ:
@@ -582,6 +700,8 @@ def rrdesi(options=None, comm=None):
         sys.stdout.flush()
     elif comm_rank == 0:
         print("Running with {} processes".format(comm_size))
+        if args.threads > 0:
+            print("Using {} threads in each process".format(args.threads))
         sys.stdout.flush()
 
     try:
@@ -594,9 +714,18 @@ def rrdesi(options=None, comm=None):
 
         # Load the targets.  If comm is None, then the target data will be
         # stored in shared memory.
+        # All processes must balance the targets with the same cost model,
+        # even if another job updates it meanwhile.
+        cost_model = None
+        if comm_rank == 0:
+            cost_model = CostModel.load(args.cost_model)
+        if comm is not None:
+            cost_model = comm.bcast(cost_model, root=0)
+
         targets = DistTargetsDESI(args.infiles, coadd=(not args.allspec),
                                   targetids=targetids, first_target=first_target, n_target=n_target,
-                                  comm=comm, cache_Rcsr=True, cosmics_nsig=args.cosmics_nsig)
+                                  comm=comm, cache_Rcsr=True, cosmics_nsig=args.cosmics_nsig,
+                                  cost_model=cost_model)
 
         #- Mask some problematic sky lines
         if not args.no_skymask:
@@ -606,6 +735,10 @@ def rrdesi(options=None, comm=None):
                     ii |= (9792. <= s.wave) & (s.wave <= 9795.)
                     s.ivar[ii] = 0.0
 
+        #- Replace the individual spectra by their normal equations
+        if args.collapse_allspec:
+            targets.collapse()
+
         # Get the dictionary of wavelength grids
         dwave = targets.wavegrids()
 
@@ -615,16 +748,35 @@ def rrdesi(options=None, comm=None):
         # Read the template data
 
         dtemplates = load_dist_templates(dwave, templates=args.templates,
-            comm=comm, mp_procs=mpprocs)
+            comm=comm, mp_procs=mpprocs, nthreads=(args.threads or None),
+            binning=parse_binning(args.scan_binning))
 
         # Compute the redshifts, including both the coarse scan and the
         # refinement.  This function only returns data on the rank 0 process.
 
         start = elapsed(None, "", comm=comm)
 
-        scandata, zfit = zfind(targets, dtemplates, mpprocs,
-            nminima=args.nminima, archetypes=args.archetypes,
-            priors=args.priors, chi2_scan=args.chi2_scan)
+        hierarchy = None
+        if args.zscan_step > 1:
+            hierarchy = HierarchicalScan(step=args.zscan_step,
+                ncandidates=max(args.zscan_candidates, args.nminima))
+
+        # Start the workers of the local targets once for both the redshift
+        # scan and the fitting of all templates.
+
+        with create_pool(default_backend(comm, mpprocs, args.threads),
+            max(mpprocs, args.threads), targets, dtemplates) as pool:
+            scandata, zfit = zfind(targets, dtemplates, mpprocs,
+                nminima=args.nminima, archetypes=args.archetypes,
+                priors=args.priors, chi2_scan=args.chi2_scan,
+                banded=args.banded_scan, pool=pool, hierarchy=hierarchy,
+                ztol=args.brent_ztol,
+                archetype_candidates=args.archetype_candidates,
+                archetype_check=args.archetype_check)
+
+        # Free the node-local shared memory of the templates
+        for t in dtemplates:
+            t.close()
 
         stop = elapsed(start, "Computing redshifts took", comm=comm)
 
@@ -658,6 +810,15 @@ def rrdesi(options=None, comm=None):
 
             stop = elapsed(start, "Writing zbest data took", comm=comm)
 
+        global_stop = elapsed(global_start, "Total run time", comm=comm)
+
+        # Update the cost model with the measured cost of this job, unless it
+        # was run for debugging.
+        if not args.debug:
+            record_job(targets, dtemplates, global_stop - global_start,
+                comm_size * max(1, mpprocs, args.threads),
+                path=args.cost_model)
+
     except Exception as err:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
@@ -670,8 +831,6 @@ def rrdesi(options=None, comm=None):
         else:
             comm.Abort()
 
-    global_stop = elapsed(global_start, "Total run time", comm=comm)
-
     if args.debug:
         import IPython
         IPython.embed()
@@ -9,17 +9,18 @@ from __future__ import absolute_import, division, print_function
 
 import numpy as np
 import scipy.constants
+import scipy.optimize
 import scipy.special
 
 from . import constants
 
-from .rebin import rebin_template
+from .zscan import calc_zchi2_batch, calc_zchi2_normal, spectral_data
 
-from .zscan import calc_zchi2_one, spectral_data
+from .targets import NormalSpectrum
 
-from .zwarning import ZWarningMask as ZW
+from .templates import rebin_template_lyman
 
-from .utils import transmission_Lyman
+from .zwarning import ZWarningMask as ZW
 
 def get_dv(z, zref):
     """Returns velocity difference in km/s for two redshifts
@@ -107,9 +108,197 @@ def minfit(x, y):
     return (x0, xerr, y0, zwarn)
 
 
-def fitz(zchi2, redshifts, spectra, template, nminima=3, archetype=None):
+def minfit_batch(x, y):
+    """Fits y = y0 + ((x-x0)/xerr)**2 to many sets of 3 points.
+
+    This is the vectorized version of minfit() for the parabola through
+    each set of 3 points.
+
+    Args:
+        x (array): (n, 3) x values.
+        y (array): (n, 3) y values.
+
+    Returns:
+        (tuple):  (x0, xerr, y0, zwarn) arrays, where zwarn=0 is a good fit.
+
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    x0 = -np.ones(n)
+    xerr = -np.ones(n)
+    y0 = -np.ones(n)
+    zwarn = np.zeros(n, dtype=int)
+
+    #- y = a (x-x1)^2 + b (x-x1) + y1 relative to the middle point
+    d01 = (y[:,1] - y[:,0]) / (x[:,1] - x[:,0])
+    d12 = (y[:,2] - y[:,1]) / (x[:,2] - x[:,1])
+    a = (d12 - d01) / (x[:,2] - x[:,0])
+    b = d01 + a * (x[:,1] - x[:,0])
+
+    bad = ~np.isfinite(a) | ~np.isfinite(b) | (a == 0.0)
+    zwarn[bad] |= ZW.BAD_MINFIT
+    ok = ~bad
+    a, b = a[ok], b[ok]
+    x0[ok] = x[ok,1] - b / (2*a)
+    y0[ok] = y[ok,1] - b**2 / (4*a)
+    xerr[ok] = 1 / np.sqrt(np.abs(a))
+
+    badfit = (x0[ok] <= np.min(x[ok], axis=1)) | \
+        (np.max(x[ok], axis=1) <= x0[ok]) | (y0[ok] <= 0.) | (a < 0.)
+    zwarn[np.flatnonzero(ok)[badfit]] |= ZW.BAD_MINFIT
+
+    return (x0, xerr, y0, zwarn)
+
+
+def fit_redshifts(spectra, template, redshifts, dwave=None, data=None):
+    """Fit a template to the spectra of a target at many redshifts at once.
+
+    The template is rebinned at all redshifts with one call per wavelength
+    grid, and the normal equations of all redshifts are solved together.
+
+    Args:
+        spectra (list): list of Spectrum objects, or the list of
+            NormalSpectrum objects of a collapsed target.
+        template (Template): the template.
+        redshifts (array): the redshifts.
+        dwave (dict): (optional) the wavelength grids of the spectra.
+        data (tuple): (optional) the (weights, flux, wflux) of the spectra
+            (see spectral_data), if already computed.
+
+    Returns:
+        tuple: (zchi2, zcoeff) arrays of chi^2 and coefficients for every
+            redshift.
+
+    """
+    if dwave is None:
+        dwave = { s.wavehash:s.wave for s in spectra }
+    tdata = rebin_template_lyman(template, dwave, redshifts)
+    if isinstance(spectra[0], NormalSpectrum):
+        return calc_zchi2_normal(spectra, tdata)
+    if data is None:
+        data = spectral_data(spectra)
+    (weights, flux, wflux) = data
+    return calc_zchi2_batch(spectra, weights, flux, wflux, tdata)
+
+
+#- Number of zz diagnostics stored per minimum
+_nfine = 15
+
+
+def _refine_grid(zchi2, redshifts, candidates, spectra, template, dwave,
+    data, nfine=_nfine):
+    """Refine minima of the redshift scan on fixed fine grids.
+
+    The chi2 are sampled at nfine redshifts between the neighbours of each
+    minimum, and a parabola is fitted to the 3 points around the best one.
+    All minima are evaluated with one call of fit_redshifts(), and the
+    parabola minima with a second one.
+
+    Returns:
+        list: (zmin, sigma, chi2min, zwarn, coeff, zz, zzchi2) for each
+            minimum.  coeff is None if the template cannot be rebinned at
+            the parabola minima.
+
+    """
+    zz = np.array([ np.linspace(redshifts[max(0, imin-1)],
+        redshifts[min(imin+1, len(zchi2)-1)], nfine) \
+        for imin in candidates ])
+    zzchi2, zzcoeff = fit_redshifts(spectra, template, zz.ravel(),
+        dwave=dwave, data=data)
+    zzchi2 = zzchi2.reshape(zz.shape)
+
+    #- fit parabola to 3 points around minimum
+    ii = np.clip(np.argmin(zzchi2, axis=1), 1, nfine-2)
+    jj = ii[:,None] + np.arange(-1, 2)[None,:]
+    kk = np.arange(len(candidates))[:,None]
+    zmin, sigma, chi2min, zwarn = minfit_batch(zz[kk,jj], zzchi2[kk,jj])
+
+    #- coefficients at the parabola minima
+    try:
+        coeff = fit_redshifts(spectra, template, zmin, dwave=dwave,
+            data=data)[1]
+    except ValueError:
+        coeff = [ None for c in candidates ]
+
+    return [ (zmin[c], sigma[c], chi2min[c], zwarn[c], coeff[c], zz[c],
+        zzchi2[c]) for c in range(len(candidates)) ]
+
+
+def _refine_brent(zchi2, redshifts, imin, spectra, template, dwave, data,
+    ztol, nfine=_nfine, maxiter=20):
+    """Refine one minimum of the redshift scan with Brent's method.
+
+    The coarse minimum must be bracketed by its neighbours.  The chi2 is
+    minimized between them with bounded Brent iterations until the redshift
+    is known to ztol, and a parabola is fitted to the best evaluation and
+    its neighbours on each side.  The evaluated redshifts are returned as
+    the zz diagnostics, in increasing order; if there are more than nfine
+    of them, only the nfine closest to the best one are kept.
+
+    Returns:
+        tuple: (zmin, sigma, chi2min, zwarn, coeff, zz, zzchi2) as for
+            _refine_grid(), or None if the minimum is not bracketed.
+
+    """
+    if (imin == 0) or (imin == len(zchi2) - 1):
+        return None
+    if not ((zchi2[imin] < zchi2[imin-1]) and (zchi2[imin] < zchi2[imin+1])):
+        return None
+
+    evals = dict()
+    def _chi2(z):
+        chi2, coeff = fit_redshifts(spectra, template, [z], dwave=dwave,
+            data=data)
+        evals[float(z)] = (chi2[0], coeff[0])
+        return chi2[0]
+
+    try:
+        scipy.optimize.minimize_scalar(_chi2,
+            bounds=(redshifts[imin-1], redshifts[imin+1]), method='bounded',
+            options=dict(xatol=ztol, maxiter=maxiter))
+    except ValueError:
+        return None
+
+    zz = np.array(sorted(evals.keys()))
+    zzchi2 = np.array([ evals[z][0] for z in zz ])
+    i = np.argmin(zzchi2)
+    if (i == 0) or (i == len(zz) - 1):
+        return None
+    zmin, sigma, chi2min, zwarn = minfit(zz[i-1:i+2], zzchi2[i-1:i+2])
+
+    coeff = None
+    if zmin in evals:
+        coeff = evals[zmin][1]
+    else:
+        try:
+            coeff = fit_redshifts(spectra, template, [zmin], dwave=dwave,
+                data=data)[1][0]
+        except ValueError:
+            pass
+
+    #- keep nfine diagnostics: the evaluations closest to the best one
+    if len(zz) > nfine:
+        keep = np.sort(np.argsort(np.abs(zz - zz[i]))[:nfine])
+        zz, zzchi2 = zz[keep], zzchi2[keep]
+
+    return (zmin, sigma, chi2min, zwarn, coeff, zz, zzchi2)
+
+
+def fitz(zchi2, redshifts, spectra, template, nminima=3, archetype=None,
+    ztol=None, archetype_stats=None):
     """Refines redshift measurement around up to nminima minima.
 
+    By default the chi2 is sampled on a fixed fine grid around each minimum;
+    the grids of all minima, and then the parabola minima, are evaluated with
+    one batched call each (see fit_redshifts).  If ztol is given, each
+    minimum is instead bracketed by its neighbours of the scan and refined
+    with Brent's method to that redshift tolerance, which needs a few times
+    fewer chi2 evaluations.  z then agrees with the fixed grid refinement to
+    about ztol, and zerr comes from a parabola through the best evaluation
+    and its closest neighbours.  Minima which are not bracketed (e.g. at
+    the edges of the redshift range) use the fixed grid.
+
     TODO:
         if there are fewer than nminima minima, consider padding.
 
@@ -117,9 +306,14 @@ def fitz(zchi2, redshifts, spectra, template, nminima=3, archetype=None):
         zchi2 (array): chi^2 values for each redshift.
         redshifts (array): the redshift values.
         spectra (list): list of Spectrum objects at different wavelengths
-            grids.
+            grids, or the list of NormalSpectrum objects of a collapsed
+            target.
         template (Template): the template for this fit.
         nminima (int): the number of minima to consider.
+        ztol (float): (optional) the redshift tolerance of the Brent
+            refinement.  Default is the fixed grid refinement.
+        archetype_stats (array): (optional) the statistics of the archetype
+            candidate pre-selection (see Archetype.get_best_archetype).
 
     Returns:
         Table: the fit parameters for the minima.
@@ -127,8 +321,6 @@ def fitz(zchi2, redshifts, spectra, template, nminima=3, archetype=None):
     """
     assert len(zchi2) == len(redshifts)
 
-    nbasis = template.nbasis
-
     # Build dictionary of wavelength grids
     dwave = { s.wavehash:s.wave for s in spectra }
 
@@ -140,94 +332,118 @@ def fitz(zchi2, redshifts, spectra, template, nminima=3, archetype=None):
         wave_max = wave.max()
         legendre = { hs:np.array([scipy.special.legendre(i)( (w-wave_min)/(wave_max-wave_min)*2.-1. ) for i in range(deg_legendre)]) for hs, w in dwave.items() }
 
-    (weights, flux, wflux) = spectral_data(spectra)
+    data = spectral_data(spectra)
+    (weights, flux, wflux) = data
 
     results = list()
 
-    for imin in find_minima(zchi2):
-        if len(results) == nminima:
+    minima = list(find_minima(zchi2))
+
+    while (len(minima) > 0) and (len(results) < nminima):
+
+        #- Select the next minima still needed, and refine them together.
+        candidates = list()
+        while (len(minima) > 0) and \
+            (len(candidates) < nminima - len(results)):
+            imin = minima[0]
+            #- The remaining redshifts were skipped by a hierarchical scan
+            #- or had a singular fit
+            if zchi2[imin] >= 9e99:
+                if len(results) > 0:
+                    minima = list()
+                    break
+                if len(candidates) > 0:
+                    break
+            minima.pop(0)
+            #- Skip this minimum if it is within constants.max_velo_diff km/s
+            #- of a previous one dv is in km/s
+            zprev = np.array([tmp['z'] for tmp in results])
+            dv = get_dv(z=redshifts[imin],zref=zprev)
+            if np.any(np.abs(dv) < constants.max_velo_diff):
+                continue
+            candidates.append(imin)
+        if len(candidates) == 0:
             break
 
-        #- Skip this minimum if it is within constants.max_velo_diff km/s of a
-        # previous one dv is in km/s
-        zprev = np.array([tmp['z'] for tmp in results])
-        dv = get_dv(z=redshifts[imin],zref=zprev)
-        if np.any(np.abs(dv) < constants.max_velo_diff):
-            continue
-
-        #- Sample more finely around the minimum
-        ilo = max(0, imin-1)
-        ihi = min(imin+1, len(zchi2)-1)
-        zz = np.linspace(redshifts[ilo], redshifts[ihi], 15)
-        nz = len(zz)
-
-        zzchi2 = np.zeros(nz, dtype=np.float64)
-        zzcoeff = np.zeros((nz, nbasis), dtype=np.float64)
-
-        for i, z in enumerate(zz):
-            binned = rebin_template(template, z, dwave)
-            for k in list(dwave.keys()):
-                T = transmission_Lyman(z,dwave[k])
-                for vect in range(binned[k].shape[1]):
-                    binned[k][:,vect] *= T
-            zzchi2[i], zzcoeff[i] = calc_zchi2_one(spectra, weights, flux,
-                wflux, binned)
-
-        #- fit parabola to 3 points around minimum
-        i = min(max(np.argmin(zzchi2),1), len(zz)-2)
-        zmin, sigma, chi2min, zwarn = minfit(zz[i-1:i+2], zzchi2[i-1:i+2])
-
-        try:
-            binned = rebin_template(template, zmin, dwave)
-            for k in list(dwave.keys()):
-                T = transmission_Lyman(zmin,dwave[k])
-                for vect in range(binned[k].shape[1]):
-                    binned[k][:,vect] *= T
-            coeff = calc_zchi2_one(spectra, weights, flux, wflux,
-                binned)[1]
-        except ValueError as err:
-            if zmin<redshifts[0] or redshifts[-1]<zmin:
-                #- beyond redshift range can be invalid for template
-                coeff = np.zeros(template.nbasis)
+        refined = dict()
+        if ztol is not None:
+            for c, imin in enumerate(candidates):
+                res = _refine_brent(zchi2, redshifts, imin, spectra,
+                    template, dwave, data, ztol)
+                if res is not None:
+                    refined[c] = res
+        grid = [ c for c in range(len(candidates)) if c not in refined ]
+        if len(grid) > 0:
+            res = _refine_grid(zchi2, redshifts,
+                [ candidates[c] for c in grid ], spectra, template, dwave,
+                data)
+            refined.update(zip(grid, res))
+
+        for c, imin in enumerate(candidates):
+            if len(results) == nminima:
+                break
+
+            zprev = np.array([tmp['z'] for tmp in results])
+            dv = get_dv(z=redshifts[imin],zref=zprev)
+            if np.any(np.abs(dv) < constants.max_velo_diff):
+                continue
+
+            zmin, sigma, chi2min, zwarn, coeff, zz, zzchi2 = refined[c]
+
+            if coeff is None:
+                try:
+                    coeff = fit_redshifts(spectra, template, [zmin],
+                        dwave=dwave, data=data)[1][0]
+                except ValueError as err:
+                    if zmin<redshifts[0] or redshifts[-1]<zmin:
+                        #- beyond redshift range can be invalid for template
+                        coeff = np.zeros(template.nbasis)
+                        zwarn |= ZW.Z_FITLIMIT
+                        zwarn |= ZW.BAD_MINFIT
+                    else:
+                        #- Unknown problem; re-raise error
+                        raise err
+
+            zbest = zmin
+            zerr = sigma
+
+            #- Initial minimum or best fit too close to edge of redshift range
+            if zbest < redshifts[1] or zbest > redshifts[-2]:
                 zwarn |= ZW.Z_FITLIMIT
+            if zmin < redshifts[1] or zmin > redshifts[-2]:
+                zwarn |= ZW.Z_FITLIMIT
+
+            #- parabola minimum outside fit range; replace with min of scan
+            if zbest < np.min(zz) or zbest > np.max(zz):
                 zwarn |= ZW.BAD_MINFIT
+                i = np.argmin(zzchi2)
+                zbest = zz[i]
+                chi2min = zzchi2[i]
+
+            #- Skip this better defined minimum if it is within
+            #- constants.max_velo_diff km/s of a previous one
+            zprev = np.array([tmp['z'] for tmp in results])
+            dv = get_dv(z=zbest, zref=zprev)
+            if np.any(np.abs(dv) < constants.max_velo_diff):
+                continue
+
+            #- The Table needs the same number of zz for all minima; pad the
+            #- (fewer) Brent evaluations with NaN
+            npad = _nfine - len(zz)
+            if npad > 0:
+                zz = np.append(zz, np.full(npad, np.nan))
+                zzchi2 = np.append(zzchi2, np.full(npad, np.nan))
+
+            if archetype is None:
+                results.append(dict(z=zbest, zerr=zerr, zwarn=zwarn,
+                    chi2=chi2min, zz=zz, zzchi2=zzchi2,
+                    coeff=coeff))
             else:
-                #- Unknown problem; re-raise error
-                raise err
-
-        zbest = zmin
-        zerr = sigma
-
-        #- Initial minimum or best fit too close to edge of redshift range
-        if zbest < redshifts[1] or zbest > redshifts[-2]:
-            zwarn |= ZW.Z_FITLIMIT
-        if zmin < redshifts[1] or zmin > redshifts[-2]:
-            zwarn |= ZW.Z_FITLIMIT
-
-        #- parabola minimum outside fit range; replace with min of scan
-        if zbest < zz[0] or zbest > zz[-1]:
-            zwarn |= ZW.BAD_MINFIT
-            imin = np.where(zbest == np.min(zbest))[0][0]
-            zbest = zz[imin]
-            chi2min = zzchi2[imin]
-
-        #- Skip this better defined minimum if it is within
-        #- constants.max_velo_diff km/s of a previous one
-        zprev = np.array([tmp['z'] for tmp in results])
-        dv = get_dv(z=zbest, zref=zprev)
-        if np.any(np.abs(dv) < constants.max_velo_diff):
-            continue
-
-        if archetype is None:
-            results.append(dict(z=zbest, zerr=zerr, zwarn=zwarn,
-                chi2=chi2min, zz=zz, zzchi2=zzchi2,
-                coeff=coeff))
-        else:
-            chi2min, coeff, fulltype = archetype.get_best_archetype(spectra,weights,flux,wflux,dwave,zbest,legendre)
-
-            results.append(dict(z=zbest, zerr=zerr, zwarn=zwarn,
-                chi2=chi2min, zz=zz, zzchi2=zzchi2,
-                coeff=coeff, fulltype=fulltype))
+                chi2min, coeff, fulltype = archetype.get_best_archetype(spectra,weights,flux,wflux,dwave,zbest,legendre,stats=archetype_stats)
+
+                results.append(dict(z=zbest, zerr=zerr, zwarn=zwarn,
+                    chi2=chi2min, zz=zz, zzchi2=zzchi2,
+                    coeff=coeff, fulltype=fulltype))
 
     #- Sort results by chi2min; detailed fits may have changed order
     ii = np.argsort([tmp['chi2'] for tmp in results])
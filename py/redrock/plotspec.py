@@ -125,10 +125,12 @@ class PlotSpec(object):
         for spectype, fmt in [('STAR', 'k-'), ('GALAXY', 'b-'), ('QSO', 'g-')]:
             if spectype in self.zscan[target.id]:
                 zx = self.zscan[target.id][spectype]
-                self._ax1.plot(zx['redshifts'], zx['zchi2'], fmt, alpha=0.2,
-                    label='_none_')
-                self._ax1.plot(zx['redshifts'], zx['zchi2']+zx['penalty'], fmt,
-                    label=spectype)
+                #- skip redshifts not computed by a hierarchical scan
+                ok = zx['zchi2'] < 9e99
+                self._ax1.plot(zx['redshifts'][ok], zx['zchi2'][ok], fmt,
+                    alpha=0.2, label='_none_')
+                self._ax1.plot(zx['redshifts'][ok],
+                    (zx['zchi2']+zx['penalty'])[ok], fmt, label=spectype)
 
         self._ax1.plot(zfit['z'], zfit['chi2'], 'r.', label='_none_')
         for row in zfit:
@@ -37,58 +37,133 @@ def centers2edges(centers):
 # of this code have already been tested and shown to perform no better
 # than numba on Intel haswell and KNL architectures.
 
-@numba.jit
-def _trapz_rebin(x, y, edges, results):
+@numba.jit(nopython=True, nogil=True, cache=True)
+def _trapz_rebin_batch(x, y, edges, redshifts, results):
     '''
-    Numba-friendly version of trapezoidal rebinning
+    Numba-friendly trapezoidal rebinning of several vectors and redshifts
 
-    See redrock.rebin.trapz_rebin() for input descriptions.
-    `results` is pre-allocated array of length len(edges)-1 to keep results
+    See redrock.rebin.trapz_rebin_batch() for input descriptions.  Every row
+    of the 2D array `y` is rebinned in a single pass over the edges, with x
+    scaled by (1+z) for every redshift z.  The GIL is released, so that
+    threads can process separate redshift ranges in parallel.
+
+    `y` has shape (ncol, len(x)) and `results` is a pre-allocated array of
+    shape (len(redshifts), len(edges)-1, ncol) which is overwritten.
     '''
     nbin = len(edges) - 1
-    i = 0  #- index counter for output
-    j = 0  #- index counter for inputs
-    yedge = 0.0
-    area = 0.0
-
-    while i < nbin:
-        #- Seek next sample beyond bin edge
-        while x[j] <= edges[i]:
-            j += 1
-
-        #- What is the y value where the interpolation crossed the edge?
-        yedge = y[j-1] + (edges[i]-x[j-1]) * (y[j]-y[j-1]) / (x[j]-x[j-1])
-
-        #- Is this sample inside this bin?
-        if x[j] < edges[i+1]:
-            area = 0.5 * (y[j] + yedge) * (x[j] - edges[i])
-            results[i] += area
-
-            #- Continue with interior bins
-            while x[j+1] < edges[i+1]:
-                j += 1
-                area = 0.5 * (y[j] + y[j-1]) * (x[j] - x[j-1])
-                results[i] += area
+    ncol = y.shape[0]
 
-            #- Next sample will be outside this bin; handle upper edge
-            yedge = y[j] + (edges[i+1]-x[j]) * (y[j+1]-y[j]) / (x[j+1]-x[j])
-            area = 0.5 * (yedge + y[j]) * (edges[i+1] - x[j])
-            results[i] += area
+    for iz in range(len(redshifts)):
+        s = 1.0 + redshifts[iz]
+        i = 0  #- index counter for output
+        j = 0  #- index counter for inputs
 
-        #- Otherwise the samples span over this bin
-        else:
-            ylo = y[j] + (edges[i]-x[j]) * (y[j] - y[j-1]) / (x[j] - x[j-1])
-            yhi = y[j] + (edges[i+1]-x[j]) * (y[j] - y[j-1]) / (x[j] - x[j-1])
-            area = 0.5 * (ylo+yhi) * (edges[i+1]-edges[i])
-            results[i] += area
+        while i < nbin:
+            for c in range(ncol):
+                results[iz,i,c] = 0.0
 
-        i += 1
+            #- Seek next sample beyond bin edge
+            while x[j]*s <= edges[i]:
+                j += 1
 
-    for i in range(nbin):
-        results[i] /= edges[i+1] - edges[i]
+            #- Is this sample inside this bin?
+            if x[j]*s < edges[i+1]:
+                for c in range(ncol):
+                    yedge = y[c,j-1] + (edges[i]-x[j-1]*s) * \
+                        (y[c,j]-y[c,j-1]) / (x[j]*s-x[j-1]*s)
+                    results[iz,i,c] += 0.5 * (y[c,j] + yedge) * \
+                        (x[j]*s - edges[i])
+
+                #- Continue with interior bins
+                while x[j+1]*s < edges[i+1]:
+                    j += 1
+                    for c in range(ncol):
+                        results[iz,i,c] += 0.5 * (y[c,j] + y[c,j-1]) * \
+                            (x[j]*s - x[j-1]*s)
+
+                #- Next sample will be outside this bin; handle upper edge
+                for c in range(ncol):
+                    yedge = y[c,j] + (edges[i+1]-x[j]*s) * \
+                        (y[c,j+1]-y[c,j]) / (x[j+1]*s-x[j]*s)
+                    results[iz,i,c] += 0.5 * (yedge + y[c,j]) * \
+                        (edges[i+1] - x[j]*s)
+
+            #- Otherwise the samples span over this bin
+            else:
+                for c in range(ncol):
+                    ylo = y[c,j] + (edges[i]-x[j]*s) * (y[c,j] - y[c,j-1]) / \
+                        (x[j]*s - x[j-1]*s)
+                    yhi = y[c,j] + (edges[i+1]-x[j]*s) * \
+                        (y[c,j] - y[c,j-1]) / (x[j]*s - x[j-1]*s)
+                    results[iz,i,c] += 0.5 * (ylo+yhi) * (edges[i+1]-edges[i])
+
+            for c in range(ncol):
+                results[iz,i,c] /= edges[i+1] - edges[i]
+
+            i += 1
 
     return
 
+def trapz_rebin_batch(x, y, edges, redshifts, out=None, nthreads=1):
+    """Rebin several y(x) flux densities at several redshifts.
+
+    This is equivalent to calling trapz_rebin((1+z)*x, y[i], edges=edges) for
+    every row i of y and every redshift z, but all rows are rebinned in one
+    pass over the edges.  The redshifts can be split among several threads.
+
+    Args:
+        x (array): input x values.
+        y (array): input y values, with shape (ncol, len(x)).
+        edges (array): new bin edges.
+        redshifts (array): the redshifts.
+        out (array): optional pre-allocated output array of shape
+            (len(redshifts), len(edges)-1, ncol).
+        nthreads (int): the number of threads to use.
+
+    Returns:
+        array: the (len(redshifts), len(edges)-1, ncol) rebinned values.
+
+    Raises:
+        ValueError: if the redshifted x range does not cover the edges.
+
+    """
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    y = np.ascontiguousarray(y, dtype=np.float64)
+    edges = np.ascontiguousarray(edges, dtype=np.float64)
+    redshifts = np.ascontiguousarray(np.atleast_1d(redshifts),
+        dtype=np.float64)
+
+    if len(redshifts) > 0:
+        zmin = redshifts.min()
+        zmax = redshifts.max()
+        if edges[0] < x[0]*(1+zmin) or x[-1]*(1+zmax) < edges[-1] or \
+            edges[0] < x[0]*(1+zmax) or x[-1]*(1+zmin) < edges[-1]:
+            raise ValueError('edges must be within input x range')
+
+    shape = (len(redshifts), len(edges)-1, y.shape[0])
+    if out is None:
+        out = np.zeros(shape, dtype=np.float64)
+    elif out.shape != shape:
+        raise ValueError('output array has the wrong shape')
+
+    if nthreads > 1 and len(redshifts) > 1:
+        # Threads rather than numba.prange: the numba threading layers are
+        # not all safe to use in a process which later forks multiprocessing
+        # workers.
+        from concurrent.futures import ThreadPoolExecutor
+        bounds = np.linspace(0, len(redshifts), min(nthreads,
+            len(redshifts)) + 1).astype(int)
+        with ThreadPoolExecutor(max_workers=len(bounds)-1) as pool:
+            jobs = [ pool.submit(_trapz_rebin_batch, x, y, edges,
+                redshifts[lo:hi], out[lo:hi]) \
+                for lo, hi in zip(bounds[:-1], bounds[1:]) ]
+            for j in jobs:
+                j.result()
+    else:
+        _trapz_rebin_batch(x, y, edges, redshifts, out)
+
+    return out
+
 def trapz_rebin(x, y, xnew=None, edges=None):
     """Rebin y(x) flux density using trapezoidal integration between bin edges
 
@@ -102,11 +177,12 @@ def trapz_rebin(x, y, xnew=None, edges=None):
 
     Args:
         x (array): input x values.
-        y (array): input y values.
+        y (array): input y values, either 1D or 2D with one vector per row.
         edges (array): (optional) new bin edges.
 
     Returns:
-        array: integrated results with len(results) = len(edges)-1
+        array: integrated results with len(results) = len(edges)-1, or with
+            shape (len(y), len(edges)-1) for 2D y.
 
     Raises:
         ValueError: if edges are outside the range of x or if len(x) != len(y)
@@ -120,11 +196,40 @@ def trapz_rebin(x, y, xnew=None, edges=None):
     if edges[0] < x[0] or x[-1] < edges[-1]:
         raise ValueError('edges must be within input x range')
 
-    result = np.zeros(len(edges)-1, dtype=np.float64)
+    y = np.asarray(y)
+    if y.ndim == 1:
+        return trapz_rebin_batch(x, y[None,:], edges, [0.0])[0,:,0]
+    else:
+        return trapz_rebin_batch(x, y, edges, [0.0])[0].T.copy()
+
 
-    _trapz_rebin(x, y, edges, result)
+def rebin_template_grid(template, redshifts, dwave, out=None, nthreads=1):
+    """Rebin a template to a set of wavelengths at many redshifts.
 
-    return result
+    All basis vectors and redshifts are rebinned by one call to
+    trapz_rebin_batch() for each wavelength grid.
+
+    Args:
+        template (Template): the template object
+        redshifts (array): the redshifts
+        dwave (dict): the keys are the "wavehash" and the values
+            are a 1D array containing the wavelength grid.
+        out (dict): optional pre-allocated (nz, nwave, nbasis) output arrays
+            for each wavehash.
+        nthreads (int): the number of threads to use.
+
+    Returns:
+        dict:  The rebinned template for every wavelength grid in dwave, as
+            an (nz, nwave, nbasis) array.
+
+    """
+    if out is None:
+        out = dict()
+    for hs, wave in dwave.items():
+        out[hs] = trapz_rebin_batch(template.wave, template.flux,
+            centers2edges(wave), redshifts, out=out.get(hs),
+            nthreads=nthreads)
+    return out
 
 
 def rebin_template(template, z, dwave):
@@ -144,12 +249,5 @@ def rebin_template(template, z, dwave):
             grid in dwave.
 
     """
-    nbasis = template.flux.shape[0]  #- number of template basis vectors
-    #print('checkpoint: starting rebinning dict construction')
-    #print('nbasis =',nbasis)
-    #print(len(dwave))
-    #sys.stdout.flush()
-    result = { hs:np.array([ trapz_rebin((1.+z)*template.wave, template.flux[b], wave) for b in range(nbasis) ]).transpose() for hs, wave in dwave.items()}
-    #print('checkpoint: ending rebinning dict construction')
-    #sys.stdout.flush()
-    return result
+    binned = rebin_template_grid(template, [z], dwave)
+    return { hs:b[0] for hs, b in binned.items() }
@@ -8,7 +8,9 @@ import sys
 import numpy as np
 import scipy.sparse
 
-from .utils import mp_array, distribute_work
+from .utils import mp_array, distribute_work, SharedArray
+
+from .costmodel import CostModel, target_size
 
 from . import constants
 
@@ -35,6 +37,7 @@ class Spectrum(object):
         self.ivar = ivar
         self.R = R
         self._Rcsr = Rcsr
+        self._Rcompact = None
         self._mpshared = False
         if hasattr(R,'data'):
             self.wavehash = hash((len(wave), wave[0], wave[1], wave[-2], wave[-1], R.data.shape[0]))
@@ -47,6 +50,24 @@ class Spectrum(object):
             self._Rcsr = self.R.tocsr()
         return self._Rcsr
 
+    @property
+    def Rcompact(self):
+        """The rows of Rcsr for the pixels with non-zero weight.
+
+        The model of the pixels with ivar == 0 does not enter the chi^2, so
+        only these rows are applied to the (full length) templates.  The
+        matrix is recomputed if the ivar mask changes.
+        """
+        good = self.ivar > 0
+        if (self._Rcompact is None) or \
+            not np.array_equal(good, self._Rcompact[0]):
+            if np.all(good):
+                Rc = self.Rcsr
+            else:
+                Rc = self.Rcsr[np.flatnonzero(good)]
+            self._Rcompact = (good, Rc)
+        return self._Rcompact[1]
+
     def sharedmem_pack(self):
         """Pack spectral data into multiprocessing shared memory.
         """
@@ -55,6 +76,7 @@ class Spectrum(object):
             self.wave = mp_array(self.wave)
             self.flux = mp_array(self.flux)
             self.ivar = mp_array(self.ivar)
+            self._Rcompact = None
 
             self._ndiag = self.R.data.shape[0]
             self._splen = self.R.data.shape[1]
@@ -101,6 +123,159 @@ class Spectrum(object):
         return
 
 
+class NormalSpectrum(object):
+    """Normal equation products for the spectra on one wavelength grid.
+
+    The chi^2 of a model R T c for a spectrum with flux f and weights W is
+
+        chi2 = f.W.f - 2 c.T^T R^T W f + c.T^T R^T W R T c
+
+    Only the banded operator A = R^T W R, the vector R^T W f and the scalar
+    f.W.f depend on the data, and all three are additive over spectra which
+    share the same wavelength grid.  This class stores those sums.
+
+    Args:
+        wave (array): the wavelength grid.
+        wavehash (int): the hash of the wavelength grid.
+        A (scipy.sparse.csr_matrix): the banded operator R^T W R.
+        Rtwf (array): the vector R^T W f.
+        fwf (float): the scalar f.W.f.
+        npix (int): the number of pixels with non-zero weight.
+        nspec (int): the number of spectra included in the sums.
+
+    """
+    def __init__(self, wave, wavehash, A, Rtwf, fwf, npix, nspec=1):
+        self.nwave = wave.size
+        self.wave = wave
+        self.wavehash = wavehash
+        self.A = A
+        self.Rtwf = Rtwf
+        self.fwf = fwf
+        self.npix = npix
+        self.nspec = nspec
+
+    def add(self, other):
+        """Add the normal equation products of another NormalSpectrum.
+
+        Args:
+            other (NormalSpectrum): products for the same wavelength grid.
+
+        """
+        assert other.wavehash == self.wavehash
+        self.A = self.A + other.A
+        self.Rtwf = self.Rtwf + other.Rtwf
+        self.fwf += other.fwf
+        self.npix += other.npix
+        self.nspec += other.nspec
+        return
+
+
+def normal_spectra(spectra):
+    """Compute the normal equation products of a list of spectra.
+
+    Spectra sharing a wavehash are summed together.
+
+    Args:
+        spectra (list): list of Spectrum objects.
+
+    Returns:
+        list: a list of NormalSpectrum objects, one for each wavehash in the
+            order of first appearance.
+
+    """
+    normal = dict()
+    for s in spectra:
+        # Only the rows of R of the pixels with non-zero weight contribute.
+        good = s.ivar > 0
+        Rc = s.Rcompact
+        ivar = s.ivar[good]
+        flux = s.flux[good]
+        RtW = Rc.T.dot(scipy.sparse.diags(ivar))
+        ns = NormalSpectrum(s.wave, s.wavehash, RtW.dot(Rc).tocsr(),
+            RtW.dot(flux), np.dot(flux, ivar * flux), int(np.sum(good)))
+        if s.wavehash in normal:
+            normal[s.wavehash].add(ns)
+        else:
+            normal[s.wavehash] = ns
+    return list(normal.values())
+
+
+def binned_wavehash(wavehash, factor):
+    """Return the wavehash of a wavelength grid binned by some factor.
+
+    Args:
+        wavehash (int): the hash of the full resolution grid.
+        factor (int): the number of pixels per bin.
+
+    Returns:
+        int: the hash of the binned grid (unchanged if factor <= 1).
+
+    """
+    if factor <= 1:
+        return wavehash
+    return hash((wavehash, int(factor)))
+
+
+def bin_wave(wave, factor):
+    """Return the mean wavelength of consecutive groups of pixels.
+
+    The last bin has fewer pixels if the grid size is not a multiple of the
+    factor.
+    """
+    starts = np.arange(0, len(wave), factor)
+    counts = np.diff(np.append(starts, len(wave)))
+    return np.add.reduceat(wave, starts) / counts
+
+
+def binned_wavegrids(dwave, factor):
+    """Return the wavelength grids binned by some factor.
+
+    Args:
+        dwave (dict): the full resolution grids for each wavehash.
+        factor (int): the number of pixels per bin.
+
+    Returns:
+        dict: the binned grids for each binned wavehash.
+
+    """
+    if factor <= 1:
+        return dwave
+    return { binned_wavehash(k, factor):bin_wave(w, factor) \
+        for k, w in dwave.items() }
+
+
+def bin_normal(ns, factor):
+    """Project normal equation products onto a binned wavelength grid.
+
+    A template evaluated on the binned grid is expanded to the full grid as
+    T = U T_b, where U repeats the value of each bin for its pixels.  The
+    chi^2 of the model R U T_b c only depends on
+
+        A_b = U^T A U,   (R^T W f)_b = U^T R^T W f,
+
+    so the weights and the resolution of all pixels are kept, while the
+    redshift scan costs a factor of the binning less.
+
+    Args:
+        ns (NormalSpectrum): the full resolution products.
+        factor (int): the number of pixels per bin.
+
+    Returns:
+        NormalSpectrum: the products on the binned grid.
+
+    """
+    if factor <= 1:
+        return ns
+    nwave = ns.nwave
+    nbin = (nwave + factor - 1) // factor
+    U = scipy.sparse.csr_matrix((np.ones(nwave),
+        (np.arange(nwave), np.arange(nwave) // factor)), shape=(nwave, nbin))
+    A = U.T.dot(ns.A.dot(U)).tocsr()
+    return NormalSpectrum(bin_wave(ns.wave, factor),
+        binned_wavehash(ns.wavehash, factor), A, U.T.dot(ns.Rtwf), ns.fwf,
+        ns.npix, nspec=ns.nspec)
+
+
 class Target(object):
     """A single target.
 
@@ -120,6 +295,8 @@ class Target(object):
     def __init__(self, targetid, spectra, coadd=False, cosmics_nsig=0., meta=None):
         self.id = targetid
         self.spectra = spectra
+        self.normal = None
+        self._binned = dict()
         if meta is None:
             self.meta = dict()
         else:
@@ -230,6 +407,65 @@ class Target(object):
         self.spectra = coadd
         return
 
+    def compute_normal(self, collapse=False):
+        """Compute the normal equation products of the current spectra list.
+
+        The resulting list of NormalSpectrum objects (one per wavehash) is
+        stored in the "normal" attribute and is used by the banded redshift
+        scan and by the redshift refinement.
+
+        Args:
+            collapse (bool): if True, REPLACE the list of individual spectra
+                with the normal equation products.  The chi^2 of the target
+                is unchanged, but the cost of fitting it no longer depends on
+                the number of exposures.
+
+        """
+        if self.collapsed:
+            return
+        self.normal = normal_spectra(self.spectra)
+        self._binned = dict()
+        if collapse:
+            self.spectra = list()
+        return
+
+    def binned_normal(self, factor):
+        """Return the normal equation products on binned wavelength grids.
+
+        The normal equation products are computed if needed (see
+        compute_normal) and projected onto grids of factor pixels per bin
+        (see bin_normal).  The result is kept for later calls.
+
+        Args:
+            factor (int): the number of pixels per bin.
+
+        Returns:
+            list: a list of NormalSpectrum objects.
+
+        """
+        if self.normal is None:
+            self.compute_normal()
+        if factor <= 1:
+            return self.normal
+        if factor not in self._binned:
+            self._binned[factor] = [ bin_normal(ns, factor) \
+                for ns in self.normal ]
+        return self._binned[factor]
+
+    @property
+    def collapsed(self):
+        """True if the spectra have been replaced by their normal equations.
+        """
+        return (self.normal is not None) and (len(self.spectra) == 0)
+
+    @property
+    def npixels(self):
+        """The number of pixels with non-zero weight in all spectra.
+        """
+        if self.collapsed:
+            return sum([ ns.npix for ns in self.normal ])
+        return sum([ (s.ivar > 0.).sum() for s in self.spectra ])
+
     def sharedmem_pack(self):
         """Pack all spectra into multiprocessing shared memory.
         """
@@ -245,6 +481,146 @@ class Target(object):
         return
 
 
+class SharedTargetStore(object):
+    """The spectral data of a list of targets in shared memory.
+
+    The wavelength, flux, inverse variance and resolution arrays of all
+    spectra (and the normal equation products of targets which have them)
+    are copied into one multiprocessing.shared_memory segment for each data
+    type.  The store only keeps the segment names and the layout of the
+    arrays, so it is cheap to pickle.  Other processes rebuild the targets
+    with targets(), whose arrays are read-only views of the segments.
+
+    The process which created the store must call close() once the other
+    processes are done with it.
+
+    Args:
+        targets (list): list of Target objects.
+
+    """
+    def __init__(self, targets):
+        sizes = dict()
+        arrays = list()
+
+        def _add(x):
+            x = np.ascontiguousarray(x)
+            dt = x.dtype.str
+            off = sizes.get(dt, 0)
+            sizes[dt] = off + x.nbytes
+            arrays.append( (dt, off, x) )
+            return (dt, off, x.shape)
+
+        def _add_csr(m):
+            return (_add(m.data), _add(m.indices), _add(m.indptr), m.shape)
+
+        self._layout = list()
+        for tg in targets:
+            spectra = list()
+            for sp in tg.spectra:
+                spectra.append( (sp.wavehash, _add(sp.wave), _add(sp.flux),
+                    _add(sp.ivar), _add(sp.R.data), _add(sp.R.offsets),
+                    _add_csr(sp.Rcsr)) )
+            normal = None
+            if tg.normal is not None:
+                normal = [ (ns.wavehash, _add(ns.wave), _add_csr(ns.A),
+                    _add(ns.Rtwf), ns.fwf, ns.npix, ns.nspec) \
+                    for ns in tg.normal ]
+            self._layout.append( (tg.id, tg.meta, spectra, normal) )
+
+        self._segments = { dt:SharedArray((size // np.dtype(dt).itemsize,),
+            dtype=dt) for dt, size in sizes.items() }
+        self._arrays = dict()
+
+        for dt, off, x in arrays:
+            view = self._view( (dt, off, x.shape) )
+            view.flags.writeable = True
+            view[...] = x
+        self._arrays = dict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_arrays"] = dict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def _view(self, desc):
+        dt, off, shape = desc
+        if dt not in self._arrays:
+            self._arrays[dt] = self._segments[dt].array
+        n = int(np.prod(shape))
+        start = off // np.dtype(dt).itemsize
+        x = self._arrays[dt][start:start+n].reshape(shape)
+        x.flags.writeable = False
+        return x
+
+    def _csr(self, desc):
+        data, indices, indptr, shape = desc
+        return scipy.sparse.csr_matrix((self._view(data),
+            self._view(indices), self._view(indptr)), shape=shape)
+
+    @property
+    def target_ids(self):
+        return [ x[0] for x in self._layout ]
+
+    def targets(self, ids=None):
+        """Return Target objects which use the shared data.
+
+        Args:
+            ids (list): the target IDs to return, in this order.  Default
+                is all targets in the store.
+
+        Returns:
+            list: list of Target objects.
+
+        """
+        layout = { x[0]:x for x in self._layout }
+        if ids is None:
+            ids = self.target_ids
+
+        targets = list()
+        for tid in ids:
+            _, meta, spectra, normal = layout[tid]
+            splist = list()
+            for (wavehash, wave, flux, ivar, rdata, roffsets, rcsr) \
+                in spectra:
+                # The arrays were already checked by the Spectrum
+                # constructor, so just restore the attributes.
+                sp = Spectrum.__new__(Spectrum)
+                sp.wave = self._view(wave)
+                sp.nwave = sp.wave.size
+                sp.flux = self._view(flux)
+                sp.ivar = self._view(ivar)
+                sp.R = scipy.sparse.dia_matrix((self._view(rdata),
+                    self._view(roffsets)), shape=(sp.nwave, sp.nwave))
+                sp._Rcsr = self._csr(rcsr)
+                sp._Rcompact = None
+                sp._mpshared = False
+                sp.wavehash = wavehash
+                splist.append(sp)
+            tg = Target(tid, splist, meta=meta)
+            if normal is not None:
+                tg.normal = [ NormalSpectrum(self._view(wave), wavehash,
+                    self._csr(A), self._view(Rtwf), fwf, npix, nspec) \
+                    for (wavehash, wave, A, Rtwf, fwf, npix, nspec) \
+                    in normal ]
+            targets.append(tg)
+        return targets
+
+    def close(self):
+        """Release the shared memory.
+
+        In the creating process this also removes the segments.  Targets
+        already returned by targets() remain valid.
+        """
+        for x in self._segments.values():
+            x.unlink()
+            x.close()
+        self._arrays = dict()
+        return
+
+
 class DistTargets(object):
     """Base class for distributed targets.
 
@@ -311,6 +687,10 @@ class DistTargets(object):
                 for s in t.spectra:
                     if s.wavehash not in my_dwave:
                         my_dwave[s.wavehash] = s.wave.copy()
+                if t.collapsed:
+                    for s in t.normal:
+                        if s.wavehash not in my_dwave:
+                            my_dwave[s.wavehash] = s.wave.copy()
             #print('len(my_dwave) =',len(my_dwave))
             if self._comm is None:
                 self._dwave = my_dwave.copy()
@@ -328,7 +708,20 @@ class DistTargets(object):
         return self._dwave
 
 
-def distribute_targets(targets, nproc):
+    def collapse(self):
+        """Collapse the spectra of all local targets.
+
+        The individual spectra of every local target are replaced by the sums
+        of their normal equation products for each wavelength grid.  See
+        Target.compute_normal().  Any masking of the spectra must be done
+        before calling this.
+        """
+        for t in self.local():
+            t.compute_normal(collapse=True)
+        return
+
+
+def distribute_targets(targets, nproc, cost_model=None):
     """Distribute a list of targets among processes.
 
     Given a list of Target objects, compute the load balanced
@@ -342,18 +735,23 @@ def distribute_targets(targets, nproc):
     Args:
         targets (list): list of Target objects.
         nproc (int): number of processes.
+        cost_model (CostModel): (optional) the model of the cost of each
+            target.  Defaults to the built-in coefficients.
 
     Returns:
         list:  A list (one element for each process) with each element
             being a list of the target IDs assigned to that process.
 
     """
-    # We weight each target by the number of spectra.
+    # We weight each target by its predicted cost, which depends on its
+    # number of pixels and wavelength grids.
+    if cost_model is None:
+        cost_model = CostModel()
     ids = list()
     tweights = dict()
     for tg in targets:
         ids.append(tg.id)
-        tweights[tg.id] = len(tg.spectra)
+        tweights[tg.id] = cost_model.target_cost(*target_size(tg))
     return distribute_work(nproc, ids, weights=tweights)
 
 
@@ -367,10 +765,13 @@ class DistTargetsCopy(DistTargets):
         targets (list): list of Target objects on one process.
         comm (mpi4py.MPI.Comm): (optional) the MPI communicator.
         root (int): the process which has the input targets locally.
+        cost_model (CostModel): (optional) the model of the cost of each
+            target, the same on all processes.  Defaults to the built-in
+            coefficients.
 
     """
 
-    def __init__(self, targets, comm=None, root=0):
+    def __init__(self, targets, comm=None, root=0, cost_model=None):
 
         comm_size = 1
         comm_rank = 0
@@ -390,7 +791,8 @@ class DistTargetsCopy(DistTargets):
         # Distribute the targets among process weighted by the amount of work
         # to do for each target.
 
-        self._proc_targets = distribute_targets(targets, comm_size)
+        self._proc_targets = distribute_targets(targets, comm_size,
+            cost_model=cost_model)
 
         self._my_targets = self._proc_targets[comm_rank]
 
@@ -7,14 +7,16 @@ from __future__ import absolute_import, division, print_function
 import sys
 from glob import glob
 import os
-import traceback
+import hashlib
 
 import numpy as np
 from astropy.io import fits
 
 from .utils import native_endian, elapsed, transmission_Lyman
 
-from .rebin import rebin_template, trapz_rebin
+from .rebin import rebin_template_grid, trapz_rebin_batch, centers2edges
+
+from .targets import binned_wavegrids
 
 
 class Template(object):
@@ -158,7 +160,8 @@ class Template(object):
         """
         assert len(coeff) == self.nbasis
         flux = self.flux.T.dot(coeff).T / (1+z)
-        return trapz_rebin(self.wave*(1+z), flux, wave)
+        return trapz_rebin_batch(self.wave, flux[None,:], centers2edges(wave),
+            [z])[0,:,0]
 
 
 
@@ -210,33 +213,208 @@ class DistTemplatePiece(object):
         index (int): the chunk index of this piece- this corresponds to
             the process rank that originally computed this piece.
         redshifts (array): the redshift range contained in this piece.
-        data (list): a list of dictionaries, one for each redshift, and
-            each containing the 2D interpolated template values for all
-            "wavehash" keys.
+        data (dict): for each "wavehash" key, the 3D (nz, nwave, nbasis)
+            array of interpolated template values at all redshifts.  A list
+            of dictionaries, one for each redshift and each containing the
+            2D interpolated template values, is also accepted.
+        first (int): the index of the first redshift of this piece in the
+            redshift grid of the template.
 
     """
-    def __init__(self, index, redshifts, data):
+    def __init__(self, index, redshifts, data, first=0):
         self.index = index
         self.redshifts = redshifts
-        self.data = data
+        self.first = first
+        if not isinstance(data, dict):
+            keys = data[0].keys() if len(data) > 0 else list()
+            data = { k:np.array([ x[k] for x in data ]) for k in keys }
+        self.tdata = data
+
+    @property
+    def data(self):
+        """List of dictionaries, one for each redshift, with views of the
+        2D interpolated template values for all "wavehash" keys.
+        """
+        return [ { k:v[i] for k, v in self.tdata.items() } \
+            for i in range(len(self.redshifts)) ]
+
+
+def rebin_template_lyman(template, dwave, zlist, nthreads=1, out=None):
+    """Rebin a template to a list of redshifts and apply Lyman absorption.
+
+    The template is rebinned with redrock.rebin.rebin_template_grid and
+    multiplied by the Lyman series transmission at each redshift.
+
+    Args:
+        template (Template): the template.
+        dwave (dict): the wavelength grid of each wavehash.
+        zlist (array): the redshifts.
+        nthreads (int): the number of threads used for rebinning.
+        out (dict): optional pre-allocated (nz, nwave, nbasis) output arrays
+            for each wavehash.
 
+    Returns:
+        dict: the (nz, nwave, nbasis) rebinned template for each wavehash.
 
-def _mp_rebin_template(template, dwave, zlist, qout):
-    """Function for multiprocessing version of rebinning.
+    """
+    binned = rebin_template_grid(template, zlist, dwave, nthreads=nthreads,
+        out=out)
+    for i, z in enumerate(zlist):
+        for hs, wave in dwave.items():
+            binned[hs][i] *= transmission_Lyman(z, wave)[:,None]
+    return binned
+
+
+def _rebin_template_shared(template, dwave, node_comm):
+    """Rebin a template at all redshifts into node-local shared memory.
+
+    One MPI-3 shared memory window is allocated for each wavelength grid on
+    the first process of the node communicator.  The processes of the node
+    each rebin a slice of the redshifts directly into the shared arrays.
+
+    Returns:
+        tuple: the dictionary of shared (nz, nwave, nbasis) arrays for each
+            wavehash and the list of MPI windows backing them.
+
+    """
+    from mpi4py import MPI
+
+    nz = len(template.redshifts)
+    itemsize = MPI.DOUBLE.Get_size()
+
+    binned = dict()
+    windows = list()
+    for hs in sorted(dwave.keys()):
+        shape = (nz, len(dwave[hs]), template.nbasis)
+        nbytes = 0
+        if node_comm.rank == 0:
+            nbytes = int(np.prod(shape)) * itemsize
+        win = MPI.Win.Allocate_shared(nbytes, itemsize, comm=node_comm)
+        buf, _ = win.Shared_query(0)
+        binned[hs] = np.ndarray(buffer=buf, dtype=np.float64, shape=shape)
+        windows.append(win)
+
+    work = np.array_split(np.arange(nz), node_comm.size)[node_comm.rank]
+    if len(work) > 0:
+        first = work[0]
+        last = work[-1] + 1
+        rebin_template_lyman(template, dwave, template.redshifts[first:last],
+            out={ hs:b[first:last] for hs, b in binned.items() })
+    node_comm.barrier()
+
+    return binned, windows
+
+
+def template_bytes(template, dwave):
+    """Return the memory needed by a template rebinned at all redshifts.
+
+    Args:
+        template (Template): the template.
+        dwave (dict): the dictionary of wavelength grids.
+
+    Returns:
+        int: the size in bytes.
+
+    """
+    nwave = sum([ len(w) for w in dwave.values() ])
+    return len(template.redshifts) * nwave * template.nbasis * 8
+
+
+def node_memory():
+    """Return the physical memory of this node in bytes, or 0 if unknown.
     """
     try:
-        results = dict()
-        for z in zlist:
-            binned = rebin_template(template, z, dwave)
-            results[z] = binned
-        qout.put(results)
-    except:
-        exc_type, exc_value, exc_traceback = sys.exc_info()
-        lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
-        lines = [ "MP rebin: {}".format(x) for x in lines ]
-        print("".join(lines))
-        sys.stdout.flush()
-    return
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return 0
+
+
+def template_cache_file(cache_dir, template, wave):
+    """Return the template cache file for one template and wavelength grid.
+
+    The name encodes the template version and type, and a hash of the
+    template data, its redshift grid and the wavelength grid.
+
+    Args:
+        cache_dir (str): the cache directory.
+        template (Template): the template.
+        wave (array): the wavelength grid.
+
+    Returns:
+        str: the path to the cache file.
+
+    """
+    h = hashlib.sha1()
+    for x in [template.redshifts, template.wave, template.flux, wave]:
+        h.update(np.ascontiguousarray(x, dtype=np.float64).tobytes())
+    version = str(getattr(template, '_version', 'unknown'))
+    name = "rrtemplate-{}-{}-{}.npy".format(
+        template.full_type.replace(':::', '_'), version, h.hexdigest())
+    return os.path.join(cache_dir, name.replace(os.sep, '_'))
+
+
+def _write_template_cache(files, binned, first, ntotal, comm=None):
+    """Write our slice of the rebinned templates to the cache files.
+
+    Every process writes its redshift range into a temporary file, which is
+    renamed once complete so that concurrent jobs never see partial files.
+    The processes agree on the success of each step, so that if any of them
+    fails to write, they all stop: a warning is printed, the temporary file
+    is removed and nothing is raised.
+
+    Returns:
+        bool: True if all cache files were written.
+
+    """
+    rank = 0 if comm is None else comm.rank
+
+    def _all_ok(ok):
+        if comm is None:
+            return ok
+        return all(comm.allgather(ok))
+
+    for hs, path in sorted(files.items()):
+        b = binned[hs]
+        tmp = "{}.tmp{}".format(path, os.getpid())
+        if comm is not None:
+            tmp = comm.bcast(tmp, root=0)
+        error = None
+        if rank == 0:
+            try:
+                out = np.lib.format.open_memmap(tmp, mode="w+",
+                    dtype=b.dtype, shape=(ntotal,) + b.shape[1:])
+                del out
+            except Exception as err:
+                error = err
+        ok = _all_ok(error is None)
+        if ok:
+            try:
+                out = np.load(tmp, mmap_mode="r+")
+                out[first:first+len(b)] = b
+                out.flush()
+                del out
+            except Exception as err:
+                error = err
+            ok = _all_ok(error is None)
+        if ok and (rank == 0):
+            try:
+                os.replace(tmp, path)
+            except Exception as err:
+                error = err
+        if ok:
+            ok = _all_ok(error is None)
+        if not ok:
+            if error is not None:
+                print("WARNING: cannot write template cache {}: {}".format(
+                    path, error))
+                sys.stdout.flush()
+            if rank == 0:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+            return False
+    return True
 
 
 class DistTemplate(object):
@@ -254,12 +432,27 @@ class DistTemplate(object):
         mp_procs (int): if not using MPI, restrict the number of
             multiprocesses to this.
         comm (mpi4py.MPI.Comm): (optional) the MPI communicator.
+        cache_dir (str): (optional) directory of cached rebinned templates.
+            If the cache files for this template exist they are memory
+            mapped, otherwise they are created.
+        node_comm (mpi4py.MPI.Comm): (optional) the communicator of the
+            processes of comm on this node.  If given, the template is
+            rebinned at all redshifts into node-local shared memory and every
+            process scans all redshifts, so that cycle() has nothing to do.
+            The shared memory is released by close().
+        nthreads (int): (optional) the number of threads used to rebin the
+            template.  Defaults to mp_procs without MPI and 1 with MPI.
+        binning (int): (optional) if > 1, the template is rebinned on the
+            grids of dwave binned by this number of pixels, for a reduced
+            resolution redshift scan (see Target.binned_normal).
 
     """
-    def __init__(self, template, dwave, mp_procs=1, comm=None):
+    def __init__(self, template, dwave, mp_procs=1, comm=None,
+        cache_dir=None, node_comm=None, nthreads=None, binning=1):
         self._comm = comm
         self._template = template
-        self._dwave = dwave
+        self._binning = max(1, int(binning))
+        self._dwave = binned_wavegrids(dwave, self._binning)
 
         self._comm_rank = 0
         self._comm_size = 1
@@ -270,91 +463,125 @@ class DistTemplate(object):
         self._distredshifts = np.array_split(self._template.redshifts,
             self._comm_size)
 
-        myz = self._distredshifts[self._comm_rank]
+        self._shared = (self._comm is not None) and (node_comm is not None)
+        self._windows = list()
+
+        if self._shared:
+            myz = self._template.redshifts
+            first = 0
+        else:
+            myz = self._distredshifts[self._comm_rank]
+            first = sum([ len(x) for x in \
+                self._distredshifts[:self._comm_rank] ])
         nz = len(myz)
 
-        data = list()
+        # Check the template cache.  One process decides whether we read
+        # the cache, write it or ignore it.
+
+        cache_files = None
+        cache_mode = None
+        if cache_dir is not None:
+            cache_files = { hs:template_cache_file(cache_dir, template, w) \
+                for hs, w in self._dwave.items() }
+            if self._comm_rank == 0:
+                if all([ os.path.isfile(x) for x in cache_files.values() ]):
+                    cache_mode = "read"
+                else:
+                    try:
+                        os.makedirs(cache_dir, exist_ok=True)
+                        if os.access(cache_dir, os.W_OK):
+                            cache_mode = "write"
+                    except OSError:
+                        pass
+                    if cache_mode is None:
+                        print("WARNING: template cache {} is not writable"\
+                            .format(cache_dir))
+                        sys.stdout.flush()
+            if self._comm is not None:
+                cache_mode = self._comm.bcast(cache_mode, root=0)
+
+        if cache_mode == "read":
+            binned = { hs:np.load(f, mmap_mode="r")[first:first+nz] \
+                for hs, f in cache_files.items() }
+        elif self._shared:
+            binned, self._windows = _rebin_template_shared(self._template,
+                self._dwave, node_comm)
+            if (cache_mode == "write") and (self._comm_rank == 0):
+                _write_template_cache(cache_files, binned, 0, nz)
+            if cache_mode == "write":
+                self._comm.barrier()
+        else:
+            # In the case of not using MPI (comm == None), one process is
+            # rebinning all the templates.  In that scenario, split the
+            # redshifts among mp_procs threads; the rebinning kernel
+            # releases the GIL.
+            if nthreads is None:
+                nthreads = mp_procs if self._comm is None else 1
+            binned = rebin_template_lyman(self._template, self._dwave, myz,
+                nthreads=nthreads)
+            if cache_mode == "write":
+                _write_template_cache(cache_files, binned, first,
+                    len(self._template.redshifts), comm=self._comm)
+
+        if self._shared:
+            self._piece = DistTemplatePiece(0, myz, binned)
+        else:
+            self._piece = DistTemplatePiece(self._comm_rank, myz, binned,
+                first=first)
 
-        # In the case of not using MPI (comm == None), one process is rebinning
-        # all the templates.  In that scenario, use multiprocessing
-        # workers to do the rebinning.
+        # In-flight requests of the MPI ring.
+        self._pending = None
 
-        if self._comm is not None:
-            #print('checkpoint DistTemplates: start MPI')
-            #print(len(myz))
-            #sys.stdout.flush()
-            # MPI case- compute our local redshifts
-            for z in myz:
-                binned = rebin_template(self._template, z, self._dwave)
-                data.append(binned)
-            #print('checkpoint DistTemplates: end MPI')
-            #sys.stdout.flush()
-        else:
-            #print('checkpoint DistTemplates: start multiprocessing')
-            # We don't have MPI, so use multiprocessing
-            import multiprocessing as mp
-
-            qout = mp.Queue()
-            work = np.array_split(myz, mp_procs)
-            procs = list()
-            for i in range(mp_procs):
-                #print(i)
-                p = mp.Process(target=_mp_rebin_template,
-                    args=(self._template, self._dwave, work[i], qout))
-                procs.append(p)
-                p.start()
-
-            #print('checkpoint multiprocessing: start extract')
-            # Extract the output into a single list
-            results = dict()
-            for i in range(mp_procs):
-                res = qout.get()
-                results.update(res)
-            #print('checkpoint multiprocessing: end extract')
-            for z in myz:
-                data.append(results[z])
-            #print('checkpoint DistTemplates: end multiprocessing')
-
-        # Correct spectra for Lyman-series
-        for i, z in enumerate(myz):
-            for k in list(self._dwave.keys()):
-                T = transmission_Lyman(z,self._dwave[k])
-                for vect in range(data[i][k].shape[1]):
-                    data[i][k][:,vect] *= T
-
-        self._piece = DistTemplatePiece(self._comm_rank, myz, data)
 
+    def close(self):
+        """Free the rebinned template.
+
+        If the template is in node-local shared memory, this is collective
+        over the node communicator, so all processes must call it.  The
+        template data can no longer be used afterwards.
+        """
+        self._piece = None
+        self._pending = None
+        for win in self._windows:
+            win.Free()
+        self._windows = list()
+        return
 
     @property
     def comm(self):
         return self._comm
 
+    @property
+    def shared(self):
+        """True if all redshifts are in node-local shared memory.
+        """
+        return self._shared
+
     @property
     def template(self):
         return self._template
 
+    @property
+    def binning(self):
+        """The number of pixels per bin of the rebinned template grids.
+        """
+        return self._binning
+
     @property
     def local(self):
         return self._piece
 
 
-    def cycle(self):
-        """Pass our piece of data to the next process.
-
-        If we have returned to our original data, then return True, otherwise
-        return False.
-
-        Args:
-            Nothing
+    def _post_cycle(self):
+        """Start passing our piece of data to the next process.
 
-        Returns (bool):
-            Whether we have finished (True) else False.
+        The interpolated templates are sent with non-blocking, buffer-based
+        MPI calls.  The incoming piece is received into a new buffer, so that
+        the piece we are currently using is never overwritten, and the
+        current piece is released by cycle() once the transfer is done.  At
+        most two pieces of the template are held at a time.
 
         """
-        # If we are not using MPI, this function is a no-op, so just return.
-        if self._comm is None:
-            return True
-
         rank = self._comm_rank
         nproc = self._comm_size
 
@@ -366,17 +593,79 @@ class DistTemplate(object):
         if from_proc < 0:
             from_proc = nproc - 1
 
-        # Send our data and get a request handle for later checking.
+        # The incoming piece was originally computed by the process preceding
+        # the one which computed our current piece.
+        index = self._piece.index - 1
+        if index < 0:
+            index = nproc - 1
+        redshifts = self._distredshifts[index]
+
+        keys = sorted(self._piece.tdata.keys())
+        first = sum([ len(x) for x in self._distredshifts[:index] ])
+        incoming = DistTemplatePiece(index, redshifts,
+            { k:np.empty((len(redshifts),) + self._piece.tdata[k].shape[1:],
+            dtype=self._piece.tdata[k].dtype) for k in keys }, first=first)
+        outgoing = [ np.ascontiguousarray(self._piece.tdata[k]) for k in keys ]
+
+        reqs = list()
+        for tag, k in enumerate(keys):
+            reqs.append(self._comm.Irecv(incoming.tdata[k], source=from_proc,
+                tag=tag))
+        for tag, x in enumerate(outgoing):
+            reqs.append(self._comm.Isend(x, dest=to_proc, tag=tag))
 
-        req = self._comm.isend(self._piece, to_proc)
+        self._pending = (reqs, outgoing, incoming)
+        return
 
-        # Receive our data
 
-        incoming = self._comm.recv(source=from_proc)
+    def prefetch(self):
+        """Start passing our piece of data to the next process.
 
-        # Wait for send to finishself._comm_rank = self._comm.rank
+        The transfer proceeds in the background while our current piece is
+        used, and is completed by the next call to cycle().  This is a no-op
+        if we are not using MPI or a transfer is already in progress.
 
-        req.wait()
+        Args:
+            Nothing
+
+        Returns:
+            Nothing
+
+        """
+        if (self._comm is None) or self._shared or \
+            (self._pending is not None):
+            return
+        self._post_cycle()
+        return
+
+
+    def cycle(self):
+        """Pass our piece of data to the next process.
+
+        If we have returned to our original data, then return True, otherwise
+        return False.  If prefetch() was called, this completes that transfer.
+
+        Args:
+            Nothing
+
+        Returns (bool):
+            Whether we have finished (True) else False.
+
+        """
+        # If we are not using MPI, or every process has all redshifts in
+        # shared memory, this function is a no-op, so just return.
+        if (self._comm is None) or self._shared:
+            return True
+
+        if self._pending is None:
+            self._post_cycle()
+
+        # Wait for the sends and receives to finish
+
+        reqs, outgoing, incoming = self._pending
+        for r in reqs:
+            r.Wait()
+        self._pending = None
 
         # Now replace our local piece with the new one
 
@@ -385,13 +674,15 @@ class DistTemplate(object):
         # Are we done?
 
         done = False
-        if self._piece.index == rank:
+        if self._piece.index == self._comm_rank:
             done = True
 
         return done
 
 
-def load_dist_templates(dwave, templates=None, comm=None, mp_procs=1):
+def load_dist_templates(dwave, templates=None, comm=None, mp_procs=1,
+    cache_dir=None, shared=None, mem_budget=None, nthreads=None,
+    binning=None):
     """Read and distribute templates from disk.
 
     This reads one or more template files from disk and distributes them among
@@ -418,13 +709,38 @@ def load_dist_templates(dwave, templates=None, comm=None, mp_procs=1):
         comm (mpi4py.MPI.Comm): (optional) the MPI communicator.
         mp_procs (int): if not using MPI, restrict the number of
             multiprocesses to this.
+        cache_dir (str): (optional) directory of cached rebinned templates.
+            Defaults to $RR_TEMPLATE_CACHE if set.
+        shared (bool): (optional) with MPI, keep one copy of all rebinned
+            templates in shared memory on each node instead of passing
+            redshift slices around the communicator.  If None, this is
+            enabled when the rebinned templates fit in mem_budget.
+        mem_budget (int): (optional) the memory in bytes available for the
+            shared templates on each node (not each process, since there is
+            one copy per node).  Defaults to a quarter of the physical memory
+            of the node.
+        nthreads (int): (optional) the number of threads each process uses
+            to rebin the templates.  Defaults to mp_procs without MPI and 1
+            with MPI.
+        binning (dict): (optional) the number of pixels per bin of the
+            redshift scan for each template type (see parse_binning).
+            Template types which are not listed are scanned at full
+            resolution.
 
     Returns:
-        list: a list of DistTemplate objects.
+        list: a list of DistTemplate objects.  With shared templates, their
+            close() method must be called by all processes to free the
+            shared memory.
 
     """
     timer = elapsed(None, "", comm=comm)
 
+    if cache_dir is None:
+        cache_dir = os.getenv('RR_TEMPLATE_CACHE')
+
+    if binning is None:
+        binning = dict()
+
     template_files = None
 
     if (comm is None) or (comm.rank == 0):
@@ -462,6 +778,33 @@ def load_dist_templates(dwave, templates=None, comm=None, mp_procs=1):
     # Compute the interpolated templates in a distributed way with every
     # process generating a slice of the redshift range.
 
+    # With MPI, decide whether each node keeps one shared copy of the full
+    # rebinned templates, or whether the processes pass redshift slices
+    # around the communicator.
+
+    node_comm = None
+    if comm is not None:
+        if shared is None:
+            if comm.rank == 0:
+                if mem_budget is None:
+                    mem_budget = node_memory() // 4
+                nbytes = sum([ template_bytes(t, binned_wavegrids(dwave,
+                    binning.get(t.template_type, 1))) for t in template_data ])
+                shared = (nbytes <= mem_budget)
+                print("Rebinned templates need {:0.1f} GB, node budget is "
+                    "{:0.1f} GB".format(nbytes / 1024**3, mem_budget / 1024**3))
+                sys.stdout.flush()
+            shared = comm.bcast(shared, root=0)
+        if shared:
+            from mpi4py import MPI
+            node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+        if comm.rank == 0:
+            if shared:
+                print("Using node-local shared memory for templates")
+            else:
+                print("Passing template redshift slices between processes")
+            sys.stdout.flush()
+
     dtemplates = list()
     #print('checkpoint load_dist_templates: start compute DistTemplates')
     #print('{} template_data entries to iterate through'.format(len(template_data)))
@@ -469,10 +812,40 @@ def load_dist_templates(dwave, templates=None, comm=None, mp_procs=1):
     for t in template_data:
         #print(len(dwave),mp_procs,comm)
         sys.stdout.flush()
-        dtemplates.append(DistTemplate(t, dwave, mp_procs=mp_procs, comm=comm))
+        dtemplates.append(DistTemplate(t, dwave, mp_procs=mp_procs, comm=comm,
+            cache_dir=cache_dir, node_comm=node_comm, nthreads=nthreads,
+            binning=binning.get(t.template_type, 1)))
     #print('checkpoint load_dist_templates: finish compute DistTemplates')
     #sys.stdout.flush()
 
+    # The node communicator is only needed to build the shared templates.
+    if node_comm is not None:
+        node_comm.Free()
+
     timer = elapsed(timer, "Rebinning templates", comm=comm)
 
     return dtemplates
+
+
+def parse_binning(value):
+    """Parse the binning factors of the redshift scan.
+
+    Args:
+        value (str): either one factor for all template types (e.g. "4"),
+            or comma-separated TYPE:factor pairs (e.g. "GALAXY:4,STAR:2").
+
+    Returns:
+        dict: the binning factor of each template type.  A single factor is
+            returned for the GALAXY, QSO and STAR types.
+
+    """
+    binning = dict()
+    if (value is None) or (value.strip() == ''):
+        return binning
+    if ':' not in value:
+        factor = int(value)
+        return { x:factor for x in ['GALAXY', 'QSO', 'STAR'] }
+    for item in value.split(','):
+        ttype, factor = item.split(':')
+        binning[ttype.strip().upper()] = int(factor)
+    return binning
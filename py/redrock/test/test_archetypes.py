@@ -0,0 +1,172 @@
+from __future__ import division, print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from astropy.io import fits
+
+from ..archetypes import (Archetype, All_archetypes, ArchetypeIndex,
+    archetype_index_file, calc_zchi2_archetypes)
+from ..zscan import spectral_data, calc_zchi2_one
+from ..templates import Template, DistTemplate
+from ..workers import create_pool
+from .. import zfind as zfind_module
+
+from . import util
+
+
+class TestArchetypes(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.archfile = os.path.join(self.testdir, 'rrarchetype-galaxy.fits')
+        #- archetypes which are random mixtures of a few smooth shapes
+        np.random.seed(1)
+        wave = np.arange(3000.0, 7000.0)
+        x = (wave - 5000.0) / 2000.0
+        shapes = np.array([ np.ones_like(x), x, x**2,
+            np.exp(-(wave - 4500.0)**2 / (2 * 20.0**2)),
+            np.exp(-(wave - 5500.0)**2 / (2 * 30.0**2)) ])
+        flux = np.random.uniform(0.1, 1.0, size=(40, len(shapes))).dot(shapes)
+        cols = [ fits.Column(name='ARCHETYPE', format='{}D'.format(len(wave)),
+                    array=flux),
+                 fits.Column(name='SUBTYPE', format='8A',
+                    array=np.array(['ARCH']*len(flux))) ]
+        hdu = fits.BinTableHDU.from_columns(cols, name='ARCHETYPES')
+        hdu.header['RRTYPE'] = 'GALAXY'
+        hdu.header['VERSION'] = 'test'
+        hdu.header['CRVAL1'] = wave[0]
+        hdu.header['CDELT1'] = 1.0
+        hdu.header['LOGLAM'] = False
+        fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(self.archfile)
+
+    def tearDown(self):
+        if os.path.exists(self.testdir):
+            shutil.rmtree(self.testdir)
+
+    def test_index_file(self):
+        """The index goes to $RR_TEMPLATE_CACHE if the directory is read-only
+        """
+        self.assertEqual(archetype_index_file(self.archfile),
+            os.path.join(self.testdir, 'rrarchetype-galaxy-index.npz'))
+        if os.getuid() == 0:
+            return
+        cache = tempfile.mkdtemp()
+        os.chmod(self.testdir, 0o555)
+        try:
+            os.environ['RR_TEMPLATE_CACHE'] = cache
+            self.assertEqual(archetype_index_file(self.archfile),
+                os.path.join(cache, 'rrarchetype-galaxy-index.npz'))
+        finally:
+            del os.environ['RR_TEMPLATE_CACHE']
+            os.chmod(self.testdir, 0o755)
+            shutil.rmtree(cache)
+
+    def test_index(self):
+        """The archetype candidates contain the best archetype"""
+        tg = util.get_target(0.2)
+        dwave = util.get_dwave(tg)
+        legendre = util.get_legendre(dwave)
+        (weights, flux, wflux) = spectral_data(tg.spectra)
+
+        full = Archetype(self.archfile)
+        ref = [ full.get_best_archetype(tg.spectra, weights, flux, wflux,
+            dwave, z, legendre) for z in [0.15, 0.2, 0.25] ]
+
+        arch = All_archetypes(archetypes_dir=self.testdir, ncandidates=5,
+            check_fraction=0.5).archetypes['GALAXY']
+        self.assertTrue(os.path.isfile(archetype_index_file(self.archfile)))
+        stats = np.zeros(3, dtype=int)
+        for z, (chi2, coeff, fulltype) in zip([0.15, 0.2, 0.25], ref):
+            res = arch.get_best_archetype(tg.spectra, weights, flux, wflux,
+                dwave, z, legendre, stats=stats)
+            self.assertEqual(res[2], fulltype)
+            np.testing.assert_allclose(res[0], chi2, rtol=1e-10)
+        nchecked = sum([ arch._check(z) for z in [0.15, 0.2, 0.25] ])
+        self.assertEqual(list(stats), [3, nchecked, 0])
+
+        #- the checks are diagnostic only: without the index the result is
+        #- the same
+        full.set_index(arch.index, 1, check_fraction=1.0)
+        stats = np.zeros(3, dtype=int)
+        res = full.get_best_archetype(tg.spectra, weights, flux, wflux,
+            dwave, 0.2, legendre, stats=stats)
+        res1 = full.get_best_archetype(tg.spectra, weights, flux, wflux,
+            dwave, 0.2, legendre)
+        self.assertEqual(res[2], res1[2])
+        np.testing.assert_allclose(res[0], res1[0])
+        self.assertEqual(list(stats[:2]), [1, 1])
+
+        #- the interpolation of a subset of the archetypes
+        rows = np.array([3, 7])
+        b = full.rebin_archetypes(0.2, dwave)
+        bs = full.rebin_archetypes(0.2, dwave, rows=rows)
+        for hs in dwave:
+            np.testing.assert_allclose(bs[hs], b[hs][rows])
+            np.testing.assert_allclose(b[hs][3],
+                full.rebin_template(3, 0.2, dwave, trapz=False)[hs])
+
+        #- the cached index is reused
+        index = ArchetypeIndex(full, cache_file=archetype_index_file(
+            self.archfile))
+        np.testing.assert_allclose(index.coords, arch.index.coords)
+
+    def test_archetype_batch(self):
+        """All archetypes are fitted together at one redshift"""
+        np.random.seed(0)
+        tg = util.get_target(0.2)
+        tg.spectra[0].ivar[:50] = 0.0
+        dwave = util.get_dwave(tg)
+        narch = 6
+        binned = { hs:np.random.uniform(0.5, 2.0, size=(narch, len(w))) \
+            for hs, w in dwave.items() }
+        legendre = util.get_legendre(dwave)
+
+        (weights, flux, wflux) = spectral_data(tg.spectra)
+        zchi2, zcoeff = calc_zchi2_archetypes(tg.spectra, weights, flux,
+            wflux, binned, legendre)
+        for i in range(narch):
+            tdata = { hs:np.append(binned[hs][i][:,None],
+                legendre[hs].T, axis=1) for hs in dwave }
+            chi2, coeff = calc_zchi2_one(tg.spectra, weights, flux, wflux,
+                tdata)
+            np.testing.assert_allclose(zchi2[i], chi2, rtol=1e-8)
+            np.testing.assert_allclose(zcoeff[i], coeff, rtol=1e-6,
+                atol=1e-10)
+
+        tg.compute_normal(collapse=True)
+        zchi2b, zcoeffb = calc_zchi2_archetypes(tg.normal, None, None, None,
+            binned, legendre)
+        np.testing.assert_allclose(zchi2b, zchi2, rtol=1e-8)
+
+    def test_zfind_threads(self):
+        """The worker threads share the archetypes of the caller"""
+        np.random.seed(0)
+        dtarg = util.fake_targets([0.2, 0.25])
+        #- as many basis vectors as archetype coefficients
+        tx = util.get_template(redshifts=np.linspace(0.16, 0.3, 50))
+        tx = Template(spectype=tx.template_type, redshifts=tx.redshifts,
+            wave=tx.wave, flux=np.vstack([tx.flux, tx.flux[1]**2]))
+        dtemp = DistTemplate(tx, dtarg.wavegrids())
+        zfit = dict()
+        for backend in ["serial", "threads"]:
+            with mock.patch.object(zfind_module, 'All_archetypes',
+                wraps=All_archetypes) as loader:
+                with create_pool(backend, 2, dtarg, [ dtemp ]) as pool:
+                    zscan, zfit[backend] = zfind_module.zfind(dtarg,
+                        [ dtemp ], archetypes=self.testdir, pool=pool)
+                self.assertEqual(loader.call_count, 1)
+        for col in ['z', 'chi2', 'spectype']:
+            self.assertTrue(np.all(zfit['serial'][col] \
+                == zfit['threads'][col]))
+
+
+def test_suite():
+    """Allows testing of only this module with the command::
+
+        python setup.py test -m <modulename>
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,109 @@
+from __future__ import division, print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+
+from ..costmodel import CostModel, grid_size, target_size, record_job
+from ..targets import DistTargetsCopy, distribute_targets
+from ..templates import DistTemplate
+from ..utils import distribute_work
+
+from . import util
+
+
+class TestCostModel(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.testfile = os.path.join(self.testdir, 'costmodel.json')
+
+    def tearDown(self):
+        if os.path.exists(self.testdir):
+            shutil.rmtree(self.testdir)
+
+    def test_fit(self):
+        """Fitting measured jobs recovers the true coefficients"""
+        true = np.array([100.0, 0.5, 2e-7, 1e-5])
+        model = CostModel()
+        rng = np.random.RandomState(0)
+        for i in range(20):
+            ntarget = rng.randint(10, 500)
+            npix = ntarget * rng.uniform(3000, 8000)
+            nhash = ntarget * rng.randint(1, 4)
+            f = model.features(npix, nhash, ntarget=ntarget, njob=1,
+                nz=rng.randint(1000, 20000))
+            model.add_sample(f, true.dot(f))
+        self.assertTrue(model.fit())
+        self.assertTrue(np.allclose(model.coeff, true, rtol=1e-4))
+
+    def test_io(self):
+        """Saved models keep the jobs measured by other runs"""
+        self.assertTrue(np.all(CostModel.load(self.testfile).coeff \
+            == CostModel.default_coeff))
+        m1 = CostModel(nz=500)
+        m1.add_sample(m1.features(1000, 1, njob=1), 10.0)
+        m1.save(self.testfile)
+        m2 = CostModel(nz=600)
+        m2.add_sample(m2.features(2000, 1, njob=1), 20.0)
+        m2.save(self.testfile)
+        m3 = CostModel.load(self.testfile)
+        self.assertEqual(m3.nz, 600)
+        self.assertEqual(len(m3.samples), 2)
+        self.assertAlmostEqual(m3.target_cost(100, 1),
+            m1.target_cost(100, 1, nz=600))
+
+    def test_record_job(self):
+        """Jobs are added to the saved model under a lock"""
+        dtarg = util.fake_targets([0.2])
+        dtemp = DistTemplate(util.get_template(), dtarg.wavegrids())
+        record_job(dtarg, [ dtemp ], 100.0, 2, path=self.testfile)
+        record_job(dtarg, [ dtemp ], 120.0, 2, path=self.testfile)
+        model = CostModel.load(self.testfile)
+        self.assertEqual(len(model.samples), 2)
+        self.assertEqual(model.nz, len(dtemp.template.redshifts))
+        self.assertEqual(model.samples[0][-1], 200.0)
+
+    def test_size(self):
+        """Loaded targets have the size predicted from their grids"""
+        tg = util.get_target(0.2)
+        grids = dict()
+        for s in tg.spectra:
+            k = (len(s.wave), float(s.wave[0]), float(s.wave[-1]))
+            grids[k] = grids.get(k, 0) + 1
+        size = grid_size(grids)
+        self.assertEqual(size, (sum([ len(s.wave) for s in tg.spectra ]), 2))
+        self.assertEqual(grid_size(grids, coadd=True)[0] * 2, size[0])
+        #- masked pixels are counted
+        tg.spectra[0].ivar[:10] = 0.0
+        self.assertEqual(target_size(tg), size)
+        tg.compute_normal(collapse=True)
+        self.assertEqual(target_size(tg), size)
+
+        #- the library balances the targets without reading a saved model
+        t1 = util.get_target(0.2); t1.id = 111
+        with mock.patch.object(CostModel, 'load',
+            side_effect=AssertionError("cost model read")):
+            dtarg = DistTargetsCopy([t1, tg])
+            self.assertEqual(sorted(dtarg.all_target_ids), [111, 123])
+
+    def test_distribute(self):
+        """Fractional weights are balanced"""
+        ids = list(range(10))
+        weights = { x:0.01 * (x + 1) for x in ids }
+        dist = distribute_work(3, ids, weights=weights)
+        self.assertEqual(len(dist), 3)
+        self.assertEqual(sorted(sum(dist, [])), ids)
+        loads = [ sum([ weights[x] for x in d ]) for d in dist ]
+        self.assertLess(max(loads), 0.25)
+
+
+def test_suite():
+    """Allows testing of only this module with the command::
+
+        python setup.py test -m <modulename>
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -74,6 +74,38 @@ class TestRebin(unittest.TestCase):
         self.assertTrue(np.allclose(yy[0:2], 2/np.pi, atol=5e-4))
         self.assertTrue(np.allclose(yy[2:4], -2/np.pi, atol=5e-4))
 
+    def test_batch(self):
+        '''Test rebinning several vectors at several redshifts'''
+        x = np.linspace(0, 10, 200)
+        y = np.array([np.sin(x), np.cos(3*x), x**2])
+        edges = np.linspace(1.0, 8.5, 37)
+        redshifts = np.array([0.0, 0.1, 0.15])
+        yy = rebin.trapz_rebin_batch(x, y, edges, redshifts)
+        self.assertEqual(yy.shape, (3, 36, 3))
+        for i, z in enumerate(redshifts):
+            for j in range(y.shape[0]):
+                ref = rebin.trapz_rebin((1+z)*x, y[j], edges=edges)
+                self.assertTrue(np.all(yy[i,:,j] == ref))
+
+        #- redshifts split among threads
+        yt = rebin.trapz_rebin_batch(x, y, edges, redshifts, nthreads=2)
+        self.assertTrue(np.all(yt == yy))
+
+        #- 2D input to trapz_rebin
+        yy = rebin.trapz_rebin(x, y, edges=edges)
+        self.assertEqual(yy.shape, (3, 36))
+        self.assertTrue(np.all(yy[1] == rebin.trapz_rebin(x, y[1],
+            edges=edges)))
+
+        #- caller provided output
+        out = np.zeros((1, 36, 3))
+        rebin.trapz_rebin_batch(x, y, edges, [0.1], out=out)
+        self.assertTrue(np.all(out[0] == rebin.trapz_rebin_batch(x, y, edges,
+            [0.1])[0]))
+
+        with self.assertRaises(ValueError):
+            rebin.trapz_rebin_batch(x, y, edges, [-0.5])
+
 
 def test_suite():
     """Allows testing of only this module with the command::
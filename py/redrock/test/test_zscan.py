@@ -8,10 +8,17 @@ from astropy.io import fits
 
 import numpy.testing as nt
 
-from ..targets import DistTargetsCopy
-from ..templates import DistTemplate
-from ..zscan import calc_zchi2_targets
+from ..targets import (Spectrum, Target, DistTargetsCopy, SharedTargetStore,
+    binned_wavehash)
+from ..templates import DistTemplate, parse_binning
+from ..zscan import (calc_zchi2_targets, calc_zchi2_one, calc_zchi2_batch,
+    calc_zchi2_normal, spectral_data, zscan_chunks, HierarchicalScan,
+    calc_zchi2_fft)
+from ..rebin import rebin_template
 from ..zfind import zfind, calc_deltachi2
+from ..fitz import fit_redshifts, minfit, minfit_batch, _refine_brent
+from ..workers import (WorkerPool, ThreadPool, LocalArray, guided_chunks,
+    backends, create_pool, default_backend)
 
 from . import util
 
@@ -31,6 +38,16 @@ def getR(n, sigma):
     return scipy.sparse.dia_matrix((data, x), shape=(n,n))
 
 
+#- Worker pool task which always fails
+def _fail_task(state):
+    raise ValueError("worker {} failed".format(state.index))
+
+
+#- Worker pool task which kills its worker process
+def _exit_task(state):
+    os._exit(1)
+
+
 class TestZScan(unittest.TestCase):
 
     @classmethod
@@ -49,9 +66,7 @@ class TestZScan(unittest.TestCase):
         print('TEST: Using random seed {}'.format(seed))
         np.random.seed(seed)
 
-        t1 = util.get_target(z1); t1.id = 111
-        t2 = util.get_target(z2); t2.id = 222
-        dtarg = DistTargetsCopy([t1, t2])
+        dtarg = util.fake_targets([z1, z2])
 
         # Get the dictionary of wavelength grids
         dwave = dtarg.wavegrids()
@@ -75,7 +90,7 @@ class TestZScan(unittest.TestCase):
 
         # Create a prior file and test it
         priorName = self._branchFiles+'/priors.fits'
-        c1 = fits.Column(name='TARGETID', array=np.array([t1.id,t2.id]), format='K')
+        c1 = fits.Column(name='TARGETID', array=np.array([111,222]), format='K')
         c2 = fits.Column(name='Z',        array=np.array([z1,z2]),       format='D')
         c3 = fits.Column(name='SIGMA',    array=np.array([0.01,0.01]),   format='D')
         t = fits.BinTableHDU.from_columns([c1, c2, c3],name='PRIORS')
@@ -107,9 +122,7 @@ class TestZScan(unittest.TestCase):
         print('TEST: Using random seed {}'.format(seed))
         np.random.seed(seed)
 
-        t1 = util.get_target(z1); t1.id = 111
-        t2 = util.get_target(z2); t2.id = 222
-        dtarg = DistTargetsCopy([t1, t2])
+        dtarg = util.fake_targets([z1, z2])
 
         # Get the dictionary of wavelength grids
         dwave = dtarg.wavegrids()
@@ -130,6 +143,451 @@ class TestZScan(unittest.TestCase):
             self.assertTrue(np.all(resa['zcoeff'] == resb['zcoeff']))
 
 
+    def test_worker_pool(self):
+        np.random.seed(0)
+        dtarg = util.fake_targets([0.2, 0.25, 0.22])
+        dwave = dtarg.wavegrids()
+
+        t_a = util.get_template(subtype='A',
+            redshifts=np.linspace(0.15, 0.3, 50))
+        t_b = util.get_template(subtype='B',
+            redshifts=np.linspace(0.1, 0.3, 40))
+        dtemps = [ DistTemplate(t_a, dwave), DistTemplate(t_b, dwave) ]
+
+        zscan_a, zfit_a = zfind(dtarg, dtemps, mp_procs=2)
+
+        #- one pool reused by several scans and fits
+        with WorkerPool(2, dtarg, dtemps) as pool:
+            tids, chunks = pool.schedule([111, 222, 333])
+            self.assertEqual(sorted(tids), [111, 222, 333])
+            self.assertEqual(chunks, [(0, 1), (1, 2), (2, 3)])
+            results = calc_zchi2_targets(dtarg, dtemps, pool=pool)
+            zscan_b, zfit_b = zfind(dtarg, dtemps, pool=pool)
+            self.assertEqual(pool.busy.shape, (2,))
+            self.assertGreater(np.sum(pool.busy), 0.0)
+
+            #- worker failures are raised in the parent
+            with self.assertRaises(RuntimeError):
+                pool.map(_fail_task, [ (), () ])
+
+        #- a worker which dies does not hang the parent
+        with WorkerPool(2, dtarg, dtemps) as pool:
+            with self.assertRaises(RuntimeError):
+                pool.map(_exit_task, [ () ])
+            self.assertEqual(pool.nproc, 0)
+
+        #- results are views of one output array per template
+        for ft in [ t_a.full_type, t_b.full_type ]:
+            self.assertIs(results[111][ft]['zcoeff'].base,
+                results[333][ft]['zcoeff'].base)
+
+        for tid in [111, 222, 333]:
+            for ft in [ t_a.full_type, t_b.full_type ]:
+                nt.assert_equal(results[tid][ft]['zchi2'],
+                    zscan_a[tid][ft]['zchi2'])
+                nt.assert_equal(zscan_b[tid][ft]['zchi2'],
+                    zscan_a[tid][ft]['zchi2'])
+        nt.assert_equal(zfit_a['z'], zfit_b['z'])
+        nt.assert_equal(zfit_a['chi2'], zfit_b['chi2'])
+
+    def test_thread_pool(self):
+        np.random.seed(0)
+        dtarg = util.fake_targets([0.2, 0.25, 0.22])
+        t1 = dtarg.local()[0]
+        dwave = dtarg.wavegrids()
+
+        template = util.get_template(redshifts=np.linspace(0.15, 0.3, 50))
+        dtemps = [ DistTemplate(template, dwave, nthreads=2) ]
+
+        zscan_a, zfit_a = zfind(dtarg, dtemps, mp_procs=2)
+        with ThreadPool(2, dtarg, dtemps) as pool:
+            zscan_b, zfit_b = zfind(dtarg, dtemps, pool=pool)
+            zscan_c, zfit_c = zfind(dtarg, dtemps, pool=pool, banded=True)
+            self.assertGreater(np.sum(pool.busy), 0.0)
+            with self.assertRaises(RuntimeError):
+                pool.map(_fail_task, [ (), () ])
+            #- the results are not put in shared memory
+            self.assertIsInstance(pool.empty((2, 3)), LocalArray)
+
+        #- the threads use the targets of this process
+        self.assertIsNotNone(t1.normal)
+
+        ft = template.full_type
+        for tid in [111, 222, 333]:
+            nt.assert_equal(zscan_b[tid][ft]['zchi2'], zscan_a[tid][ft]['zchi2'])
+            nt.assert_allclose(zscan_c[tid][ft]['zchi2'],
+                zscan_a[tid][ft]['zchi2'], rtol=1e-10)
+        nt.assert_equal(zfit_a['z'], zfit_b['z'])
+        nt.assert_allclose(zfit_a['z'], zfit_c['z'], rtol=1e-8)
+
+    def test_backends(self):
+        np.random.seed(0)
+        dtarg = util.fake_targets([0.2, 0.25])
+        dwave = dtarg.wavegrids()
+        template = util.get_template(redshifts=np.linspace(0.15, 0.3, 50))
+        dtemps = [ DistTemplate(template, dwave) ]
+
+        self.assertEqual(default_backend(mp_procs=1), "serial")
+        self.assertEqual(default_backend(mp_procs=4), "processes")
+        self.assertEqual(default_backend(mp_procs=4, nthreads=2), "threads")
+        for backend in ["gpu", "mpi"]:
+            with self.assertRaises(ValueError):
+                create_pool(backend, 2, dtarg, dtemps)
+
+        #- every backend gives the same results for the same workload
+        zfit = dict()
+        for backend in backends:
+            with create_pool(backend, 2, dtarg, dtemps) as pool:
+                zscan, zfit[backend] = zfind(dtarg, dtemps, pool=pool)
+        for backend in backends:
+            nt.assert_equal(zfit[backend]['z'], zfit['serial']['z'])
+            nt.assert_equal(zfit[backend]['chi2'], zfit['serial']['chi2'])
+
+    def test_zscan_chunks(self):
+        self.assertEqual(zscan_chunks(1000, 10, 4), [(0, 1000)])
+        chunks = zscan_chunks(1000, 1, 4, minz=10)
+        self.assertEqual(chunks, [(0, 250), (250, 500), (500, 750),
+            (750, 1000)])
+        self.assertEqual(len(zscan_chunks(1000, 3, 64, minz=10)), 22)
+        self.assertEqual(len(zscan_chunks(50, 1, 64, minz=10)), 5)
+        self.assertEqual(zscan_chunks(5, 1, 64, minz=10), [(0, 5)])
+
+    def test_redshift_split(self):
+        np.random.seed(0)
+        dtarg = util.fake_targets([0.2])
+        dwave = dtarg.wavegrids()
+        template = util.get_template(redshifts=np.linspace(0.1, 0.3, 200))
+        dtemp = DistTemplate(template, dwave)
+
+        results_a = calc_zchi2_targets(dtarg, [ dtemp ], mp_procs=1)
+        #- 1 target on 4 workers: the redshifts are split in 4 chunks
+        results_b = calc_zchi2_targets(dtarg, [ dtemp ], mp_procs=4)
+        resa = results_a[111][template.full_type]
+        resb = results_b[111][template.full_type]
+        nt.assert_equal(resa['zchi2'], resb['zchi2'])
+        nt.assert_equal(resa['zcoeff'], resb['zcoeff'])
+        nt.assert_equal(resa['penalty'], resb['penalty'])
+
+    def test_guided_chunks(self):
+        chunks = guided_chunks(100, 4)
+        self.assertEqual(chunks[0], (0, 13))
+        self.assertEqual(chunks[-1][1], 100)
+        sizes = [ b - a for a, b in chunks ]
+        self.assertEqual(sum(sizes), 100)
+        self.assertTrue(np.all(np.diff(sizes) <= 0))
+        for (a, b), (c, d) in zip(chunks[:-1], chunks[1:]):
+            self.assertEqual(b, c)
+        self.assertEqual(guided_chunks(0, 4), [])
+        self.assertEqual(min(sizes), 1)
+        sizes = [ b - a for a, b in guided_chunks(100, 4, minchunk=5) ]
+        self.assertEqual(min(sizes[:-1]), 5)
+
+    def test_batch_zchi2(self):
+        np.random.seed(0)
+        tg = util.get_target(0.2)
+        template = util.get_template()
+        dwave = util.get_dwave(tg)
+        redshifts = np.linspace(0.15, 0.3, 7)
+        binned = [ rebin_template(template, z, dwave) for z in redshifts ]
+        tdata = { k:np.array([ b[k] for b in binned ]) for k in dwave }
+
+        (weights, flux, wflux) = spectral_data(tg.spectra)
+        zchi2, zcoeff = calc_zchi2_batch(tg.spectra, weights, flux, wflux,
+            tdata)
+        for i in range(len(redshifts)):
+            chi2, coeff = calc_zchi2_one(tg.spectra, weights, flux, wflux,
+                binned[i])
+            nt.assert_allclose(zchi2[i], chi2, rtol=1e-10)
+            nt.assert_allclose(zcoeff[i], coeff, rtol=1e-8)
+
+    def test_compact_zchi2(self):
+        np.random.seed(0)
+        tg = util.get_target(0.2)
+        for s in tg.spectra:
+            s.ivar[np.random.uniform(size=len(s.ivar)) < 0.5] = 0.0
+            s.ivar[:20] = 0.0
+        template = util.get_template()
+        dwave = util.get_dwave(tg)
+        redshifts = np.linspace(0.15, 0.3, 7)
+        binned = [ rebin_template(template, z, dwave) for z in redshifts ]
+        tdata = { k:np.array([ b[k] for b in binned ]) for k in dwave }
+
+        #- only the pixels with non-zero weight are used
+        (weights, flux, wflux) = spectral_data(tg.spectra)
+        ngood = sum([ np.sum(s.ivar > 0) for s in tg.spectra ])
+        self.assertEqual(len(weights), ngood)
+        self.assertTrue(np.all(weights > 0))
+        zchi2, zcoeff = calc_zchi2_batch(tg.spectra, weights, flux, wflux,
+            tdata)
+        for i in range(len(redshifts)):
+            Tb = np.vstack([ s.Rcsr.dot(binned[i][s.wavehash]) \
+                for s in tg.spectra ])
+            w = np.concatenate([ s.ivar for s in tg.spectra ])
+            f = np.concatenate([ s.flux for s in tg.spectra ])
+            coeff = np.linalg.solve(Tb.T.dot(w[:,None] * Tb), Tb.T.dot(w * f))
+            chi2 = np.dot((f - Tb.dot(coeff))**2, w)
+            nt.assert_allclose(zchi2[i], chi2, rtol=1e-8)
+            nt.assert_allclose(zcoeff[i], coeff, rtol=1e-7)
+
+        #- the compacted resolution follows changes of the mask
+        s = tg.spectra[0]
+        s.ivar[20:30] = 1.0
+        nrow = s.Rcompact.shape[0]
+        s.ivar[20:30] = 0.0
+        self.assertEqual(s.Rcompact.shape[0], nrow - 10)
+
+    def test_fit_redshifts(self):
+        np.random.seed(0)
+        tg = util.get_target(0.2)
+        template = util.get_template()
+        dwave = util.get_dwave(tg)
+        redshifts = np.linspace(0.19, 0.21, 15)
+        zchi2, zcoeff = fit_redshifts(tg.spectra, template, redshifts)
+        (weights, flux, wflux) = spectral_data(tg.spectra)
+        for i, z in enumerate(redshifts):
+            chi2, coeff = calc_zchi2_one(tg.spectra, weights, flux, wflux,
+                rebin_template(template, z, dwave))
+            nt.assert_allclose(zchi2[i], chi2, rtol=1e-8)
+            nt.assert_allclose(zcoeff[i], coeff, rtol=1e-7)
+
+        tg.compute_normal(collapse=True)
+        zchi2b, zcoeffb = fit_redshifts(tg.normal, template, redshifts)
+        nt.assert_allclose(zchi2b, zchi2, rtol=1e-8)
+
+        #- the batched parabola fits match minfit
+        x = np.array([[0.1, 0.2, 0.3], [1.0, 1.1, 1.2], [0.0, 1.0, 2.0]])
+        y = np.array([[3.0, 1.0, 2.0], [1.0, 2.0, 4.0], [1.0, 2.0, 1.0]])
+        x0, xerr, y0, zwarn = minfit_batch(x, y)
+        for i in range(len(x)):
+            res = minfit(x[i], y[i])
+            self.assertEqual(zwarn[i], res[3])
+            if res[3] == 0:
+                nt.assert_allclose([x0[i], xerr[i], y0[i]], res[:3],
+                    rtol=1e-8)
+
+    def test_brent_fitz(self):
+        np.random.seed(0)
+        dtarg = util.fake_targets()
+        template = util.get_template(redshifts=np.linspace(0.1, 0.6, 100))
+        dtemp = DistTemplate(template, dtarg.wavegrids())
+
+        zscan_a, zfit_a = zfind(dtarg, [ dtemp ])
+        zscan_b, zfit_b = zfind(dtarg, [ dtemp ], ztol=1e-6)
+        self.assertEqual(zfit_a['zz'].shape, zfit_b['zz'].shape)
+        #- the Brent evaluations are not repeated, only padded with NaN
+        for zz in zfit_b['zz']:
+            good = zz[np.isfinite(zz)]
+            self.assertEqual(len(np.unique(good)), len(good))
+            self.assertTrue(np.all(np.isnan(zz[len(good):])))
+        zbest_a = zfit_a[zfit_a['znum'] == 0]
+        zbest_b = zfit_b[zfit_b['znum'] == 0]
+        nt.assert_allclose(zbest_a['z'], zbest_b['z'], atol=1e-5)
+        nt.assert_allclose(zbest_a['zerr'], zbest_b['zerr'], rtol=0.1)
+        nt.assert_allclose(zbest_a['chi2'], zbest_b['chi2'], rtol=1e-6)
+
+        #- _refine_brent returns only the evaluated redshifts
+        tg = dtarg.local()[0]
+        data = spectral_data(tg.spectra)
+        dwave = util.get_dwave(tg)
+        zchi2 = zscan_b[tg.id][template.full_type]['zchi2']
+        imin = np.argmin(zchi2)
+        zz, zzchi2 = _refine_brent(zchi2, template.redshifts, imin,
+            tg.spectra, template, dwave, data, 1e-6)[5:]
+        self.assertEqual(len(zz), len(zzchi2))
+        self.assertTrue(np.all(np.isfinite(zz)))
+        self.assertTrue(np.all(np.diff(zz) > 0))
+
+    def test_banded_zscan(self):
+        np.random.seed(0)
+        dtarg = util.fake_targets([0.2, 0.25])
+        dwave = dtarg.wavegrids()
+
+        template = util.get_template(redshifts=np.linspace(0.15, 0.3, 50))
+        dtemp = DistTemplate(template, dwave)
+
+        results_a = calc_zchi2_targets(dtarg, [ dtemp ], mp_procs=1)
+        results_b = calc_zchi2_targets(dtarg, [ dtemp ], mp_procs=2,
+            banded=True)
+
+        for tg in dtarg.local():
+            resa = results_a[tg.id][template.full_type]
+            resb = results_b[tg.id][template.full_type]
+            nt.assert_allclose(resa['zchi2'], resb['zchi2'], rtol=1e-10)
+            nt.assert_allclose(resa['zcoeff'], resb['zcoeff'], rtol=1e-7)
+            nt.assert_allclose(resa['penalty'], resb['penalty'], atol=1e-8)
+
+    def test_hierarchical_zscan(self):
+        np.random.seed(0)
+        dtarg = util.fake_targets([0.2, 0.25])
+        dwave = dtarg.wavegrids()
+
+        template = util.get_template(redshifts=np.linspace(0.1, 0.3, 200))
+        dtemp = DistTemplate(template, dwave)
+
+        hierarchy = HierarchicalScan(step=8, ncandidates=3)
+        results_a = calc_zchi2_targets(dtarg, [ dtemp ], mp_procs=1)
+        results_b = calc_zchi2_targets(dtarg, [ dtemp ], mp_procs=2,
+            hierarchy=hierarchy)
+
+        #- the refined redshifts do not depend on the redshift chunks of
+        #- the workers
+        for mp in [1, 4]:
+            results_c = calc_zchi2_targets(dtarg, [ dtemp ], mp_procs=mp,
+                hierarchy=hierarchy)
+            for tg in dtarg.local():
+                resb = results_b[tg.id][template.full_type]
+                resc = results_c[tg.id][template.full_type]
+                nt.assert_array_equal(resb['zchi2'] < 9e99,
+                    resc['zchi2'] < 9e99)
+                nt.assert_allclose(resb['zchi2'], resc['zchi2'], rtol=1e-10)
+
+        for tg in dtarg.local():
+            resa = results_a[tg.id][template.full_type]
+            resb = results_b[tg.id][template.full_type]
+            self.assertEqual(resa['zchi2'].shape, resb['zchi2'].shape)
+            done = resb['zchi2'] < 9e99
+            self.assertLess(np.sum(done), len(done))
+            nt.assert_allclose(resb['zchi2'][done], resa['zchi2'][done],
+                rtol=1e-10)
+            self.assertTrue(np.all(resb['zcoeff'][~done] == 0.0))
+            self.assertEqual(np.argmin(resa['zchi2']),
+                np.argmin(resb['zchi2']))
+
+        zscan_a, zfit_a = zfind(dtarg, [ dtemp ])
+        zscan_b, zfit_b = zfind(dtarg, [ dtemp ], hierarchy=hierarchy)
+        zbest_a = zfit_a[zfit_a['znum'] == 0]
+        zbest_b = zfit_b[zfit_b['znum'] == 0]
+        nt.assert_allclose(zbest_a['z'], zbest_b['z'], rtol=1e-8)
+
+        #- windows around the best minima of the decimated scan
+        hierarchy = HierarchicalScan(step=8, ncandidates=3, margin=0)
+        icoarse = hierarchy.coarse_indices(50)
+        self.assertEqual(list(icoarse), [0, 8, 16, 24, 32, 40, 48, 49])
+        chi2 = np.array([ 5, 4, 6, 1, 7, 8, 9, 3 ], dtype=float)
+        ifine = hierarchy.fine_indices(chi2, icoarse, 50)
+        self.assertEqual(list(ifine), list(range(1, 8)) \
+            + list(range(9, 16)) + list(range(17, 24)) \
+            + list(range(25, 32)) + list(range(41, 48)))
+
+    def test_fft_zscan(self):
+        np.random.seed(0)
+        template = util.get_template(redshifts=10**(np.log10(1.15) \
+            + 3e-4 * np.arange(100)) - 1)
+        wave = 10**(3.6 + 1e-4 * np.arange(3000))
+        flux = template.eval([1, 2, 3], wave, 0.2)
+        ivar = np.ones(len(wave))
+        ivar[:6] = 0.0
+        ivar[-6:] = 0.0
+        flux = flux + np.random.normal(size=len(wave))
+        R = getR(len(wave), 2.0)
+        tg = Target(111, [ Spectrum(wave, flux, ivar, R, R.tocsr()) ])
+        dtarg = DistTargetsCopy([tg])
+        dtemp = DistTemplate(template, dtarg.wavegrids())
+
+        #- with a constant resolution, the FFT scan is exact
+        zchi2, zcoeff = calc_zchi2_fft(tg.spectra, template,
+            template.redshifts)
+        (weights, flux, wflux) = spectral_data(tg.spectra)
+        zchi2b, zcoeffb = calc_zchi2_batch(tg.spectra, weights, flux, wflux,
+            dtemp.local.tdata)
+        nt.assert_allclose(zchi2, zchi2b, rtol=1e-6)
+        nt.assert_allclose(zcoeff, zcoeffb, rtol=1e-5, atol=1e-8)
+
+        results_a = calc_zchi2_targets(dtarg, [ dtemp ], mp_procs=1)
+        results_b = calc_zchi2_targets(dtarg, [ dtemp ], mp_procs=1,
+            fft=True)
+        resa = results_a[111][template.full_type]
+        resb = results_b[111][template.full_type]
+        nt.assert_allclose(resa['zchi2'], resb['zchi2'], rtol=1e-6)
+        self.assertEqual(np.argmin(resa['zchi2']), np.argmin(resb['zchi2']))
+
+        #- the resolution of every pixel is used
+        x = np.arange(-5, 6)
+        sigma = np.linspace(1.0, 3.0, len(wave))
+        kern = np.exp(-x[:,None]**2 / (2 * sigma[None,:]**2))
+        R = scipy.sparse.dia_matrix((kern / kern.sum(axis=0), x),
+            shape=(len(wave), len(wave)))
+        ivar[1000:1100] = 0.0
+        spectra = [ Spectrum(wave, tg.spectra[0].flux, ivar, R, R.tocsr()) ]
+        zchi2, zcoeff = calc_zchi2_fft(spectra, template, template.redshifts)
+        (weights, flux, wflux) = spectral_data(spectra)
+        zchi2b, zcoeffb = calc_zchi2_batch(spectra, weights, flux, wflux,
+            dtemp.local.tdata)
+        nt.assert_allclose(zchi2, zchi2b, rtol=1e-8)
+        nt.assert_allclose(zcoeff, zcoeffb, rtol=1e-6, atol=1e-8)
+
+        #- other wavelength grids and redshifts use the usual scan
+        self.assertIsNone(calc_zchi2_fft(tg.spectra, template,
+            np.linspace(0.15, 0.3, 50)))
+        tg = util.get_target(0.2)
+        self.assertIsNone(calc_zchi2_fft(tg.spectra, template,
+            template.redshifts))
+
+    def test_binned_zscan(self):
+        np.random.seed(0)
+        dtarg = util.fake_targets([0.2, 0.25])
+        dwave = dtarg.wavegrids()
+
+        template = util.get_template(redshifts=np.linspace(0.15, 0.3, 50))
+        dtemp = DistTemplate(template, dwave)
+        dtemp_b = DistTemplate(template, dwave, binning=2)
+        self.assertEqual(dtemp_b.binning, 2)
+
+        #- the binned products give the chi2 of the binned template repeated
+        #- on the full resolution grid
+        tdata_b = dtemp_b.local.tdata
+        t1 = dtarg.local()[0]
+        tfull = { k:np.repeat(tdata_b[binned_wavehash(k, 2)], 2,
+            axis=1)[:,:len(w)] for k, w in dwave.items() }
+        chi2a, coeffa = calc_zchi2_normal(t1.binned_normal(1), tfull)
+        chi2b, coeffb = calc_zchi2_normal(t1.binned_normal(2), tdata_b)
+        nt.assert_allclose(chi2a, chi2b, rtol=1e-10)
+        nt.assert_allclose(coeffa, coeffb, rtol=1e-7)
+
+        results_a = calc_zchi2_targets(dtarg, [ dtemp ], mp_procs=1)
+        results_b = calc_zchi2_targets(dtarg, [ dtemp_b ], mp_procs=2)
+        for tg in dtarg.local():
+            resa = results_a[tg.id][template.full_type]
+            resb = results_b[tg.id][template.full_type]
+            self.assertLessEqual(abs(np.argmin(resa['zchi2']) \
+                - np.argmin(resb['zchi2'])), 1)
+
+        zscan_a, zfit_a = zfind(dtarg, [ dtemp ])
+        zscan_b, zfit_b = zfind(dtarg, [ dtemp_b ])
+        zbest_a = zfit_a[zfit_a['znum'] == 0]
+        zbest_b = zfit_b[zfit_b['znum'] == 0]
+        nt.assert_allclose(zbest_a['z'], zbest_b['z'], atol=1e-5)
+
+        self.assertEqual(parse_binning('GALAXY:4, star:2'),
+            {'GALAXY':4, 'STAR':2})
+        self.assertEqual(parse_binning('3')['QSO'], 3)
+        self.assertEqual(parse_binning(None), {})
+
+    def test_collapse(self):
+        import copy
+        np.random.seed(0)
+        dtarg = util.fake_targets([0.2, 0.25])
+        dcoll = copy.deepcopy(dtarg)
+        dcoll.collapse()
+        dwave = dtarg.wavegrids()
+        self.assertEqual(sorted(dcoll.wavegrids().keys()), sorted(dwave.keys()))
+
+        template = util.get_template(redshifts=np.linspace(0.15, 0.3, 50))
+        dtemp = DistTemplate(template, dwave)
+
+        zscan_a, zfit_a = zfind(dtarg, [ dtemp ])
+        zscan_b, zfit_b = zfind(dcoll, [ dtemp ], mp_procs=2)
+
+        for tg in dcoll.local():
+            self.assertTrue(tg.collapsed)
+            self.assertEqual(len(tg.spectra), 0)
+            resa = zscan_a[tg.id][template.full_type]
+            resb = zscan_b[tg.id][template.full_type]
+            nt.assert_allclose(resa['zchi2'], resb['zchi2'], rtol=1e-10)
+        nt.assert_allclose(zfit_a['z'], zfit_b['z'], rtol=1e-8)
+        nt.assert_allclose(zfit_a['chi2'], zfit_b['chi2'], rtol=1e-10)
+        nt.assert_equal(zfit_a['npixels'], zfit_b['npixels'])
+
     def test_subtype(self):
         z1 = 0.0
         z2 = 1e-4
@@ -137,9 +595,7 @@ class TestZScan(unittest.TestCase):
         print('TEST: Using random seed {}'.format(seed))
         np.random.seed(seed)
 
-        t1 = util.get_target(z1); t1.id = 111
-        t2 = util.get_target(z2); t2.id = 222
-        dtarg = DistTargetsCopy([t1, t2])
+        dtarg = util.fake_targets([z1, z2])
 
         # Get the dictionary of wavelength grids
         dwave = dtarg.wavegrids()
@@ -161,12 +617,90 @@ class TestZScan(unittest.TestCase):
         self.assertTrue(np.all(zfit['spectype'] == 'STAR'))
 
 
+    def test_template_piece(self):
+        dwave = util.fake_targets([0.2]).wavegrids()
+        template = util.get_template()
+        dtemp = DistTemplate(template, dwave)
+        nz = len(template.redshifts)
+        for hs, b in dtemp.local.tdata.items():
+            self.assertEqual(b.shape, (nz, len(dwave[hs]), template.nbasis))
+            self.assertTrue(b.flags.c_contiguous)
+            self.assertTrue(np.shares_memory(dtemp.local.data[3][hs], b))
+            ref = rebin_template(template, template.redshifts[3],
+                {hs:dwave[hs]})[hs]
+            nt.assert_allclose(b[3], ref, rtol=1e-12, atol=1e-12)
+
+        #- close() frees the rebinned data also without shared memory
+        dtemp.close()
+        self.assertIsNone(dtemp.local)
+
+    def test_template_cache(self):
+        dtarg = util.fake_targets([0.2])
+        dwave = dtarg.wavegrids()
+        template = util.get_template(subtype='BLAT')
+        cache_dir = os.path.join(self._branchFiles, 'cache')
+
+        dref = DistTemplate(template, dwave)
+        dwrite = DistTemplate(template, dwave, cache_dir=cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), len(dwave))
+        dread = DistTemplate(template, dwave, cache_dir=cache_dir)
+
+        for i in range(len(template.redshifts)):
+            for hs in dwave:
+                ref = dref.local.data[i][hs]
+                nt.assert_equal(dwrite.local.data[i][hs], ref)
+                nt.assert_equal(dread.local.data[i][hs], ref)
+
+        #- a different redshift grid is a different cache entry
+        t2 = util.get_template(subtype='BLAT',
+            redshifts=template.redshifts[::2])
+        DistTemplate(t2, dwave, cache_dir=cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 2*len(dwave))
+
+        #- a failed write is reported, not raised
+        from ..templates import _write_template_cache
+        bad = { hs:os.path.join(cache_dir, 'missing', 'x.npy') \
+            for hs in dwave }
+        self.assertFalse(_write_template_cache(bad, dref.local.tdata, 0,
+            len(template.redshifts)))
+        self.assertEqual(len(os.listdir(cache_dir)), 2*len(dwave))
+
+    def test_target_store(self):
+        import pickle
+        t1 = util.get_target(0.0); t1.id = 111
+        t2 = util.get_target(1e-4); t2.id = 222
+        t2.compute_normal(collapse=True)
+        dtarg = DistTargetsCopy([t1, t2])
+
+        store = SharedTargetStore(dtarg.local())
+        try:
+            self.assertEqual(store.target_ids, [111, 222])
+            #- a pickled store attaches to the segments by name
+            for st in [ store, pickle.loads(pickle.dumps(store)) ]:
+                s1, s2 = st.targets([222, 111])
+                self.assertEqual((s1.id, s2.id), (222, 111))
+                self.assertTrue(s1.collapsed)
+                for a, b in zip(s1.normal, t2.normal):
+                    self.assertEqual(a.wavehash, b.wavehash)
+                    nt.assert_equal(a.A.toarray(), b.A.toarray())
+                    nt.assert_equal(a.Rtwf, b.Rtwf)
+                    self.assertEqual(a.fwf, b.fwf)
+                for a, b in zip(s2.spectra, t1.spectra):
+                    self.assertEqual(a.wavehash, b.wavehash)
+                    nt.assert_equal(a.flux, b.flux)
+                    nt.assert_equal(a.ivar, b.ivar)
+                    nt.assert_equal(a.R.toarray(), b.R.toarray())
+                    nt.assert_equal(a.Rcsr.toarray(), b.Rcsr.toarray())
+                    self.assertFalse(a.flux.flags.writeable)
+                    self.assertFalse(np.shares_memory(a.flux, b.flux))
+                self.assertEqual(s2.npixels, t1.npixels)
+        finally:
+            store.close()
+
     def test_sharedmem(self):
         z1 = 0.0
         z2 = 1e-4
-        t1 = util.get_target(z1); t1.id = 111
-        t2 = util.get_target(z2); t2.id = 222
-        dtarg = DistTargetsCopy([t1, t2])
+        dtarg = util.fake_targets([z1, z2])
 
         import copy
         dtcopy = copy.deepcopy(dtarg)
@@ -195,6 +729,47 @@ class TestZScan(unittest.TestCase):
                 soff += 1
             toff += 1
 
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'needs /proc/self/fd')
+    def test_shared_array_fds(self):
+        """SharedArrays and zfind do not leak file descriptors"""
+        import pickle
+        from ..utils import SharedArray
+
+        def nfd():
+            return len(os.listdir('/proc/self/fd'))
+
+        #- the first segment starts the multiprocessing resource tracker
+        x = SharedArray((1,))
+        x.unlink()
+        x.close()
+        start = nfd()
+        for i in range(50):
+            x = SharedArray((10, 3))
+            x.array[:] = i
+            y = pickle.loads(pickle.dumps(x))
+            self.assertEqual(y.array[0, 0], i)
+            y.close()
+            x.unlink()
+            x.close()
+        self.assertLessEqual(nfd(), start)
+
+        #- views stay valid after close and unlink
+        x = SharedArray((4,))
+        a = x.array
+        a[:] = 2.0
+        x.unlink()
+        x.close()
+        nt.assert_equal(a, 2.0)
+
+        dtarg = util.fake_targets([0.2])
+        template = util.get_template(redshifts=np.linspace(0.15, 0.3, 20))
+        dtemp = DistTemplate(template, dtarg.wavegrids())
+        zfind(dtarg, [ dtemp ])
+        start = nfd()
+        for i in range(3):
+            zfind(dtarg, [ dtemp ])
+        self.assertLessEqual(nfd(), start)
+
 
 def test_suite():
     """Allows testing of only this module with the command::
@@ -47,18 +47,34 @@ def get_target(z=0.5, wavestep=5):
     return Target(123, spectra)
 
 
-# Return a couple of fake targets
-def fake_targets():
-    t1 = get_target(0.2)
-    t1.id = 111
-    t2 = get_target(0.5)
-    t2.id = 222
+# Return fake targets at the given redshifts, with ids 111, 222, ...
+def fake_targets(redshifts=(0.2, 0.5)):
+    targets = list()
+    for i, z in enumerate(redshifts):
+        tg = get_target(z)
+        tg.id = 111 * (i + 1)
+        targets.append(tg)
     # Make a distributed targets object that just copies existing
     # targets.
-    dtarg = DistTargetsCopy([t1, t2])
+    dtarg = DistTargetsCopy(targets)
     return dtarg
 
 
+def get_dwave(target):
+    """Returns the dictionary of wavelength grids of a target
+    """
+    return { s.wavehash:s.wave for s in target.spectra }
+
+
+def get_legendre(dwave, deg=3):
+    """Returns the powers of the wavelength, scaled to [-1, 1] over all the
+    grids of dwave, as the Legendre terms of the archetype fits
+    """
+    wave = np.concatenate(list(dwave.values()))
+    return { hs:np.array([ ((w - wave.min()) / (wave.max() - wave.min()) \
+        * 2 - 1)**i for i in range(deg) ]) for hs, w in dwave.items() }
+
+
 #- Return a normalized sampled Gaussian (no integration, just sampling)
 def _norm_gauss(x, sigma):
     y = np.exp(-x**2/(2.0*sigma))
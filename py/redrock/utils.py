@@ -174,6 +174,91 @@ def mp_array(original):
     return nd
 
 
+def _shared_memory(**kwargs):
+    """Return a multiprocessing SharedMemory whose views may outlive it.
+
+    The standard class unmaps the segment when it is garbage collected, even
+    if numpy arrays still use it.  Here the mapping is only released with
+    the last array (or memoryview) which references it.  The file
+    descriptor of the segment is not needed once it is mapped, so it is
+    closed right away rather than held open for the lifetime of the views.
+    """
+    from multiprocessing import shared_memory
+
+    class _SharedMemory(shared_memory.SharedMemory):
+        def __del__(self):
+            pass
+
+    shm = _SharedMemory(**kwargs)
+    fd = getattr(shm, "_fd", -1)
+    if fd >= 0:
+        os.close(fd)
+        shm._fd = -1
+    return shm
+
+
+class SharedArray(object):
+    """A numpy array in a multiprocessing.shared_memory segment.
+
+    Only the segment name, shape and dtype are pickled, so this can be sent
+    to running processes, which attach to the segment when they access the
+    array.  The process which created the segment removes it with unlink(),
+    but arrays already returned by the array property stay valid until they
+    are deleted.
+
+    Args:
+        shape (tuple): the shape of the array.
+        dtype (numpy.dtype): the type of the array.
+
+    """
+    def __init__(self, shape, dtype=np.float64):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).str
+        nbytes = int(np.prod(self.shape)) * np.dtype(dtype).itemsize
+        self._pid = os.getpid()
+        self._shm = _shared_memory(create=True, size=max(nbytes, 1))
+        self.name = self._shm.name
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shm"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    @property
+    def array(self):
+        """The ndarray view of the segment.
+        """
+        if self._shm is None:
+            self._shm = _shared_memory(name=self.name)
+        return np.ndarray(self.shape, dtype=np.dtype(self.dtype),
+            buffer=self._shm.buf)
+
+    def close(self):
+        """Detach from the segment in this process.
+
+        The memory stays mapped while arrays returned by the array property
+        are in use.
+        """
+        self._shm = None
+        return
+
+    def unlink(self):
+        """Remove the segment, if this process created it.
+        """
+        if os.getpid() == self._pid:
+            shm = self._shm
+            if shm is None:
+                shm = _shared_memory(name=self.name)
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+        return
+
+
 def distribute_work(nproc, ids, weights=None):
     """Helper function to distribute work among processes.
 
@@ -185,7 +270,8 @@ def distribute_work(nproc, ids, weights=None):
         nproc (int): the number of processes.
         ids (list): list of IDs
         weights (dict): dictionary of weights for each ID.  If None,
-            use equal weighting.
+            use equal weighting.  The weights may be fractional, for example
+            the costs predicted by redrock.costmodel.CostModel.
 
     Returns:
         list:  A list (one element for each process) with each element
@@ -225,10 +311,16 @@ def distribute_work(nproc, ids, weights=None):
     sids = list(sorted(ids))
     wts = np.array([ weights[x] for x in sids ], dtype=np.float64)
 
-    # Compute the partitioning
+    # Compute the partitioning.  The partition search works on integer
+    # weights, so fractional weights (e.g. predicted costs in seconds) are
+    # scaled to integers first.
+
+    scale = 1.0
+    if np.any(wts != np.rint(wts)):
+        scale = 1.0e6 / np.max(wts)
 
-    max_per_proc = float(distribute_partition(wts.astype(np.int64),
-        nproc))
+    max_per_proc = float(distribute_partition(
+        np.ceil(wts * scale).astype(np.int64), nproc)) / scale
 
     if len(sids) <= nproc:
         # This is wasteful, but the best we can do is assign one target
@@ -0,0 +1,584 @@
+"""
+redrock.workers
+===============
+
+Persistent pools of workers, which run the redshift scan and fitting tasks of
+the local targets of a process.  There is one pool class per parallel
+backend: "serial", "threads" and "processes".  These only cover the work
+within one process: the distribution of the targets and templates between
+MPI processes is still done by DistTargets and DistTemplate (and the
+DESI / BOSS loaders), and with MPI every process uses its own serial or
+thread pool for its local targets.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import time
+import queue
+import traceback
+
+import numpy as np
+
+from .targets import SharedTargetStore
+
+from .utils import SharedArray
+
+# The names of the parallel backends, see create_pool().
+backends = ("serial", "threads", "processes")
+
+
+def guided_chunks(n, nproc, minchunk=1):
+    """Split a range of tasks into chunks of decreasing size.
+
+    Each chunk is a fixed fraction of the work remaining when it is taken
+    (guided self-scheduling), so that workers start with large chunks and the
+    last chunks are small enough to even out the finishing times.
+
+    Args:
+        n (int): the number of tasks.
+        nproc (int): the number of workers.
+        minchunk (int): the smallest chunk size.
+
+    Returns:
+        list: list of (first, last) ranges covering range(n).
+
+    """
+    chunks = list()
+    first = 0
+    while first < n:
+        size = max(minchunk, int(np.ceil((n - first) / (2 * nproc))))
+        last = min(n, first + size)
+        chunks.append( (first, last) )
+        first = last
+    return chunks
+
+
+class WorkerProgress(object):
+    """Queue-like object used by worker tasks to report progress.
+
+    Calling put() sends the count back to the process which submitted the
+    task.
+    """
+    def __init__(self, index, qout):
+        self._index = index
+        self._qout = qout
+
+    def put(self, count):
+        self._qout.put( ("progress", self._index, count) )
+
+
+class WorkerState(object):
+    """The data held by one worker process for its whole lifetime.
+
+    Args:
+        index (int): the index of this worker in the pool.
+        store (SharedTargetStore): the shared spectra of all targets.
+        templates (list): all DistTemplate objects.
+        qout (multiprocessing.Queue): the queue of results.
+
+    """
+    def __init__(self, index, store, templates, qout):
+        self.index = index
+        self.store = store
+        self.templates = templates
+        self.progress = WorkerProgress(index, qout)
+        # Worker tasks may store data here which is reused by later tasks.
+        self.cache = dict()
+        self._targets = dict()
+
+    def targets(self, ids):
+        """Return the Target objects for a list of target IDs.
+
+        The targets are views of the shared store, built the first time this
+        worker needs them and kept (along with anything computed from them,
+        such as the normal equation products) for later tasks.
+        """
+        missing = [ x for x in ids if x not in self._targets ]
+        if len(missing) > 0:
+            for tg in self.store.targets(missing):
+                self._targets[tg.id] = tg
+        return [ self._targets[x] for x in ids ]
+
+
+def _worker_main(index, store, templates, qin, qout):
+    """Main loop of a worker process.
+
+    Tasks are (task index, func, args) tuples, taken from the queue shared by
+    all workers until a None task stops the worker.  The result of
+    func(state, *args) is sent back with the time spent on the task.
+    """
+    state = WorkerState(index, store, templates, qout)
+
+    while True:
+        task = qin.get()
+        if task is None:
+            break
+        itask, func, args = task
+        start = time.time()
+        try:
+            result = func(state, *args)
+            qout.put( ("result", index, (itask, result,
+                time.time() - start)) )
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            lines = traceback.format_exception(exc_type, exc_value,
+                exc_traceback)
+            lines = [ "MP worker {}: {}".format(index, x) for x in lines ]
+            print("".join(lines))
+            sys.stdout.flush()
+            qout.put( ("error", index, (itask, "".join(lines),
+                time.time() - start)) )
+    return
+
+
+class LocalTargetStore(object):
+    """The Target objects of this process, for the workers of a ThreadPool.
+
+    This has the same targets() method as SharedTargetStore, but returns the
+    original objects, since threads do not need a copy.
+
+    Args:
+        targets (list): list of Target objects.
+
+    """
+    def __init__(self, targets):
+        self._targets = { tg.id:tg for tg in targets }
+
+    def targets(self, ids=None):
+        if ids is None:
+            ids = list(self._targets.keys())
+        return [ self._targets[x] for x in ids ]
+
+    def close(self):
+        return
+
+
+class LocalArray(object):
+    """A numpy array with the interface of SharedArray.
+
+    This is the output buffer of the pools whose workers run in the calling
+    process, which do not need shared memory.
+
+    Args:
+        shape (tuple): the shape of the array.
+        dtype (numpy.dtype): the type of the array.
+
+    """
+    def __init__(self, shape, dtype=np.float64):
+        self.shape = tuple(shape)
+        self.array = np.zeros(self.shape, dtype=dtype)
+
+    def close(self):
+        return
+
+    def unlink(self):
+        return
+
+
+class WorkerPool(object):
+    """A persistent pool of multiprocessing workers.
+
+    The spectra of the local targets are copied once into a
+    SharedTargetStore, which the workers read without copying, and every
+    worker is started with all templates.  These are never sent again: the
+    tasks run on the pool are small descriptors, such as the index of a
+    template and a chunk of target IDs, and the workers keep their state
+    between tasks.  The pool should therefore be created once all targets
+    and templates are loaded, and shared by the redshift scan and the
+    fitting.
+
+    Tasks are pulled by the workers from a single queue, so that a worker
+    which finishes early takes the next chunk of work.
+
+    Args:
+        nproc (int): the number of worker processes.
+        targets (DistTargets): the targets.
+        templates (list): list of DistTemplate objects.
+
+    """
+    # True if the workers use the Target objects of the calling process.
+    shared_targets = False
+
+    # The time in seconds map() waits for a result before checking that all
+    # workers are still running.
+    poll_interval = 1.0
+
+    def __init__(self, nproc, targets, templates):
+        import multiprocessing as mp
+
+        self._templates = list(templates)
+
+        for tg in targets.local():
+            tg.sharedmem_unpack()
+        self._store = SharedTargetStore(targets.local())
+
+        # The estimated cost of each target, used to schedule the most
+        # expensive targets first.
+        self._cost = { tg.id:tg.npixels for tg in targets.local() }
+
+        self._busy = np.zeros(nproc)
+
+        self._qin = mp.Queue()
+        self._qout = mp.Queue()
+        self._procs = list()
+        for i in range(nproc):
+            p = mp.Process(target=_worker_main, args=(i, self._store,
+                self._templates, self._qin, self._qout))
+            p.daemon = True
+            p.start()
+            self._procs.append(p)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # After an error, the workers may still be running tasks.
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+        return False
+
+    @property
+    def nproc(self):
+        return len(self._procs)
+
+    @property
+    def busy(self):
+        """The time in seconds each worker spent on the tasks of the last
+        call to map().
+        """
+        return self._busy
+
+    def template_index(self, dtemplate):
+        """Return the index of a DistTemplate known to the workers.
+        """
+        for i, t in enumerate(self._templates):
+            if t is dtemplate:
+                return i
+        raise ValueError("template {} was not given to the worker pool"\
+            .format(dtemplate.template.full_type))
+
+    def empty(self, shape, dtype=np.float64):
+        """Allocate an output buffer which the workers can write to.
+
+        Args:
+            shape (tuple): the shape of the array.
+            dtype (numpy.dtype): the type of the array.
+
+        Returns:
+            SharedArray: the buffer, which the caller should unlink() and
+                close() when the results are no longer needed.
+
+        """
+        return SharedArray(shape, dtype=dtype)
+
+    def schedule(self, ids):
+        """Order target IDs and split them into chunks of work.
+
+        The targets are sorted by decreasing cost and split with
+        guided_chunks().
+
+        Args:
+            ids (list): the target IDs.
+
+        Returns:
+            tuple: the list of sorted target IDs and the list of (first, last)
+                ranges of each chunk in that list.
+
+        """
+        ids = sorted(ids, key=lambda x: -self._cost[x])
+        return ids, guided_chunks(len(ids), self.nproc)
+
+    def map(self, func, tasks, progress=None):
+        """Run tasks on the workers and wait for the results.
+
+        Args:
+            func (function): module level function called as
+                func(state, *tasks[i]) for each task, where state is the
+                WorkerState of the worker which takes the task.
+            tasks (list): the tuple of arguments of each task.
+            progress (function): optional function called with the counts
+                sent by the tasks through state.progress.
+
+        Returns:
+            list: the result of each task.
+
+        """
+        for i, a in enumerate(tasks):
+            self._qin.put( (i, func, a) )
+
+        self._busy = np.zeros(self.nproc)
+        results = [ None for t in tasks ]
+        errors = list()
+        ndone = 0
+        while ndone < len(tasks):
+            try:
+                kind, w, val = self._qout.get(timeout=self.poll_interval)
+            except queue.Empty:
+                dead = [ i for i, p in enumerate(self._procs) \
+                    if not p.is_alive() ]
+                if len(dead) > 0:
+                    # A worker was killed (e.g. out of memory) and its task
+                    # will never finish.
+                    self.terminate()
+                    raise RuntimeError("worker(s) {} exited while running "
+                        "tasks".format(", ".join([ str(x) for x in dead ])))
+                continue
+            if kind == "progress":
+                if progress is not None:
+                    progress(val)
+                continue
+            itask, res, dt = val
+            self._busy[w] += dt
+            ndone += 1
+            if kind == "error":
+                errors.append(res)
+            else:
+                results[itask] = res
+
+        if len(errors) > 0:
+            raise RuntimeError("{} worker task(s) failed:\n{}".format(
+                len(errors), "\n".join(errors)))
+        return results
+
+    def print_busy(self, prefix=""):
+        """Print the busy time of the workers during the last map().
+        """
+        print("{}Worker busy time: min {:0.1f}, max {:0.1f}, mean {:0.1f} "
+            "seconds".format(prefix, np.min(self._busy), np.max(self._busy),
+            np.mean(self._busy)))
+        sys.stdout.flush()
+        return
+
+    def close(self):
+        """Stop the worker processes.
+        """
+        if len(self._procs) == 0:
+            return
+        for p in self._procs:
+            self._qin.put(None)
+        for p in self._procs:
+            p.join()
+        self._procs = list()
+        self._store.close()
+        return
+
+    def terminate(self):
+        """Kill the worker processes without waiting for their tasks.
+
+        This is used when the pool cannot be closed normally, for example
+        after a worker died.
+        """
+        for p in self._procs:
+            if p.is_alive():
+                p.terminate()
+        for p in self._procs:
+            p.join()
+        self._procs = list()
+        self._store.close()
+        return
+
+
+class ThreadPool(WorkerPool):
+    """A persistent pool of worker threads.
+
+    This is a drop-in replacement for WorkerPool, which runs the same tasks
+    in threads of the calling process.  The targets and templates are used
+    in place and the results are written to plain numpy arrays, so nothing
+    is copied, and the pool can also be used by every process of an MPI job
+    for its local targets.  Most of the time of the tasks is spent in numpy
+    (including the LAPACK solves), BLAS, scipy.sparse and numba kernels
+    which release the GIL.
+
+    BLAS is limited to one thread while tasks are running, so that the
+    threads do not oversubscribe the cores.  This needs the optional
+    threadpoolctl package; otherwise OMP_NUM_THREADS should be set to 1.
+
+    Args:
+        nthread (int): the number of worker threads.
+        targets (DistTargets): the targets.
+        templates (list): list of DistTemplate objects.
+
+    """
+    shared_targets = True
+
+    def __init__(self, nthread, targets, templates):
+        import threading
+
+        self._templates = list(templates)
+
+        for tg in targets.local():
+            tg.sharedmem_unpack()
+        self._store = LocalTargetStore(targets.local())
+        self._cost = { tg.id:tg.npixels for tg in targets.local() }
+
+        self._busy = np.zeros(nthread)
+
+        try:
+            from threadpoolctl import threadpool_limits
+            self._limits = threadpool_limits
+        except ImportError:
+            self._limits = None
+            if os.environ.get("OMP_NUM_THREADS", None) != "1":
+                print("WARNING:  threadpoolctl is not available and "
+                    "OMP_NUM_THREADS is not 1- the {} worker threads may "
+                    "oversubscribe the cores".format(nthread))
+                sys.stdout.flush()
+
+        self._qin = queue.Queue()
+        self._qout = queue.Queue()
+        self._procs = list()
+        for i in range(nthread):
+            p = threading.Thread(target=_worker_main, args=(i, self._store,
+                self._templates, self._qin, self._qout))
+            p.daemon = True
+            p.start()
+            self._procs.append(p)
+
+    def empty(self, shape, dtype=np.float64):
+        """Allocate an output buffer, see WorkerPool.empty().
+        """
+        return LocalArray(shape, dtype=dtype)
+
+    def map(self, func, tasks, progress=None):
+        """Run tasks on the threads and wait for the results.
+
+        See WorkerPool.map().
+        """
+        if self._limits is None:
+            return super(ThreadPool, self).map(func, tasks,
+                progress=progress)
+        with self._limits(limits=1, user_api="blas"):
+            return super(ThreadPool, self).map(func, tasks,
+                progress=progress)
+
+    def terminate(self):
+        """Stop the worker threads once their current tasks are done.
+
+        Threads cannot be killed, so the tasks which were not started are
+        dropped and the (daemon) threads are not waited for.
+        """
+        try:
+            while True:
+                self._qin.get_nowait()
+        except queue.Empty:
+            pass
+        for p in self._procs:
+            self._qin.put(None)
+        self._procs = list()
+        self._store.close()
+        return
+
+
+class SerialPool(WorkerPool):
+    """A pool which runs the tasks one after the other in this process.
+
+    This has the interface of WorkerPool, so that the same code runs
+    serially, for example in every process of an MPI job, or to compare the
+    other backends to.  Exceptions raised by the tasks are not caught.
+
+    Args:
+        targets (DistTargets): the targets.
+        templates (list): list of DistTemplate objects.
+
+    """
+    shared_targets = True
+
+    def __init__(self, targets, templates):
+        self._templates = list(templates)
+        for tg in targets.local():
+            tg.sharedmem_unpack()
+        self._store = LocalTargetStore(targets.local())
+        self._cost = { tg.id:tg.npixels for tg in targets.local() }
+        self._busy = np.zeros(1)
+        self._qout = queue.Queue()
+        self._procs = list()
+        self._state = WorkerState(0, self._store, self._templates,
+            self._qout)
+
+    @property
+    def nproc(self):
+        return 1
+
+    def empty(self, shape, dtype=np.float64):
+        """Allocate an output buffer, see WorkerPool.empty().
+        """
+        return LocalArray(shape, dtype=dtype)
+
+    def map(self, func, tasks, progress=None):
+        """Run tasks in this process.
+
+        See WorkerPool.map().
+        """
+        self._busy = np.zeros(1)
+        results = list()
+        for a in tasks:
+            start = time.time()
+            results.append(func(self._state, *a))
+            self._busy[0] += time.time() - start
+            while not self._qout.empty():
+                kind, w, count = self._qout.get()
+                if progress is not None:
+                    progress(count)
+        return results
+
+
+def default_backend(comm=None, mp_procs=1, nthreads=0):
+    """Choose the parallel backend of the local work of a process.
+
+    Args:
+        comm (mpi4py.MPI.Comm): (optional) the MPI communicator.
+        mp_procs (int): if not using MPI, the number of processes.
+        nthreads (int): if > 0, use this number of threads.
+
+    Returns:
+        str: "threads" if nthreads > 0, otherwise "processes" if not using
+            MPI and mp_procs > 1, otherwise "serial".
+
+    """
+    if nthreads > 0:
+        return "threads"
+    if (comm is None) and (mp_procs > 1):
+        return "processes"
+    return "serial"
+
+
+def create_pool(backend, nworker, targets, templates):
+    """Create the pool of workers of a parallel backend.
+
+    The pool should be created once all targets and templates are loaded,
+    and shared by the redshift scan and the fitting.
+
+    Args:
+        backend (str): one of "serial", "threads" or "processes".
+        nworker (int): the number of threads or processes.  Ignored by the
+            serial backend.
+        targets (DistTargets): the targets.
+        templates (list): list of DistTemplate objects.
+
+    Returns:
+        WorkerPool: the pool.
+
+    Raises:
+        ValueError: if the backend is unknown, or is "processes" with MPI.
+            There is no MPI backend: with MPI, each process runs its local
+            targets on its own serial or thread pool.
+
+    """
+    if backend == "serial":
+        return SerialPool(targets, templates)
+    elif backend == "threads":
+        return ThreadPool(nworker, targets, templates)
+    elif backend == "processes":
+        if targets.comm is not None:
+            raise ValueError("the processes backend cannot be used with MPI")
+        return WorkerPool(nworker, targets, templates)
+    elif backend == "mpi":
+        raise ValueError("there is no MPI backend: the targets and templates "
+            "are distributed between MPI processes by DistTargets and "
+            "DistTemplate, and each process uses a serial or thread pool")
+    raise ValueError("unknown parallel backend \"{}\", use one of {}"\
+        .format(backend, ", ".join(backends)))
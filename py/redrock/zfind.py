@@ -9,7 +9,6 @@ from __future__ import division, print_function
 
 import re
 import sys
-import traceback
 
 import numpy as np
 
@@ -19,7 +18,7 @@ from . import constants
 
 from .utils import elapsed
 
-from .targets import distribute_targets
+from .workers import create_pool, default_backend
 
 from .archetypes import All_archetypes
 
@@ -34,28 +33,50 @@ from .fitz import fitz, get_dv
 from .zwarning import ZWarningMask as ZW
 
 
-def _mp_fitz(chi2, target_data, t, nminima, qout, archetype):
-    """Wrapper for multiprocessing version of fitz.
+def _fit_spectra(tg):
+    """Return the spectra of a target to pass to fitz.
+
+    Collapsed targets are fit using their normal equation products.
+    """
+    if tg.collapsed:
+        return tg.normal
+    return tg.spectra
+
+
+def _mp_fitz(state, tindex, target_ids, chi2, first, nminima, archetypes,
+    ztol, archetype_opts):
+    """Worker task of fitz, run by the pool.
+
+    The chi2 of the targets are the rows first:first+len(target_ids) of the
+    buffer chi2 (see WorkerPool.empty).  The archetypes are either the
+    dictionary of Archetype objects loaded by the caller, which the workers
+    of the pools running in the calling process share, or the archetype
+    directory, which each worker process loads once.  Returns the fit
+    results and the statistics of the archetype candidate pre-selection.
     """
-    try:
-        # Unpack targets from shared memory
-        for tg in target_data:
-            tg.sharedmem_unpack()
-        results = list()
-        for i, tg in enumerate(target_data):
-            zfit = fitz(chi2[i], t.template.redshifts, tg.spectra,
-                t.template, nminima=nminima, archetype=archetype)
-            npix = 0
-            for spc in tg.spectra:
-                npix += (spc.ivar > 0.).sum()
-            results.append( (tg.id, zfit, npix) )
-        qout.put(results)
-    except:
-        exc_type, exc_value, exc_traceback = sys.exc_info()
-        lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
-        lines = [ "MP calc_zchi2: {}".format(x) for x in lines ]
-        print("".join(lines))
-        sys.stdout.flush()
+    t = state.templates[tindex]
+    archetype = None
+    if isinstance(archetypes, dict):
+        archetype = archetypes[t.template._rrtype]
+    elif archetypes:
+        key = ("archetypes", archetypes, archetype_opts)
+        if key not in state.cache:
+            ncandidates, check_fraction = archetype_opts
+            state.cache[key] = All_archetypes(archetypes_dir=archetypes,
+                ncandidates=ncandidates,
+                check_fraction=check_fraction).archetypes
+        archetype = state.cache[key][t.template._rrtype]
+    tchi2 = chi2.array
+    results = list()
+    stats = np.zeros(3, dtype=np.int64)
+    for i, tg in enumerate(state.targets(target_ids)):
+        zfit = fitz(tchi2[first+i], t.template.redshifts, _fit_spectra(tg),
+            t.template, nminima=nminima, archetype=archetype, ztol=ztol,
+            archetype_stats=stats)
+        results.append( (tg.id, zfit, tg.npixels) )
+    del tchi2
+    chi2.close()
+    return results, stats
 
 def calc_deltachi2(chi2, z, dvlimit=None):
     '''
@@ -85,7 +106,8 @@ def calc_deltachi2(chi2, z, dvlimit=None):
 
     return deltachi2
 
-def zfind(targets, templates, mp_procs=1, nminima=3, archetypes=None, priors=None, chi2_scan=None):
+def zfind(targets, templates, mp_procs=1, nminima=3, archetypes=None, priors=None, chi2_scan=None, banded=False, pool=None, hierarchy=None, fft=False, ztol=None, archetype_candidates=0,
+    archetype_check=0.1):
     """Compute all redshift fits for the local set of targets and collect.
 
     Given targets and templates distributed across a set of MPI processes,
@@ -109,6 +131,26 @@ def zfind(targets, templates, mp_procs=1, nminima=3, archetypes=None, priors=Non
             to use for final fitz choice of best chi2 vs. z minimum.
         priors (str, optional): file containing redshift priors
         chi2_scan (str, optional): file containing already computed chi2 scan
+        banded (bool, optional): use the banded normal equations in the coarse
+            redshift scan.  Passed to calc_zchi2_targets().
+        pool (WorkerPool, optional): the pool of workers used for both the
+            redshift scan and the fitting of the local targets (see
+            redrock.workers.create_pool).  If None, a pool of the default
+            backend is created for this call: mp_procs processes without MPI,
+            or serial with MPI.
+        hierarchy (HierarchicalScan, optional): scan the redshifts from
+            coarse to fine.  Passed to calc_zchi2_targets().
+        fft (bool, optional): scan the targets on log-lambda wavelength
+            grids with FFT cross-correlations.  Passed to
+            calc_zchi2_targets().
+        ztol (float, optional): refine the minima with Brent's method to this
+            redshift tolerance instead of a fixed fine grid.  Passed to
+            fitz().
+        archetype_candidates (int, optional): if > 0, only fit the best
+            candidates of an index of the archetypes (see All_archetypes).
+        archetype_check (float, optional): the fraction of the archetype
+            searches which are checked against all archetypes.  The number
+            of checks which found a different archetype is reported.
 
     Returns:
         tuple: (allresults, allzfit), where "allresults" is a dictionary of the
@@ -118,8 +160,28 @@ def zfind(targets, templates, mp_procs=1, nminima=3, archetypes=None, priors=Non
 
     """
 
+    if pool is None:
+        # Run on a pool of the default backend for this call, which is
+        # stopped even if the fits fail.
+        with create_pool(default_backend(targets.comm, mp_procs), mp_procs,
+            targets, templates) as pool:
+            return zfind(targets, templates, mp_procs=mp_procs,
+                nminima=nminima, archetypes=archetypes, priors=priors,
+                chi2_scan=chi2_scan, banded=banded, pool=pool,
+                hierarchy=hierarchy, fft=fft, ztol=ztol,
+                archetype_candidates=archetype_candidates,
+                archetype_check=archetype_check)
+
+    archetype_opts = (archetype_candidates, archetype_check)
+    task_archetypes = archetypes
     if archetypes:
-        archetypes = All_archetypes(archetypes_dir=archetypes).archetypes
+        archetypes = All_archetypes(archetypes_dir=archetypes,
+            ncandidates=archetype_candidates,
+            check_fraction=archetype_check).archetypes
+        # Workers in this process use these archetypes (which are read only)
+        # in place, worker processes load their own copy.
+        if pool.shared_targets:
+            task_archetypes = archetypes
 
     if not priors is None:
         priors = Priors(priors)
@@ -134,18 +196,13 @@ def zfind(targets, templates, mp_procs=1, nminima=3, archetypes=None, priors=Non
     elif targets.comm.rank == 0:
         am_root = True
 
-    # If we are not using MPI, our DistTargets object will have all the targets
-    # on the main process.  In that case, we would like to distribute our
-    # targets across multiprocesses.  Here we compute that distribution, if
-    # needed.
-
-    mpdist = None
-    if targets.comm is None:
-        mpdist = distribute_targets(targets.local(), mp_procs)
+    # The local targets of this process are distributed across the pool of
+    # workers, which is used for all templates.
 
     # Compute the coarse-binned chi2 for all local targets.
     if chi2_scan is None:
-        results = calc_zchi2_targets(targets, templates, mp_procs=mp_procs)
+        results = calc_zchi2_targets(targets, templates, mp_procs=mp_procs,
+            banded=banded, pool=pool, hierarchy=hierarchy, fft=fft)
     else:
         results = read_zscan_redrock(chi2_scan)
 
@@ -161,10 +218,6 @@ def zfind(targets, templates, mp_procs=1, nminima=3, archetypes=None, priors=Non
     sort = np.array([ t.template.full_type for t in templates]).argsort()
     for t in np.array(list(templates))[sort]:
         ft = t.template.full_type
-        if archetypes:
-            archetype = archetypes[t.template._rrtype]
-        else:
-            archetype = None
 
         if am_root:
             print("  Finding best fits for template {}"\
@@ -173,56 +226,47 @@ def zfind(targets, templates, mp_procs=1, nminima=3, archetypes=None, priors=Non
 
         start = elapsed(None, "", comm=t.comm)
 
-        # Here we have another parallelization choice between MPI and
-        # multiprocessing.
-
-        if targets.comm is not None:
-            # MPI case.  Every process just works with its local targets.
-            for tg in targets.local():
-                zfit = fitz(results[tg.id][ft]['zchi2'] \
-                    + results[tg.id][ft]['penalty'],
-                    t.template.redshifts, tg.spectra,
-                    t.template, nminima=nminima,archetype=archetype)
-                results[tg.id][ft]['zfit'] = zfit
-                results[tg.id][ft]['zfit']['npixels'] = 0
-                for spectrum in tg.spectra:
-                    results[tg.id][ft]['zfit']['npixels'] += \
-                        (spectrum.ivar>0.).sum()
-
-        else:
-            # Multiprocessing case.
-            import multiprocessing as mp
-
-            # Ensure that all targets are packed into shared memory
-            for tg in targets.local():
-                tg.sharedmem_pack()
-
-            qout = mp.Queue()
-
-            procs = list()
-            for i in range(mp_procs):
-                if len(mpdist[i]) == 0:
-                    continue
-                target_data = [ x for x in targets.local() if x.id in mpdist[i] ]
-                eff_chi2 = np.zeros((len(target_data),
-                    len(t.template.redshifts)), dtype=np.float64)
-
-                for i, tg in enumerate(target_data):
-                    eff_chi2[i,:] = results[tg.id][ft]['zchi2'] \
-                        + results[tg.id][ft]['penalty']
-                p = mp.Process(target=_mp_fitz, args=(eff_chi2,
-                    target_data, t, nminima, qout, archetype))
-                procs.append(p)
-                p.start()
-
-            # Extract the output
-            for i in range(mp_procs):
-                if len(mpdist[i]) == 0:
-                    continue
-                res = qout.get()
-                for rs in res:
-                    results[rs[0]][ft]['zfit'] = rs[1]
-                    results[rs[0]][ft]['zfit']['npixels'] = rs[2]
+        # The chi2 of all local targets are placed in a buffer of the pool
+        # (shared memory for worker processes), and the workers take chunks
+        # of targets from a queue.
+        tindex = pool.template_index(t)
+        tids, chunks = pool.schedule(targets.local_target_ids())
+        chi2 = pool.empty((len(tids), len(t.template.redshifts)))
+        try:
+            eff_chi2 = chi2.array
+            for j, tid in enumerate(tids):
+                eff_chi2[j,:] = results[tid][ft]['zchi2'] \
+                    + results[tid][ft]['penalty']
+            del eff_chi2
+            tasks = [ (tindex, tids[first:last], chi2, first, nminima,
+                task_archetypes, ztol, archetype_opts) \
+                for first, last in chunks ]
+            res = pool.map(_mp_fitz, tasks)
+        finally:
+            chi2.unlink()
+            chi2.close()
+        if am_root:
+            pool.print_busy("    ")
+
+        # Extract the output
+        archstats = np.zeros(3, dtype=np.int64)
+        for rlist, stats in res:
+            archstats += stats
+            for rs in rlist:
+                results[rs[0]][ft]['zfit'] = rs[1]
+                results[rs[0]][ft]['zfit']['npixels'] = rs[2]
+
+        # Report how often the archetype candidates missed the best one
+        if archetypes and (archetype_candidates > 0):
+            if targets.comm is not None:
+                archstats = targets.comm.reduce(archstats, root=0)
+            if am_root and (archstats[0] > 0):
+                frac = archstats[2] / max(archstats[1], 1)
+                print("    Archetype candidates: {} searches, {} checked "
+                    "with all archetypes, {} ({:0.1f}%) would pick a "
+                    "different archetype".format(archstats[0], archstats[1],
+                    archstats[2], 100.0 * frac))
+                sys.stdout.flush()
 
         elapsed(start, "    Finished in", comm=t.comm)
 
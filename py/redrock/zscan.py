@@ -8,12 +8,23 @@ Algorithms for scanning redshifts.
 from __future__ import division, print_function
 
 import sys
-import traceback
 import numpy as np
 
+from scipy.fft import next_fast_len
+
+from . import constants
+
 from .utils import elapsed
 
-from .targets import distribute_targets
+from .targets import NormalSpectrum, normal_spectra
+
+from .rebin import trapz_rebin_batch, centers2edges
+
+from .workers import create_pool, default_backend
+
+# Number of redshifts solved together by calc_zchi2_batch().  This bounds the
+# size of the (nz, npix, nbasis) temporary arrays.
+_zbatch = 128
 
 def _zchi2_one(Tb, weights, flux, wflux, zcoeff):
     """Calculate a single chi2.
@@ -39,19 +50,25 @@ def _zchi2_one(Tb, weights, flux, wflux, zcoeff):
 def spectral_data(spectra):
     """Compute concatenated spectral data products.
 
-    This helper function builds full length array quantities needed for the
-    chi2 fit.
+    This helper function builds the array quantities needed for the chi2
+    fit.  Only the pixels with non-zero weight are kept, in the order of the
+    rows of Spectrum.Rcompact.
 
     Args:
         spectra (list): list of Spectrum objects.
 
     Returns:
         tuple: (weights, flux, wflux) concatenated values used for single
-            redshift chi^2 fits.
+            redshift chi^2 fits.  These are all None for a list of
+            NormalSpectrum objects.
 
     """
-    weights = np.concatenate([ s.ivar for s in spectra ])
-    flux = np.concatenate([ s.flux for s in spectra ])
+    if len(spectra) > 0 and isinstance(spectra[0], NormalSpectrum):
+        # The normal equation products already contain the weighted data.
+        return (None, None, None)
+    good = [ s.ivar > 0 for s in spectra ]
+    weights = np.concatenate([ s.ivar[g] for s, g in zip(spectra, good) ])
+    flux = np.concatenate([ s.flux[g] for s, g in zip(spectra, good) ])
     wflux = weights * flux
     return (weights, flux, wflux)
 
@@ -63,8 +80,10 @@ def calc_zchi2_one(spectra, weights, flux, wflux, tdata):
     data that is already on the correct grid.
 
     Args:
-        spectra (list): list of Spectrum objects.
-        weights (array): concatenated spectral weights (ivar).
+        spectra (list): list of Spectrum objects, or list of NormalSpectrum
+            objects of a collapsed target.
+        weights (array): concatenated spectral weights (ivar) of the pixels
+            with non-zero weight (see spectral_data).
         flux (array): concatenated flux values.
         wflux (array): concatenated weighted flux values.
         tdata (dict): dictionary of interpolated template values for each
@@ -74,6 +93,11 @@ def calc_zchi2_one(spectra, weights, flux, wflux, tdata):
         tuple: chi^2 and coefficients.
 
     """
+    if isinstance(spectra[0], NormalSpectrum):
+        zchi2, zcoeff = calc_zchi2_normal(spectra,
+            { k:v[None,:,:] for k, v in tdata.items() })
+        return zchi2[0], zcoeff[0]
+
     Tb = list()
     nbasis = None
     for s in spectra:
@@ -81,7 +105,7 @@ def calc_zchi2_one(spectra, weights, flux, wflux, tdata):
         if nbasis is None:
             nbasis = tdata[key].shape[1]
             #print("using ",nbasis," basis vectors", flush=True)
-        Tb.append(s.Rcsr.dot(tdata[key]))
+        Tb.append(s.Rcompact.dot(tdata[key]))
     Tb = np.vstack(Tb)
     zcoeff = np.zeros(nbasis, dtype=np.float64)
     zchi2 = _zchi2_one(Tb, weights, flux, wflux, zcoeff)
@@ -89,7 +113,353 @@ def calc_zchi2_one(spectra, weights, flux, wflux, tdata):
     return zchi2, zcoeff
 
 
-def calc_zchi2(target_ids, target_data, dtemplate, progress=None):
+def _zchi2_batch(M, y, fwf, zchi2, zcoeff):
+    """Solve a stack of normal equations and compute the chi2 values.
+
+    For every redshift, solve M[i] c = y[i] for the template coefficients and
+    compute chi2 = f.W.f - y[i].c.  This is equal to the chi2 of the best fit
+    model, without ever building the model.  Redshifts with a singular normal
+    matrix get a chi2 of 9e99 and zero coefficients.
+
+    Args:
+        M (array): the (nz, nbasis, nbasis) normal matrices.
+        y (array): the (nz, nbasis) right hand sides.
+        fwf (float): the weighted sum of the squared flux.
+        zchi2 (array): the (nz,) output chi2 values.
+        zcoeff (array): the (nz, nbasis) output coefficients.
+
+    """
+    bad = np.zeros(len(M), dtype=bool)
+    try:
+        zcoeff[:] = np.linalg.solve(M, y[:,:,None])[:,:,0]
+    except np.linalg.LinAlgError:
+        # At least one matrix is singular, fall back to solving one by one.
+        for i in range(len(M)):
+            try:
+                zcoeff[i] = np.linalg.solve(M[i], y[i])
+            except np.linalg.LinAlgError:
+                zcoeff[i] = 0.0
+                bad[i] = True
+
+    zchi2[:] = fwf - np.sum(y * zcoeff, axis=1)
+    zchi2[bad] = 9e99
+
+    return
+
+
+def calc_zchi2_batch(spectra, weights, flux, wflux, tdata):
+    """Calculate the chi2 for a set of redshifts at once.
+
+    For a set of spectra and templates already rebinned to several redshifts,
+    build the stacked normal equations and solve them together.  The normal
+    matrix of each redshift is built from contiguous per-redshift products,
+    which use BLAS, and the chi2 is computed from the solution without
+    building the model (see _zchi2_batch).
+
+    Args:
+        spectra (list): list of Spectrum objects.
+        weights (array): concatenated spectral weights (ivar) of the pixels
+            with non-zero weight (see spectral_data).
+        flux (array): concatenated flux values.
+        wflux (array): concatenated weighted flux values.
+        tdata (dict): dictionary of (nz, nwave, nbasis) arrays of interpolated
+            template values for each wavehash.
+
+    Returns:
+        tuple: (zchi2, zcoeff) arrays of chi^2 and coefficients for every
+            redshift.
+
+    """
+    nz, _, nbasis = tdata[spectra[0].wavehash].shape
+
+    # With the square root of the weights folded into the templates, M is
+    # Tw^T Tw, for which BLAS uses a symmetric rank-k update.
+    sqrtw = np.sqrt(weights)
+    sqrtwf = sqrtw * flux
+    M = np.zeros((nz, nbasis, nbasis), dtype=np.float64)
+    y = np.zeros((nz, nbasis), dtype=np.float64)
+    for i in range(nz):
+        Tw = np.vstack([ s.Rcompact.dot(tdata[s.wavehash][i]) \
+            for s in spectra ])
+        Tw *= sqrtw[:,None]
+        M[i] = Tw.T.dot(Tw)
+        y[i] = Tw.T.dot(sqrtwf)
+    fwf = np.dot(flux, wflux)
+
+    zchi2 = np.zeros(nz, dtype=np.float64)
+    zcoeff = np.zeros((nz, nbasis), dtype=np.float64)
+    _zchi2_batch(M, y, fwf, zchi2, zcoeff)
+
+    return zchi2, zcoeff
+
+
+def calc_zchi2_normal(normal, tdata):
+    """Calculate the chi2 for a set of redshifts from the normal equations.
+
+    This is the banded version of calc_zchi2_batch().  Rather than applying
+    the resolution matrix of every spectrum to the templates at every
+    redshift, the precomputed operators A = R^T W R and vectors R^T W f of
+    each wavelength grid are used, so that M(z) = T(z)^T A T(z) and
+    y(z) = T(z)^T R^T W f are built with one banded times dense product per
+    redshift and wavelength grid, whatever the number of exposures.
+
+    Args:
+        normal (list): list of NormalSpectrum objects.
+        tdata (dict): dictionary of (nz, nwave, nbasis) arrays of interpolated
+            template values for each wavehash.
+
+    Returns:
+        tuple: (zchi2, zcoeff) arrays of chi^2 and coefficients for every
+            redshift.
+
+    """
+    nz, _, nbasis = tdata[normal[0].wavehash].shape
+    M = np.zeros((nz, nbasis, nbasis), dtype=np.float64)
+    y = np.zeros((nz, nbasis), dtype=np.float64)
+    fwf = 0.0
+    for ns in normal:
+        T = tdata[ns.wavehash]
+        for i in range(nz):
+            M[i] += T[i].T.dot(ns.A.dot(T[i]))
+            y[i] += T[i].T.dot(ns.Rtwf)
+        fwf += ns.fwf
+
+    zchi2 = np.zeros(nz, dtype=np.float64)
+    zcoeff = np.zeros((nz, nbasis), dtype=np.float64)
+    _zchi2_batch(M, y, fwf, zchi2, zcoeff)
+
+    return zchi2, zcoeff
+
+
+# Largest distance of the redshift shifts of the FFT scan from whole pixels.
+_fft_shift_tol = 1.0e-3
+
+def _fft_template(template, wave, redshifts):
+    """Rebin a template for the FFT scan of one log-lambda wavelength grid.
+
+    For a grid with a constant step in log10(wavelength), and redshifts
+    whose log10(1+z) differ by whole pixels, the template rebinned at
+    redshift z is a shift of one template rebinned on an extended rest
+    frame grid.
+
+    Args:
+        template (Template): the template.
+        wave (array): the log-lambda wavelength grid.
+        redshifts (array): the redshifts to scan.
+
+    Returns:
+        tuple: (Tlog, m) with the (next, nbasis) rebinned template
+            and the offset in the extended grid for each redshift, or None
+            if the grid or the redshifts are not suitable.
+
+    """
+    n = len(wave)
+    if (n < 2) or (len(redshifts) == 0):
+        return None
+    loglam = np.log10(wave)
+    dl = (loglam[-1] - loglam[0]) / (n - 1)
+    if (dl <= 0) or not np.allclose(np.diff(loglam), dl, rtol=1e-6, atol=0):
+        return None
+
+    k = np.log10(1.0 + np.asarray(redshifts)) / dl
+    kint = np.rint(k - k[0])
+    if np.max(np.abs(k - k[0] - kint)) > _fft_shift_tol:
+        return None
+    kint = kint.astype(np.int64)
+
+    # The Lyman absorption applied to the templates is not a shift.
+    maxline = max([ x['line'] for x in constants.Lyman_series.values() ])
+    if wave[0] / (1.0 + np.max(redshifts)) < maxline:
+        return None
+
+    # Pixel i of the spectrum at the redshift of shift kint is pixel
+    # i - kint + kmax of the extended grid.
+    kmin, kmax = kint.min(), kint.max()
+    next = n + kmax - kmin
+    jj = np.arange(next)
+    centers = 10**(loglam[0] - (k[0] + kmax) * dl + jj * dl)
+    try:
+        Tlog = trapz_rebin_batch(template.wave, template.flux,
+            centers2edges(centers), [0.0])[0]
+    except ValueError:
+        return None
+    return Tlog, kmax - kint
+
+
+def calc_zchi2_fft(spectra, template, redshifts, cache=None):
+    """Calculate the chi2 at all redshifts with FFT cross-correlations.
+
+    For spectra on log-lambda grids (e.g. BOSS coadds) and redshifts spaced
+    by whole pixels in log10(1+z), the rebinned templates are shifts
+    T(z)[i] = Tlog[i+m(z)] of a single rebinned template.  With the normal
+    equation products A = R^T W R and R^T W f of each wavelength grid (see
+    redrock.targets.normal_spectra), the normal equations
+
+        y(z)_b = sum_i (R^T W f)[i] Tlog[i+m, b]
+        M(z)_bc = sum_d sum_i A[i, i+d] Tlog[i+m, b] Tlog[i+d+m, c]
+
+    are cross-correlations of the data with the template (and with the
+    products of the shifted template for each diagonal d of A), which are
+    computed for all redshifts at once with FFTs.  The resolution of every
+    pixel is used, so the chi2 are those of calc_zchi2_batch() up to
+    floating point errors.
+
+    Args:
+        spectra (list): list of Spectrum objects.
+        template (Template): the template.
+        redshifts (array): the redshifts.
+        cache (dict): optional dictionary of the rebinned templates of each
+            wavelength grid, shared by the calls for the same redshifts.
+
+    Returns:
+        tuple: (zchi2, zcoeff) arrays of chi^2 and coefficients for every
+            redshift, or None if the spectra or the redshifts are not
+            suitable for the FFT scan.
+
+    """
+    if cache is None:
+        cache = dict()
+    nz = len(redshifts)
+    nbasis = template.nbasis
+    iu, ju = np.triu_indices(nbasis)
+
+    M = np.zeros((nz, nbasis, nbasis))
+    y = np.zeros((nz, nbasis))
+    fwf = 0.0
+    for ns in normal_spectra(spectra):
+        if ns.wavehash not in cache:
+            cache[ns.wavehash] = _fft_template(template, ns.wave, redshifts)
+        if cache[ns.wavehash] is None:
+            return None
+        Tlog, m = cache[ns.wavehash]
+        next = len(Tlog)
+        n = ns.nwave
+
+        # c(m) = sum_i h[i] g[i+m] = irfft(conj(rfft(h)) rfft(g))[m]
+        L = next_fast_len(next)
+        hy = np.conj(np.fft.rfft(ns.Rtwf, L))
+        gy = np.fft.rfft(Tlog.T, L, axis=1)
+        y += np.fft.irfft(hy * gy, L, axis=1)[:,m].T
+
+        # The cross-correlations of the diagonals of A are summed in Fourier
+        # space, so that there is one inverse transform per pair of basis
+        # vectors.
+        A = ns.A.tocoo()
+        band = 0
+        if A.nnz > 0:
+            band = int(np.max(np.abs(A.col - A.row)))
+        Mf = np.zeros((len(iu), L//2 + 1), dtype=np.complex128)
+        for d in range(-band, band + 1):
+            a = np.zeros(n)
+            Td = np.zeros_like(Tlog)
+            if d >= 0:
+                a[:n-d] = ns.A.diagonal(d)
+                Td[:next-d] = Tlog[d:]
+            else:
+                a[-d:] = ns.A.diagonal(d)
+                Td[-d:] = Tlog[:next+d]
+            gm = np.fft.rfft(Tlog.T[iu] * Td.T[ju], L, axis=1)
+            Mf += np.conj(np.fft.rfft(a, L)) * gm
+        M[:,iu,ju] += np.fft.irfft(Mf, L, axis=1)[:,m].T
+        fwf += ns.fwf
+    M[:,ju,iu] = M[:,iu,ju]
+
+    zchi2 = np.zeros(nz, dtype=np.float64)
+    zcoeff = np.zeros((nz, nbasis), dtype=np.float64)
+    _zchi2_batch(M, y, fwf, zchi2, zcoeff)
+
+    return zchi2, zcoeff
+
+
+class HierarchicalScan(object):
+    """Options of the hierarchical (coarse-to-fine) redshift scan.
+
+    The chi2 is first computed at every "step"-th redshift of the grid.  The
+    full grid is then only computed in windows of +/- (margin + 1) * step
+    redshifts around the "ncandidates" lowest minima of this decimated scan.
+    The skipped redshifts keep the grid and the layout of the results: their
+    chi2 is set to 9e99, as for redshifts with a singular fit, and their
+    coefficients to zero.
+
+    Args:
+        step (int): the decimation factor of the first pass.
+        ncandidates (int): the number of minima of the first pass which are
+            refined on the full grid.
+        margin (int): the number of extra decimated steps on each side of
+            the windows.
+
+    """
+    def __init__(self, step=8, ncandidates=5, margin=1):
+        self.step = int(step)
+        self.ncandidates = int(ncandidates)
+        self.margin = int(margin)
+
+    def coarse_indices(self, nz):
+        """Return the indices of the redshifts of the first pass.
+
+        Args:
+            nz (int): the number of redshifts.
+
+        Returns:
+            array: every step-th index and the last one.
+
+        """
+        if nz == 0:
+            return np.zeros(0, dtype=int)
+        return np.unique(np.r_[np.arange(0, nz, self.step), nz-1])
+
+    def fine_indices(self, chi2, icoarse, nz):
+        """Return the indices of the redshifts of the second pass.
+
+        Args:
+            chi2 (array): the chi2 (including any penalty) of the first pass.
+            icoarse (array): the indices of the first pass.
+            nz (int): the number of redshifts.
+
+        Returns:
+            array: the sorted indices in the windows around the best minima
+                of chi2, excluding those of the first pass.
+
+        """
+        x = np.asarray(chi2)
+        imin = np.where(np.r_[True, x[1:] <= x[:-1]] \
+            & np.r_[x[:-1] <= x[1:], True])[0]
+        imin = imin[np.argsort(x[imin], kind="stable")][:self.ncandidates]
+        half = (self.margin + 1) * self.step
+        keep = np.zeros(nz, dtype=bool)
+        for i in icoarse[imin]:
+            keep[max(0, i - half):min(nz, i + half + 1)] = True
+        keep[icoarse] = False
+        return np.where(keep)[0]
+
+
+def _calc_zchi2_indices(tg, normal, data, tdata, zchi2, zcoeff, iz=None):
+    """Compute the chi2 of one target at some of the local redshifts.
+
+    The normal equation products are used if normal is not None, otherwise
+    the spectra of the target and their data.  The redshifts iz (default all)
+    are solved in blocks of _zbatch redshifts to bound the memory use, and
+    the results are written to zchi2[iz] and zcoeff[iz].
+    """
+    nz = len(zchi2) if iz is None else len(iz)
+    for first in range(0, nz, _zbatch):
+        last = min(first + _zbatch, nz)
+        if iz is None:
+            sel = slice(first, last)
+        else:
+            sel = iz[first:last]
+        tblock = { k:v[sel] for k, v in tdata.items() }
+        if normal is not None:
+            zchi2[sel], zcoeff[sel] = calc_zchi2_normal(normal, tblock)
+        else:
+            (weights, flux, wflux) = data
+            zchi2[sel], zcoeff[sel] = calc_zchi2_batch(tg.spectra, weights,
+                flux, wflux, tblock)
+    return
+
+
+def calc_zchi2(target_ids, target_data, dtemplate, progress=None,
+    banded=False, out=None, zrange=None, zmask=None, fft=False):
     """Calculate chi2 vs. redshift for a given PCA template.
 
     Args:
@@ -98,46 +468,99 @@ def calc_zchi2(target_ids, target_data, dtemplate, progress=None):
         dtemplate (DistTemplate): distributed template data
         progress (multiprocessing.Queue): optional queue for tracking
             progress, only used if MPI is disabled.
+        banded (bool): if True, use the normal equation products of each
+            target (see Target.compute_normal) rather than applying the
+            resolution matrices at every redshift.  Collapsed targets always
+            use the normal equation products.
+        out (tuple): optional (zchi2, zcoeff, zchi2penalty) arrays with the
+            shapes described below, which are filled and returned.
+        zrange (tuple): optional (first, last) range of the local redshifts
+            to scan.  Default is all local redshifts.
+        zmask (array): optional (ntargets, nz) boolean array of the
+            redshifts to compute for each target.  The chi2 of the others is
+            set to 9e99 and their coefficients to zero.  Default is to
+            compute all redshifts.
+        fft (bool): if True, use calc_zchi2_fft() for the targets whose
+            spectra and redshifts are suitable, and the other methods for
+            the rest.  Not used for a binned template (see
+            DistTemplate.binning), which always uses the binned normal
+            equation products of the targets.
 
     Returns:
         tuple: (zchi2, zcoeff, zchi2penalty) with:
             - zchi2[ntargets, nz]: array with one element per target per
-                redshift
+                redshift (nz is the size of zrange, if given)
             - zcoeff[ntargets, nz, ncoeff]: array of best fit template
                 coefficients for each target at each redshift
             - zchi2penalty[ntargets, nz]: array of penalty priors per target
                 and redshift, e.g. to penalize unphysical fits
 
     """
-    nz = len(dtemplate.local.redshifts)
+    if zrange is None:
+        zrange = (0, len(dtemplate.local.redshifts))
+    nz = zrange[1] - zrange[0]
     ntargets = len(target_ids)
     nbasis = dtemplate.template.nbasis
 
-    zchi2 = np.zeros( (ntargets, nz) )
-    zchi2penalty = np.zeros( (ntargets, nz) )
-    zcoeff = np.zeros( (ntargets, nz, nbasis) )
+    if out is None:
+        zchi2 = np.zeros( (ntargets, nz) )
+        zchi2penalty = np.zeros( (ntargets, nz) )
+        zcoeff = np.zeros( (ntargets, nz, nbasis) )
+    else:
+        zchi2, zcoeff, zchi2penalty = out
+        zchi2penalty[:] = 0.0
 
     # Redshifts near [OII]; used only for galaxy templates
     if dtemplate.template.template_type == 'GALAXY':
         isOII = (3724 <= dtemplate.template.wave) & \
             (dtemplate.template.wave <= 3733)
         OIItemplate = dtemplate.template.flux[:,isOII].T
+        OIIsum = OIItemplate.sum(axis=0)
 
-    for j in range(ntargets):
-        (weights, flux, wflux) = spectral_data(target_data[j].spectra)
+    # The pre-interpolated (nz, nwave, nbasis) templates for each unique
+    # wavelength range.
+    tdata = { k:v[zrange[0]:zrange[1]] \
+        for k, v in dtemplate.local.tdata.items() }
+    redshifts = dtemplate.local.redshifts[zrange[0]:zrange[1]]
+    fftcache = dict()
+
+    binning = dtemplate.binning
 
-        # Loop over redshifts, solving for template fit
-        # coefficients.  We use the pre-interpolated templates for each
-        # unique wavelength range.
-        for i, _ in enumerate(dtemplate.local.redshifts):
-            zchi2[j,i], zcoeff[j,i] = calc_zchi2_one(target_data[j].spectra,
-                weights, flux, wflux, dtemplate.local.data[i])
+    for j in range(ntargets):
+        tg = target_data[j]
+        fftresult = None
+        if fft and (binning <= 1) and not tg.collapsed:
+            fftresult = calc_zchi2_fft(tg.spectra, dtemplate.template,
+                redshifts, cache=fftcache)
+        normal = None
+        data = None
+        if fftresult is not None:
+            pass
+        elif banded or tg.collapsed or (binning > 1):
+            normal = tg.binned_normal(binning)
+        else:
+            data = spectral_data(tg.spectra)
+
+        # Solve for the template fit coefficients at all redshifts, or only
+        # at the selected ones.
+        if fftresult is not None:
+            zchi2[j], zcoeff[j] = fftresult
+            if zmask is not None:
+                zchi2[j,~zmask[j]] = 9e99
+                zcoeff[j,~zmask[j]] = 0.0
+        elif zmask is None:
+            _calc_zchi2_indices(tg, normal, data, tdata, zchi2[j],
+                zcoeff[j])
+        else:
+            zchi2[j] = 9e99
+            zcoeff[j] = 0.0
+            _calc_zchi2_indices(tg, normal, data, tdata, zchi2[j],
+                zcoeff[j], iz=np.where(zmask[j])[0])
 
-            #- Penalize chi2 for negative [OII] flux; ad-hoc
-            if dtemplate.template.template_type == 'GALAXY':
-                OIIflux = np.sum( OIItemplate.dot(zcoeff[j,i]) )
-                if OIIflux < 0:
-                    zchi2penalty[j,i] = -OIIflux
+        #- Penalize chi2 for negative [OII] flux; ad-hoc
+        if dtemplate.template.template_type == 'GALAXY':
+            OIIflux = zcoeff[j].dot(OIIsum)
+            zchi2penalty[j] = np.where(OIIflux < 0, -OIIflux, 0.0)
 
         if dtemplate.comm is None:
             progress.put(1)
@@ -145,25 +568,229 @@ def calc_zchi2(target_ids, target_data, dtemplate, progress=None):
     return zchi2, zcoeff, zchi2penalty
 
 
-def _mp_calc_zchi2(indx, target_ids, target_data, t, qout, qprog):
-    """Wrapper for multiprocessing version of calc_zchi2.
+def _mp_calc_zchi2(state, tindex, banded, zmask, fft, target_ids, out,
+    first, zrange):
+    """Worker task of calc_zchi2, run by the pool.
+
+    The results for the targets are written to rows
+    first:first+len(target_ids) and the columns in zrange of the output
+    buffers (see WorkerPool.empty).
     """
+    last = first + len(target_ids)
+    zfirst, zlast = zrange
+    calc_zchi2(target_ids, state.targets(target_ids),
+        state.templates[tindex], progress=state.progress, banded=banded,
+        out=[ x.array[first:last,zfirst:zlast] for x in out ], zrange=zrange,
+        zmask=zmask, fft=fft)
+    for x in out:
+        x.close()
+    return
+
+
+def zscan_chunks(nz, ntarget, nproc, minz=_zbatch // 4):
+    """Split the redshift grid when there are fewer targets than workers.
+
+    Args:
+        nz (int): the number of redshifts.
+        ntarget (int): the number of targets.
+        nproc (int): the number of workers.
+        minz (int): the smallest number of redshifts in a chunk.
+
+    Returns:
+        list: list of (first, last) redshift ranges, in order.  This is the
+            whole range if there are at least as many targets as workers.
+
+    """
+    nsplit = 1
+    if ntarget < nproc:
+        nsplit = int(np.ceil(nproc / max(ntarget, 1)))
+    nsplit = max(1, min(nsplit, nz // max(minz, 1)))
+    bounds = np.linspace(0, nz, nsplit + 1).astype(int)
+    return [ (int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) ]
+
+
+def _pool_calc_zchi2(pool, dtemplate, target_ids, banded, progress=None,
+    zmask=None, fft=False):
+    """Run calc_zchi2 for the local redshifts of a template on a pool.
+
+    Args:
+        pool (WorkerPool): the pool of workers.
+        dtemplate (DistTemplate): the template.
+        target_ids (list): the target IDs.
+        banded (bool): passed to calc_zchi2.
+        progress (function): called with the number of (target, redshift
+            chunk) units done.
+        zmask (dict): optional boolean array of the redshifts to compute
+            over the full redshift grid of the template, for each target ID
+            (see calc_zchi2).  Default is all redshifts.
+        fft (bool): passed to calc_zchi2.
+
+    Returns:
+        tuple: (tids, zchi2, zcoeff, zchi2penalty), where tids is the order of
+            the targets in the result arrays.
+
+    """
+    tindex = pool.template_index(dtemplate)
+
+    # If there are fewer targets than workers, also split the redshifts so
+    # that all workers have something to do.
+    nz = len(dtemplate.local.redshifts)
+    zchunks = zscan_chunks(nz, len(target_ids), pool.nproc)
+
+    # The workers write the rows of their chunks of targets, and the columns
+    # of their redshifts, in the outputs (in shared memory for worker
+    # processes).
+    tids, chunks = pool.schedule(target_ids)
+    out = [ pool.empty((len(tids), nz)),
+        pool.empty((len(tids), nz, dtemplate.template.nbasis)),
+        pool.empty((len(tids), nz)) ]
+    def _mask(ids, zr):
+        if zmask is None:
+            return None
+        zfirst = dtemplate.local.first + zr[0]
+        zlast = dtemplate.local.first + zr[1]
+        return np.array([ zmask[x][zfirst:zlast] for x in ids ])
+
+    tasks = [ (tindex, banded, _mask(tids[first:last], zr), fft,
+        tids[first:last], out, first, zr) \
+        for first, last in chunks for zr in zchunks ]
+
     try:
-        # Unpack targets from shared memory
-        for tg in target_data:
-            tg.sharedmem_unpack()
-        tzchi2, tzcoeff, tpenalty = calc_zchi2(target_ids, target_data, t,
-            progress=qprog)
-        qout.put( (indx, tzchi2, tzcoeff, tpenalty) )
-    except:
-        exc_type, exc_value, exc_traceback = sys.exc_info()
-        lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
-        lines = [ "MP calc_zchi2: {}".format(x) for x in lines ]
-        print("".join(lines))
+        pool.map(_mp_calc_zchi2, tasks, progress=progress)
+        tzchi2, tzcoeff, tpenalty = [ x.array for x in out ]
+    finally:
+        for x in out:
+            x.unlink()
+            x.close()
+    return tids, tzchi2, tzcoeff, tpenalty
+
+
+def _scan_template(pool, targets, t, banded, fft, am_root, zmask=None):
+    """Scan the redshifts of one template for all local targets.
+
+    With MPI, the redshift slices of the template are cycled between the
+    processes.  In all cases, the local work of each slice is run on the
+    pool.
+
+    Args:
+        pool (WorkerPool): the pool of workers.
+        targets (DistTargets): distributed targets.
+        t (DistTemplate): the template.
+        banded (bool): passed to calc_zchi2.
+        fft (bool): passed to calc_zchi2.
+        am_root (bool): if True, this process prints the progress.
+        zmask (dict): passed to _pool_calc_zchi2.
+
+    Returns:
+        tuple: (zchi2, zcoeff, penalty) dictionaries of the results over the
+            full redshift grid for each local target ID.
+
+    """
+    if targets.comm is not None:
+        # MPI case.
+        # The following while-loop will cycle through the redshift slices
+        # (one per MPI process) until all processes have computed the chi2
+        # for all redshifts for their local targets.
+
+        if am_root:
+            sys.stdout.write("    Progress: {:3d} %\n".format(0))
+            sys.stdout.flush()
+
+        zchi2 = dict()
+        zcoeff = dict()
+        penalty = dict()
+
+        mpi_prog_frac = 1.0
+        prog_chunk = 10
+        if (t.comm is not None) and not t.shared:
+            mpi_prog_frac = 1.0 / t.comm.size
+            if t.comm.size < prog_chunk:
+                prog_chunk = 100 // t.comm.size
+        proglast = 0
+        prog = 1
+
+        done = False
+        while not done:
+            # Start passing the current slice to the next process, so
+            # that the transfer overlaps with our computation.
+            t.prefetch()
+
+            # Compute the fit for our current redshift slice.
+            tids, tzchi2, tzcoeff, tpenalty = _pool_calc_zchi2(pool, t,
+                targets.local_target_ids(), banded, zmask=zmask, fft=fft)
+
+            # Save the results into a dict keyed on targetid
+            for i, tid in enumerate(tids):
+                if tid not in zchi2:
+                    zchi2[tid] = {}
+                    zcoeff[tid] = {}
+                    penalty[tid] = {}
+                zchi2[tid][t.local.index] = tzchi2[i]
+                zcoeff[tid][t.local.index] = tzcoeff[i]
+                penalty[tid][t.local.index] = tpenalty[i]
+
+            prg = int(100.0 * prog * mpi_prog_frac)
+            if prg >= proglast + prog_chunk:
+                proglast += prog_chunk
+                if am_root and (t.comm is not None):
+                    sys.stdout.write("    Progress: {:3d} %\n"\
+                        .format(proglast))
+                    sys.stdout.flush()
+            prog += 1
+
+            # Cycle through the redshift slices
+            done = t.cycle()
+
+        for tid in zchi2.keys():
+            zchi2[tid] = np.concatenate([ zchi2[tid][p] for p in sorted(zchi2[tid].keys()) ])
+            zcoeff[tid] = np.concatenate([ zcoeff[tid][p] for p in sorted(zcoeff[tid].keys()) ])
+            penalty[tid] = np.concatenate([ penalty[tid][p] for p in sorted(penalty[tid].keys()) ])
+    else:
+        # Single process case.  The workers already hold the targets
+        # and all templates, so we only send the template index and the
+        # chunks of target IDs, which the workers take from a queue.
+
+        # Track progress
+        sys.stdout.write("    Progress: {:3d} %\n".format(0))
         sys.stdout.flush()
+        # Progress is counted in (target, redshift chunk) units.
+        ntarget = len(targets.local_target_ids())
+        ntarget *= len(zscan_chunks(len(t.template.redshifts), ntarget,
+            pool.nproc))
+        progincr = 10
+        if pool.nproc > ntarget:
+            progincr = int(100.0 / ntarget)
+        prog = { "tot":0, "last":0 }
+
+        def _progress(cnt):
+            prog["tot"] += cnt
+            prg = int(100.0 * prog["tot"] / ntarget)
+            if prg >= prog["last"] + progincr:
+                prog["last"] += progincr
+                sys.stdout.write("    Progress: {:3d} %\n"\
+                    .format(prog["last"]))
+                sys.stdout.flush()
+
+        tids, tzchi2, tzcoeff, tpenalty = _pool_calc_zchi2(pool, t,
+            targets.local_target_ids(), banded, progress=_progress,
+            zmask=zmask, fft=fft)
+        pool.print_busy("    ")
 
+        # The results are views of the shared outputs.
+        zchi2 = dict()
+        zcoeff = dict()
+        penalty = dict()
+        for j, tid in enumerate(tids):
+            zchi2[tid] = tzchi2[j]
+            zcoeff[tid] = tzcoeff[j]
+            penalty[tid] = tpenalty[j]
 
-def calc_zchi2_targets(targets, templates, mp_procs=1):
+
+    return zchi2, zcoeff, penalty
+
+
+def calc_zchi2_targets(targets, templates, mp_procs=1, banded=False,
+    pool=None, hierarchy=None, fft=False):
     """Compute all chi2 fits for the local set of targets and collect.
 
     Given targets and templates distributed across a set of MPI processes,
@@ -177,6 +804,19 @@ def calc_zchi2_targets(targets, templates, mp_procs=1):
         templates (list): list of DistTemplate objects.
         mp_procs (int): if not using MPI, this is the number of multiprocessing
             processes to use.
+        banded (bool): if True, precompute the normal equation products of
+            every target once and use the banded scan (see calc_zchi2).
+        pool (WorkerPool): the pool of workers which scans the local targets
+            (see redrock.workers.create_pool).  If None, a pool of the
+            default backend is created for this call: mp_procs processes
+            without MPI, or serial with MPI.
+        hierarchy (HierarchicalScan): if not None, scan the redshifts from
+            coarse to fine: the decimated redshifts of the full grid first,
+            then the windows around the best minima of each target.  The
+            chi2 of the skipped redshifts is 9e99.
+        fft (bool): if True, scan the targets on log-lambda wavelength grids
+            with FFT cross-correlations (see calc_zchi2_fft).  The other
+            targets are scanned as usual.
 
     Returns:
         dict: dictionary of results for each local target ID.
@@ -193,19 +833,29 @@ def calc_zchi2_targets(targets, templates, mp_procs=1):
     elif targets.comm.rank == 0:
         am_root = True
 
-    # If we are not using MPI, our DistTargets object will have all the targets
-    # on the main process.  In that case, we would like to distribute our
-    # targets across multiprocesses.  Here we compute that distribution, if
-    # needed.
+    # The local targets of this process are distributed across a pool of
+    # workers.  If we are not using MPI, our DistTargets object will have all
+    # the targets on the main process.
 
-    mpdist = None
-    if targets.comm is None:
-        mpdist = distribute_targets(targets.local(), mp_procs)
+    if pool is None:
+        # Run on a pool of the default backend for this call, which is
+        # stopped even if the scan fails.
+        with create_pool(default_backend(targets.comm, mp_procs), mp_procs,
+            targets, templates) as pool:
+            return calc_zchi2_targets(targets, templates, mp_procs=mp_procs,
+                banded=banded, pool=pool, hierarchy=hierarchy, fft=fft)
 
     results = dict()
     for tid in targets.local_target_ids():
         results[tid] = dict()
 
+    # The normal equation products do not depend on the template, so compute
+    # them once for all templates.  Worker processes keep their own.
+    if banded and pool.shared_targets:
+        for tg in targets.local():
+            if tg.normal is None:
+                tg.compute_normal()
+
     if am_root:
         print("Computing redshifts")
         sys.stdout.flush()
@@ -220,124 +870,33 @@ def calc_zchi2_targets(targets, templates, mp_procs=1):
 
         start = elapsed(None, "", comm=t.comm)
 
-        # There are 2 parallelization techniques supported here (MPI and
-        # multiprocessing).
-
-        zchi2 = None
-        zcoeff = None
-        penalty = None
-
-        if targets.comm is not None:
-            # MPI case.
-            # The following while-loop will cycle through the redshift slices
-            # (one per MPI process) until all processes have computed the chi2
-            # for all redshifts for their local targets.
-
-            if am_root:
-                sys.stdout.write("    Progress: {:3d} %\n".format(0))
-                sys.stdout.flush()
-
-            zchi2 = dict()
-            zcoeff = dict()
-            penalty = dict()
-
-            mpi_prog_frac = 1.0
-            prog_chunk = 10
-            if t.comm is not None:
-                mpi_prog_frac = 1.0 / t.comm.size
-                if t.comm.size < prog_chunk:
-                    prog_chunk = 100 // t.comm.size
-            proglast = 0
-            prog = 1
-
-            done = False
-            while not done:
-                # Compute the fit for our current redshift slice.
-                tzchi2, tzcoeff, tpenalty = \
-                    calc_zchi2(targets.local_target_ids(), targets.local(), t)
-
-                # Save the results into a dict keyed on targetid
-                tids = targets.local_target_ids()
-                for i, tid in enumerate(tids):
-                    if tid not in zchi2:
-                        zchi2[tid] = {}
-                        zcoeff[tid] = {}
-                        penalty[tid] = {}
-                    zchi2[tid][t.local.index] = tzchi2[i]
-                    zcoeff[tid][t.local.index] = tzcoeff[i]
-                    penalty[tid][t.local.index] = tpenalty[i]
-
-                prg = int(100.0 * prog * mpi_prog_frac)
-                if prg >= proglast + prog_chunk:
-                    proglast += prog_chunk
-                    if am_root and (t.comm is not None):
-                        sys.stdout.write("    Progress: {:3d} %\n"\
-                            .format(proglast))
-                        sys.stdout.flush()
-                prog += 1
-
-                # Cycle through the redshift slices
-                done = t.cycle()
-
-            for tid in zchi2.keys():
-                zchi2[tid] = np.concatenate([ zchi2[tid][p] for p in sorted(zchi2[tid].keys()) ])
-                zcoeff[tid] = np.concatenate([ zcoeff[tid][p] for p in sorted(zcoeff[tid].keys()) ])
-                penalty[tid] = np.concatenate([ penalty[tid][p] for p in sorted(penalty[tid].keys()) ])
+        if (hierarchy is None) or (hierarchy.step <= 1):
+            zchi2, zcoeff, penalty = _scan_template(pool, targets, t, banded,
+                fft, am_root)
         else:
-            # Multiprocessing case.
-            import multiprocessing as mp
-
-            # Ensure that all targets are packed into shared memory
-            for tg in targets.local():
-                tg.sharedmem_pack()
-
-            # We explicitly spawn processes here (rather than using a pool.map)
-            # so that we can communicate the read-only objects once and send
-            # a whole list of redshifts to each process.
-
-            qout = mp.Queue()
-            qprog = mp.Queue()
-
-            procs = list()
-            for i in range(mp_procs):
-                if len(mpdist[i]) == 0:
-                    continue
-                target_ids = mpdist[i]
-                target_data = [ x for x in targets.local() if x.id in mpdist[i] ]
-                p = mp.Process(target=_mp_calc_zchi2,
-                    args=(i, target_ids, target_data, t, qout, qprog))
-                procs.append(p)
-                p.start()
-
-            # Track progress
-            sys.stdout.write("    Progress: {:3d} %\n".format(0))
-            sys.stdout.flush()
-            ntarget = len(targets.local_target_ids())
-            progincr = 10
-            if mp_procs > ntarget:
-                progincr = int(100.0 / ntarget)
-            tot = 0
-            proglast = 0
-            while (tot < ntarget):
-                cnt = qprog.get()
-                tot += cnt
-                prg = int(100.0 * tot / ntarget)
-                if prg >= proglast + progincr:
-                    proglast += progincr
-                    sys.stdout.write("    Progress: {:3d} %\n".format(proglast))
-                    sys.stdout.flush()
-
-            # Extract the output
-            zchi2 = dict()
-            zcoeff = dict()
-            penalty = dict()
-            for _ in range(len(procs)):
-                res = qout.get()
-                tids = mpdist[res[0]]
-                for j,tid in enumerate(tids):
-                    zchi2[tid] = res[1][j]
-                    zcoeff[tid] = res[2][j]
-                    penalty[tid] = res[3][j]
+            # Coarse pass on every step-th redshift of the full grid, then
+            # refinement of the windows around the best minima of each
+            # target.  The windows are selected on the full grid, so they do
+            # not depend on how the redshifts are split among the workers
+            # or the MPI processes.
+            nz = len(t.template.redshifts)
+            icoarse = hierarchy.coarse_indices(nz)
+            coarse = np.zeros(nz, dtype=bool)
+            coarse[icoarse] = True
+            zchi2, zcoeff, penalty = _scan_template(pool, targets, t, banded,
+                fft, am_root, zmask={ tid:coarse \
+                for tid in targets.local_target_ids() })
+            fine = dict()
+            for tid in zchi2.keys():
+                cchi2 = zchi2[tid][icoarse] + penalty[tid][icoarse]
+                fine[tid] = np.zeros(nz, dtype=bool)
+                fine[tid][hierarchy.fine_indices(cchi2, icoarse, nz)] = True
+            fchi2, fcoeff, fpenalty = _scan_template(pool, targets, t,
+                banded, fft, am_root, zmask=fine)
+            for tid, m in fine.items():
+                zchi2[tid][m] = fchi2[tid][m]
+                zcoeff[tid][m] = fcoeff[tid][m]
+                penalty[tid][m] = fpenalty[tid][m]
 
         elapsed(start, "    Finished in", comm=t.comm)
 